@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+    Compare searching the whole fuzzy index with artist blocking (match the artist first, then search only
+    that artist's recordings), for growing collections. Recording names are made of a small set of common
+    words, so that many recordings of other artists share trigrams with each query. Reports the time per
+    query and the fraction of queries that found the right recording.
+
+    Usage: python benchmarks/artist_blocking.py [--sizes 10000,100000] [--queries 500] [--backend scipy]
+"""
+
+import os
+import random
+import sys
+from time import monotonic
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.fuzzy_index import FuzzyIndex
+from encode_strings import random_name
+
+COMMON_WORDS = ("love", "night", "heart", "time", "dream", "fire", "blue", "song", "light", "world", "baby", "rain",
+                "home", "dance", "way", "life", "girl", "day", "you", "me", "the", "of", "in", "my")
+
+
+def make_data(recordings):
+    artist_names = [random_name(random.randint(1, 3)) for _ in range(max(1, recordings // 20))]
+    data = []
+    for i in range(recordings):
+        recording_name = " ".join(random.choices(COMMON_WORDS, k=random.randint(2, 4)))
+        data.append((random.choice(artist_names), recording_name, i))
+    return data
+
+
+def query_for(artist_name, recording_name):
+    """ A query with a typo in the recording name """
+    i = random.randrange(len(recording_name))
+    return {"artist_name": artist_name, "recording_name": recording_name[:i] + recording_name[i + 1:]}
+
+
+@click.command()
+@click.option("--sizes", default="10000,100000", help="Comma separated collection sizes")
+@click.option("--queries", default=500, help="Number of queries")
+@click.option("--backend", default=None, help="Search backend for the global index")
+def main(sizes, queries, backend):
+    random.seed(1)
+    print("%-10s %-10s %14s %10s" % ("size", "search", "ms per query", "correct"))
+    for size in [int(s) for s in sizes.split(",")]:
+        data = make_data(size)
+        index = FuzzyIndex(backend)
+        index.build(data)
+        sample = random.sample(data, queries)
+        query_data = [query_for(artist_name, recording_name) for artist_name, recording_name, _ in sample]
+        expected = [(artist_name, recording_name) for artist_name, recording_name, _ in sample]
+        names = {recording_id: (artist_name, recording_name) for artist_name, recording_name, recording_id in data}
+
+        for name, artist_blocking in (("global", False), ("blocked", True)):
+            t0 = monotonic()
+            hits = [index.search([query], k=1, artist_blocking=artist_blocking)[0] for query in query_data]
+            elapsed = (monotonic() - t0) / queries
+            # Several recordings can have the same names, so compare names instead of ids
+            correct = sum(names.get(hit["recording_id"]) == e for hit, e in zip(hits, expected)) / queries
+            print("%-10d %-10s %14.2f %10.3f" % (size, name, elapsed * 1000, correct))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+    Measure the time and memory needed to load the recordings from the database and build the
+    fuzzy index, comparing the old loading code (which created model instances and loaded every
+    recording twice) with ContentResolver.get_artist_recording_metadata.
+
+    Each variant runs in its own process, so the peak RSS of one doesn't affect the other.
+
+    Usage: python benchmarks/build_index.py [--recordings 100000]
+"""
+
+from multiprocessing import Process, Queue
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+from time import monotonic
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.content_resolver import ContentResolver
+from lb_content_resolver.database import Database
+from lb_content_resolver.fuzzy_index import FuzzyIndex
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, FileIdType
+
+
+def random_name(words):
+    return " ".join("".join(random.choices(string.ascii_lowercase, k=random.randint(3, 9))) for _ in range(words))
+
+
+def make_database(db_file, count):
+    """ Create a database with count random recordings, by artists with 50 recordings each. """
+
+    database = Database(db_file)
+    database.create()
+    artists = [random_name(2) for _ in range(max(1, count // 50))]
+    rows = []
+    for i in range(count):
+        rows.append({
+            "file_id": "/music/%d.flac" % i,
+            "file_id_type": FileIdType.FILE_PATH,
+            "mtime": 0,
+            "artist_name": random.choice(artists),
+            "release_name": random_name(3),
+            "recording_name": random_name(random.randint(1, 5)),
+        })
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Recording.insert_many(rows[i:i + 500]).execute()
+    database.close()
+
+
+def load_with_models():
+    """ The loading code of ContentResolver.build_index before it was fixed """
+
+    artist_recording_data = []
+    for recording in Recording.select():
+        artist_recording_data.append((recording.artist_name, recording.recording_name, recording.id))
+    for recording in Recording.select():
+        artist_recording_data.append((recording.artist_name, recording.recording_name, recording.id))
+    return artist_recording_data
+
+
+def load_with_cursor():
+    return ContentResolver().get_artist_recording_metadata()
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run(db_file, load, results):
+    Database(db_file).open()
+    rss_before = max_rss_mb()
+    t0 = monotonic()
+    data = load()
+    t1 = monotonic()
+    FuzzyIndex().build(data)
+    t2 = monotonic()
+    results.put((len(data), t1 - t0, t2 - t1, max_rss_mb() - rss_before))
+
+
+@click.command()
+@click.option("--recordings", default=100000, help="Number of recordings in the test database")
+def main(recordings):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "benchmark.db")
+        make_database(db_file, recordings)
+
+        print("%-8s %10s %10s %10s %14s" % ("loader", "rows", "load s", "build s", "peak RSS +MB"))
+        for name, load in (("models", load_with_models), ("cursor", load_with_cursor)):
+            results = Queue()
+            p = Process(target=run, args=(db_file, load, results))
+            p.start()
+            rows, load_time, build_time, rss = results.get()
+            p.join()
+            print("%-8s %10d %10.2f %10.2f %14.1f" % (name, rows, load_time, build_time, rss))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+    Measure how long the normalization of names and the trigram analysis take when building the
+    fuzzy index, comparing the old per string code (TfidfVectorizer calling ngrams for each string)
+    with the batched, memoized encode_strings and count_trigrams. Times are given per 100k recordings.
+
+    Usage: python benchmarks/encode_strings.py [--recordings 100000] [--artists 5000]
+"""
+
+import os
+import random
+import re
+import string
+import sys
+from time import monotonic
+
+import click
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
+from unidecode import unidecode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.fuzzy_index import FuzzyIndex, count_trigrams
+
+ACCENTED = "áàâäãåçéèêëíìîïñóòôöõøúùûüýÿßæœ"
+
+
+def random_word():
+    letters = string.ascii_lowercase * 4 + ACCENTED
+    return "".join(random.choices(letters, k=random.randint(3, 9))).capitalize()
+
+
+def random_name(words):
+    return " ".join(random_word() for _ in range(words)) + random.choice(("", "", "", "!", " (Live)", " - Remastered"))
+
+
+def old_encode_string(text):
+    """ FuzzyIndex.encode_string before it was batched """
+    if text is None:
+        return None
+    return unidecode(re.sub(" +", "", re.sub(r'[^\w ]+', '', text)).strip().lower())
+
+
+def old_ngrams(string, n=3):
+    """ ngrams before it was simplified """
+    string = ' ' + string + ' '
+    ngrams = zip(*[string[i:] for i in range(n)])
+    return [''.join(ngram) for ngram in ngrams]
+
+
+def old_encode_data(artist_recording_data):
+    lookup_strings = []
+    for artist_name, recording_name, lookup_id in artist_recording_data:
+        if artist_name is None or recording_name is None:
+            continue
+        lookup_strings.append(old_encode_string(artist_name) + old_encode_string(recording_name))
+    return lookup_strings
+
+
+def new_encode_data(artist_recording_data):
+    return FuzzyIndex().encode_data(artist_recording_data)[0]
+
+
+def old_analyze(lookup_strings):
+    TfidfVectorizer(min_df=1, analyzer=old_ngrams).fit_transform(lookup_strings)
+
+
+def new_analyze(lookup_strings):
+    counts, vocabulary = count_trigrams(lookup_strings)
+    TfidfTransformer().fit_transform(counts)
+
+
+@click.command()
+@click.option("--recordings", default=100000, help="Number of recordings to encode")
+@click.option("--artists", default=5000, help="Number of distinct artists")
+def main(recordings, artists):
+    random.seed(1)
+    artist_names = [random_name(random.randint(1, 3)) for _ in range(artists)]
+    data = [(random.choice(artist_names), random_name(random.randint(1, 5)), i) for i in range(recordings)]
+    per_100k = 100000 / recordings
+
+    print("%-6s %12s %12s %12s" % ("code", "encode s", "analyze s", "total s"))
+    print("%-6s %12s %12s %12s" % ("", "per 100k", "per 100k", "per 100k"))
+    for name, encode_data, analyze in (("old", old_encode_data, old_analyze), ("new", new_encode_data, new_analyze)):
+        t0 = monotonic()
+        lookup_strings = encode_data(data)
+        t1 = monotonic()
+        analyze(lookup_strings)
+        t2 = monotonic()
+        print("%-6s %12.2f %12.2f %12.2f" % (name, (t1 - t0) * per_100k, (t2 - t1) * per_100k, (t2 - t0) * per_100k))
+
+    t0 = monotonic()
+    FuzzyIndex().build(data)
+    print("\nFuzzyIndex.build, including the nmslib index: %.2fs per 100k" % ((monotonic() - t0) * per_100k))
+
+
+if __name__ == "__main__":
+    main()
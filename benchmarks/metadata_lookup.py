@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+    Measure how long the metadata lookup takes against the stand-in bulk tag lookup server, which adds
+    a fixed latency to every request, with different numbers of batches looked up at the same time.
+    With more than one, the next batches are looked up while the results are written to the database.
+
+    Usage: python benchmarks/metadata_lookup.py [--recordings 20000] [--latency 0.5] [--concurrency 1,2,4,8]
+"""
+
+import datetime
+import os
+import sys
+import tempfile
+from time import monotonic
+import uuid
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.database import Database
+from lb_content_resolver.metadata_lookup import MetadataLookup
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, FileIdType
+from lb_content_resolver.test.fake_tag_lookup import FakeTagLookupServer
+
+
+def create_db(db_file, recordings):
+    database = Database(db_file)
+    database.create()
+    database.open()
+    rows = [{"file_id": "/music/%d.flac" % i,
+             "file_id_type": FileIdType.FILE_PATH,
+             "mtime": datetime.datetime.now(),
+             "recording_name": "Recording %d" % i,
+             "recording_mbid": str(uuid.uuid4())} for i in range(recordings)]
+    with db.atomic():
+        for i in range(0, len(rows), 50):
+            Recording.insert_many(rows[i:i + 50]).execute()
+
+
+@click.command()
+@click.option("--recordings", default=20000, help="Number of recordings to look up")
+@click.option("--latency", default=0.5, help="Seconds each request takes")
+@click.option("--concurrency", default="1,2,4,8", help="Comma separated numbers of batches looked up at the same time")
+def main(recordings, latency, concurrency):
+    results = []
+    with FakeTagLookupServer(latency=latency) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        for n in [int(c) for c in concurrency.split(",")]:
+            create_db(os.path.join(tmp_dir, "lookup-%d.db" % n), recordings)
+            t0 = monotonic()
+            MetadataLookup(url=server.url, concurrency=n).lookup()
+            results.append((n, monotonic() - t0))
+            db.close()
+
+    print("\n%-12s %10s %18s" % ("concurrency", "lookup s", "recordings per s"))
+    for n, elapsed in results:
+        print("%-12d %10.2f %18.0f" % (n, elapsed, recordings / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+    Count the file system calls made per audio file while walking a music collection, using the
+    old os.walk based traversal and the os.scandir based walker of Database.walk.
+
+    The calls are counted by wrapping os.stat, os.lstat, os.scandir and DirEntry.stat, so this
+    counts calls made from Python, on any platform. On network mounts each one of them is a round trip.
+
+    Usage: python benchmarks/scan_syscalls.py [--dirs 200] [--files 12]
+"""
+
+from collections import Counter
+import os
+import sys
+import tempfile
+from time import monotonic
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.database import Database, ScanCounters, ALL_EXTENSIONS, match_extensions
+
+
+class CountingDirEntry:
+    """ Wrap a DirEntry, counting the stat calls. The is_* calls are served from the d_type in most cases. """
+
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+
+    def stat(self, *, follow_symlinks=True):
+        self._counter["DirEntry.stat"] += 1
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+
+class CountingScandir:
+
+    def __init__(self, it, counter):
+        self._it = it
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._it.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return CountingDirEntry(next(self._it), self._counter)
+
+    def close(self):
+        self._it.close()
+
+
+class SyscallCounter:
+    """ Context manager that counts calls to the os functions that hit the file system. """
+
+    def __enter__(self):
+        self.counter = Counter()
+        self.saved = {name: getattr(os, name) for name in ("stat", "lstat", "scandir")}
+
+        def wrap(name):
+            func = self.saved[name]
+
+            def wrapper(*args, **kwargs):
+                self.counter["os." + name] += 1
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        os.stat = wrap("stat")
+        os.lstat = wrap("lstat")
+        scandir = wrap("scandir")
+        os.scandir = lambda *args, **kwargs: CountingScandir(scandir(*args, **kwargs), self.counter)
+        return self.counter
+
+    def __exit__(self, *args):
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+
+
+def make_tree(top, dirs, files):
+    """ Create a collection of artist/album directories with empty audio files and a cover in each. """
+
+    for i in range(dirs):
+        album_dir = os.path.join(top, "artist %d" % (i // 5), "album %d" % i)
+        os.makedirs(album_dir)
+        for j in range(files):
+            open(os.path.join(album_dir, "%02d track.mp3" % j), "w").close()
+        open(os.path.join(album_dir, "cover.jpg"), "w").close()
+
+
+def old_traverse(top):
+    """ The traversal done by Database.traverse and Database.add before the scandir walker. """
+
+    count = 0
+    for root, dirs, files in os.walk(top):
+        root = os.path.realpath(root)
+        os.stat(root)  # dir_has_changed
+        for name in files:
+            file_path = os.path.realpath(os.path.join(root, name))
+            if os.path.isfile(file_path) and match_extensions(file_path, ALL_EXTENSIONS):
+                os.stat(file_path)  # add
+                count += 1
+    return count
+
+
+def new_traverse(top):
+    """ The traversal done by Database.walk and Database.add now. """
+
+    database = Database(None)
+    database.music_dirs = (top, )
+    database.forced_scan = True
+    database.counters = ScanCounters()
+    count = 0
+    for position, root, dir_mtime, files in database.walk():
+        for file_path, timestamp in files:
+            if timestamp is None:
+                os.stat(file_path)  # add
+            count += 1
+    return count
+
+
+def report(name, func, top):
+    with SyscallCounter() as counter:
+        t0 = monotonic()
+        count = func(top)
+        duration = monotonic() - t0
+
+    total = sum(counter.values())
+    print("%-8s %d audio files, %.3fs, %d calls, %.2f calls per file" % (name, count, duration, total, total / count))
+    for name, calls in sorted(counter.items()):
+        print("         %-15s %6d (%.2f per file)" % (name, calls, calls / count))
+
+
+@click.command()
+@click.option("--dirs", default=200, help="Number of album directories to create")
+@click.option("--files", default=12, help="Number of audio files per album directory")
+def main(dirs, files):
+    with tempfile.TemporaryDirectory() as top:
+        top = os.path.realpath(top)
+        make_tree(top, dirs, files)
+        report("before", old_traverse, top)
+        report("after", new_traverse, top)
+
+
+if __name__ == "__main__":
+    main()
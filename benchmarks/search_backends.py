@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+    Compare the fuzzy index search backends (nmslib and scipy) on build time, search latency and memory.
+    Each backend runs in its own process, so the peak RSS of one doesn't affect the other.
+
+    Usage: python benchmarks/search_backends.py [--recordings 100000] [--queries 1000] [--threads 4]
+"""
+
+from multiprocessing import Process, Queue
+import os
+import random
+import resource
+import sys
+from time import monotonic
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.fuzzy_backends import BACKENDS
+from lb_content_resolver.fuzzy_index import FuzzyIndex
+from encode_strings import random_name
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run(backend, recordings, queries, threads, results):
+    random.seed(1)
+    artist_names = [random_name(random.randint(1, 3)) for _ in range(max(1, recordings // 20))]
+    data = [(random.choice(artist_names), random_name(random.randint(1, 5)), i) for i in range(recordings)]
+    # Queries with a few characters missing, so they don't match exactly
+    query_data = [{"artist_name": artist_name, "recording_name": recording_name[:-2]}
+                  for artist_name, recording_name, _ in random.sample(data, queries)]
+
+    rss_before = max_rss_mb()
+    index = FuzzyIndex(backend)
+    t0 = monotonic()
+    index.build(data)
+    build_time = monotonic() - t0
+    rss = max_rss_mb() - rss_before
+
+    t0 = monotonic()
+    index.search(query_data, k=5, num_threads=threads)
+    batch_time = monotonic() - t0
+
+    t0 = monotonic()
+    for query in query_data[:100]:
+        index.search([query], k=5, num_threads=1)
+    single_time = (monotonic() - t0) / min(100, len(query_data))
+
+    results.put((build_time, batch_time, single_time, rss))
+
+
+@click.command()
+@click.option("--recordings", default=100000, help="Number of recordings in the index")
+@click.option("--queries", default=1000, help="Number of queries searched for in one batch")
+@click.option("--threads", default=4, help="Number of threads used to search")
+def main(recordings, queries, threads):
+    print("%-8s %10s %14s %14s %14s" % ("backend", "build s", "batch ms", "single ms", "peak RSS +MB"))
+    for name, backend in BACKENDS.items():
+        if not backend.available():
+            print("%-8s not installed" % name)
+            continue
+
+        results = Queue()
+        p = Process(target=run, args=(name, recordings, queries, threads, results))
+        p.start()
+        build_time, batch_time, single_time, rss = results.get()
+        p.join()
+        print("%-8s %10.2f %14.1f %14.2f %14.1f" % (name, build_time, batch_time * 1000, single_time * 1000, rss))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+    Measure how long a subsonic sync takes against the stand-in subsonic server, which adds a fixed
+    latency to every request, with different numbers of albums fetched at the same time. On a real
+    server the sync is dominated by this latency, since several requests are made for each album.
+    Each sync is followed by an incremental sync of the unchanged library.
+
+    Usage: python benchmarks/subsonic_sync.py [--albums 500] [--latency 0.02] [--concurrency 1,4,16]
+"""
+
+import os
+import sys
+import tempfile
+from time import monotonic
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.model.database import db
+from lb_content_resolver.subsonic import SubsonicDatabase
+from lb_content_resolver.test.fake_subsonic import FakeLibrary, FakeSubsonicServer
+
+
+@click.command()
+@click.option("--albums", default=500, help="Number of albums in the library")
+@click.option("--songs", default=10, help="Number of songs per album")
+@click.option("--latency", default=0.02, help="Seconds each request takes")
+@click.option("--concurrency", default="1,4,16", help="Comma separated numbers of albums fetched at the same time")
+def main(albums, songs, latency, concurrency):
+    library = FakeLibrary(albums=albums, songs_per_album=songs, artists=max(1, albums // 5))
+    results = []
+    with FakeSubsonicServer(library, latency=latency) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        for n in [int(c) for c in concurrency.split(",")]:
+            subsonic_db = SubsonicDatabase(os.path.join(tmp_dir, "sync-%d.db" % n), server.config())
+            subsonic_db.create()
+            subsonic_db.open()
+            t0 = monotonic()
+            subsonic_db.sync(concurrency=n)
+            t1 = monotonic()
+            subsonic_db.sync(concurrency=n, incremental=True)
+            results.append((n, t1 - t0, monotonic() - t1))
+            db.close()
+
+    print("\n%-12s %10s %14s %16s" % ("concurrency", "sync s", "albums per s", "incremental s"))
+    for n, elapsed, incremental_elapsed in results:
+        print("%-12d %10.2f %14.1f %16.2f" % (n, elapsed, albums / elapsed, incremental_elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+    Compare how subsonic songs are written to the database: the old way, with a transaction, a SELECT
+    and a save() or create() for every song, and the bulk add_subsonic_songs, which writes a batch of
+    songs with a few insert_many statements. Both are timed adding the songs to an empty database and
+    updating them again. Then a complete sync against the stand-in subsonic server is timed.
+
+    Usage: python benchmarks/subsonic_write.py [--albums 2000] [--songs 10]
+"""
+
+import datetime
+import os
+import sys
+import tempfile
+from time import monotonic
+
+import click
+import peewee
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, FileIdType
+from lb_content_resolver.subsonic import SubsonicDatabase
+from lb_content_resolver.test.fake_subsonic import FakeLibrary, FakeSubsonicServer
+
+
+def old_add_subsonic(song):
+    """ SubsonicDatabase.add_subsonic before songs were written in batches """
+    with db.atomic():
+        try:
+            recording = Recording.select().where(Recording.file_id == song['file_id']).get()
+            recording.artist_name = song["artist_name"]
+            recording.release_name = song["release_name"]
+            recording.recording_name = song["recording_name"]
+            recording.artist_mbid = song["artist_mbid"]
+            recording.release_mbid = song["release_mbid"]
+            recording.recording_mbid = song["recording_mbid"]
+            recording.mtime = song["mtime"]
+            recording.track_num = song["track_num"]
+            recording.disc_num = song["disc_num"]
+            recording.save()
+        except peewee.DoesNotExist:
+            Recording.create(**song)
+
+
+def old_write(subsonic_db, songs):
+    for song in songs:
+        old_add_subsonic(song)
+
+
+def new_write(subsonic_db, songs):
+    for i in range(0, len(songs), subsonic_db.BATCH_SIZE):
+        subsonic_db.add_subsonic_songs(songs[i:i + subsonic_db.BATCH_SIZE])
+
+
+def make_songs(library):
+    songs = []
+    for album in library.albums.values():
+        for song in album["song"]:
+            songs.append({
+                "file_id": song["id"],
+                "file_id_type": FileIdType.SUBSONIC_ID,
+                "artist_name": song["artist"],
+                "release_name": song["album"],
+                "recording_name": song["title"],
+                "artist_mbid": library.artists[song["artistId"]]["musicBrainzId"],
+                "release_mbid": library.album_mbids[album["id"]],
+                "recording_mbid": song["musicBrainzId"],
+                "duration": song["duration"] * 1000,
+                "track_num": song["track"],
+                "disc_num": song["discNumber"],
+                "mtime": datetime.datetime.now()
+            })
+    return songs
+
+
+@click.command()
+@click.option("--albums", default=2000, help="Number of albums in the library")
+@click.option("--songs", default=10, help="Number of songs per album")
+def main(albums, songs):
+    library = FakeLibrary(albums=albums, songs_per_album=songs, artists=max(1, albums // 5))
+    rows = make_songs(library)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print("%-6s %12s %12s %14s" % ("code", "add s", "update s", "songs per s"))
+        for name, write in (("old", old_write), ("new", new_write)):
+            subsonic_db = SubsonicDatabase(os.path.join(tmp_dir, "%s.db" % name), None)
+            subsonic_db.create()
+            subsonic_db.open()
+            subsonic_db.renamed_ids = set()
+            t0 = monotonic()
+            write(subsonic_db, rows)
+            t1 = monotonic()
+            write(subsonic_db, rows)
+            t2 = monotonic()
+            db.close()
+            print("%-6s %12.2f %12.2f %14.0f" % (name, t1 - t0, t2 - t1, 2 * len(rows) / (t2 - t0)))
+
+        with FakeSubsonicServer(library) as server:
+            subsonic_db = SubsonicDatabase(os.path.join(tmp_dir, "sync.db"), server.config())
+            subsonic_db.create()
+            subsonic_db.open()
+            t0 = monotonic()
+            subsonic_db.sync()
+            elapsed = monotonic() - t0
+            db.close()
+
+    print("\nComplete sync of %d songs from the stand-in server: %.2fs" % (len(rows), elapsed))
+
+
+if __name__ == "__main__":
+    main()
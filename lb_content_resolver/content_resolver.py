@@ -1,14 +1,19 @@
 import os
 import datetime
+from functools import lru_cache
 import sys
+import threading
 from uuid import UUID
 
 import peewee
 
 from lb_content_resolver.model.database import db, setup_db
 from lb_content_resolver.model.recording import Recording, FileIdType
+from lb_content_resolver.model.state import State
+from lb_content_resolver.model.resolution_cache import ResolutionCache
 from lb_content_resolver.unresolved_recording import UnresolvedRecordingTracker
 from lb_content_resolver.fuzzy_index import FuzzyIndex
+from lb_content_resolver.fuzzy_index_store import FuzzyIndexStore
 from lb_matching_tools.cleaner import MetadataCleaner
 from lb_content_resolver.playlist import read_jspf_playlist
 from lb_content_resolver.utils import bcolors
@@ -21,36 +26,70 @@ class ContentResolver:
     Scan a given path and enter/update the metadata in the search index
     '''
 
-    def __init__(self):
+    # The number of candidates fetched from the fuzzy index for each query and reranked
+    DEFAULT_CANDIDATES = 5
+
+    # Reranking adjustments to the fuzzy confidence of a candidate. These are small, so that they
+    # only decide between candidates that matched about equally well on artist and recording name.
+    MBID_BONUS = .1
+    RELEASE_BONUS = .05
+    DURATION_BONUS = .05
+    DURATION_PENALTY = .05
+    DURATION_MATCH = 5000  # ms
+    DURATION_MISMATCH = 30000  # ms
+
+    BATCH_SIZE = 500
+
+    # The maximum number of times the MetadataCleaner is applied to the names of a query, and the
+    # number of distinct names whose cleaned version is remembered
+    MAX_CLEAN_PASSES = 3
+    CLEANER_CACHE_SIZE = 65536
+
+    def __init__(self, num_threads=None, k=DEFAULT_CANDIDATES, artist_blocking=False):
+        """
+            num_threads is the number of threads used to search the fuzzy index, by default one per CPU.
+            k is the number of candidates that are fetched for each query and reranked. If artist_blocking
+            is set, the fuzzy index first matches the artist and then searches only that artist's recordings.
+        """
         self.fuzzy_index = None
+        self.index_lock = threading.Lock()
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.k = k
+        self.artist_blocking = artist_blocking
+        self.cache_lookups = 0
+        self.cache_hits = 0
+        self.mbid_index = None
+        self.mbid_index_version = None
+
+        # Playlists often repeat artist names, so clean each distinct name only once
+        cleaner = MetadataCleaner()
+        self.clean_artist = lru_cache(maxsize=self.CLEANER_CACHE_SIZE)(cleaner.clean_artist)
+        self.clean_recording = lru_cache(maxsize=self.CLEANER_CACHE_SIZE)(cleaner.clean_recording)
 
     def get_artist_recording_metadata(self):
         """
-            Fetch the metadata needed to build a fuzzy search index.
+            Fetch the metadata needed to build a fuzzy search index, as a list of
+            (artist_name, recording_name, recording_id) tuples.
         """
-
-        artist_recording_data = []
-        for recording in Recording.select():
-            artist_recording_data.append((recording.artist_name, recording.recording_name, recording.id))
-
-        return artist_recording_data
+        return FuzzyIndexStore().get_artist_recording_metadata()
 
     def build_index(self):
         """
-            Fetch the data from the DB and then build the fuzzy lookup index.
+            Load the fuzzy lookup index from disk. If it is missing or out of date, fetch the data
+            from the DB, build the index and save it for next time. Nothing is done if the index
+            was already loaded and the collection hasn't changed since.
         """
-
-        artist_recording_data = self.get_artist_recording_metadata()
-        for recording in Recording.select():
-            artist_recording_data.append((recording.artist_name, recording.recording_name, recording.id))
-
-        self.fuzzy_index = FuzzyIndex()
-        self.fuzzy_index.build(artist_recording_data)
+        with self.index_lock:
+            if self.fuzzy_index is not None and self.fuzzy_index.version == State.collection_version():
+                return
+            self.fuzzy_index = FuzzyIndexStore().load()
 
     def resolve_recordings(self, query_data, match_threshold):
         """
         Given a list of dicts with artist_name, recording_name, recording_mbid in query data and
         a matching threshold, attempt to match recordings by looking them up in the fuzzy index.
+        The results are kept in the resolution cache, recordings found in there are not looked up
+        again. The fuzzy index is only built if needed.
         """
 
         resolved_recordings = []
@@ -60,92 +99,304 @@ class ContentResolver:
         for i, data in enumerate(query_data):
             data["index"] = i
 
-        mc = MetadataCleaner()
-        while True:
-            next_query_data = []
-            hits = self.fuzzy_index.search(query_data)
-            for hit, data in zip(hits, query_data):
-
-                # If we resolved this recording via MBID in a previous step, accept that as a match
-                if "recording_id" in data:
-                    resolved_recordings.append({
-                        "artist_name": data["artist_name"],
-                        "recording_name": data["recording_name"],
-                        "recording_mbid": data["recording_mbid"],
-                        "recording_id": data["recording_id"],
-                        "confidence": 1.0,
-                        "index": data["index"],
-                        "method": "MBID"
-                    })
-                    continue
-
-                # if not, proceed to examine the match that metadata lookup gave us
-                if hit["confidence"] < match_threshold:
-                    next_query_data.append(data)
-                    unresolved_recording_mbids.append(data["recording_mbid"])
-                else:
-                    resolved_recordings.append({
-                        "artist_name": data["artist_name"],
-                        "recording_name": data["recording_name"],
-                        "recording_mbid": data["recording_mbid"],
-                        "recording_id": hit["recording_id"],
-                        "confidence": hit["confidence"],
-                        "index": data["index"],
-                        "method": "FUZZY"
-                    })
-
-            if len(next_query_data) == 0:
-                break
-
-            query_data = []
-            for data in next_query_data:
-                recording_name = mc.clean_recording(data["recording_name"])
-                artist_name = mc.clean_artist(data["artist_name"])
-                if recording_name != data["recording_name"]:
-                    query_data.append({"artist_name": artist_name,
-                                       "recording_name": recording_name,
-                                       "recording_mbid": data["recording_mbid"],
-                                       "index": data["index"]})
-
-                if artist_name != data["artist_name"]:
-                    query_data.append({"artist_name": artist_name,
-                                       "recording_name": recording_name,
-                                       "recording_mbid": data["recording_mbid"],
-                                       "index": data["index"]})
-
-            # If nothing got cleaned, we can finish now
-            if len(query_data) == 0:
-                break
+        # If we resolved a recording via MBID in a previous step, accept that as a match
+        fuzzy_query_data = []
+        for data in query_data:
+            if "recording_id" in data:
+                resolved_recordings.append({
+                    "artist_name": data["artist_name"],
+                    "recording_name": data["recording_name"],
+                    "recording_mbid": data["recording_mbid"],
+                    "recording_id": data["recording_id"],
+                    "confidence": 1.0,
+                    "index": data["index"],
+                    "method": "MBID"
+                })
+            else:
+                fuzzy_query_data.append(data)
+
+        version = State.collection_version()
+        cached, query_data = self.lookup_cache(fuzzy_query_data, match_threshold, version)
+        for data, entry in cached:
+            if entry.recording_id is None:
+                unresolved_recording_mbids.append(data["recording_mbid"])
+            else:
+                resolved_recordings.append({
+                    "artist_name": data["artist_name"],
+                    "recording_name": data["recording_name"],
+                    "recording_mbid": data["recording_mbid"],
+                    "recording_id": entry.recording_id,
+                    "confidence": entry.confidence,
+                    "index": data["index"],
+                    "method": entry.method
+                })
+
+        # Search for the names as given and for their cleaned variants in a single batch, since
+        # searching the index in batches is much faster than searching one round after another.
+        # Queries that share a variant search for it only once.
+        variants = []
+        variant_indexes = {}
+        query_variants = []
+        for data in query_data:
+            indexes = []
+            for artist_name, recording_name in self.clean_variants(data["artist_name"], data["recording_name"]):
+                variant = {"artist_name": artist_name,
+                           "recording_name": recording_name,
+                           "recording_mbid": data["recording_mbid"],
+                           "release_name": data.get("release_name"),
+                           "duration": data.get("duration")}
+                key = tuple(variant.values())
+                if key not in variant_indexes:
+                    variant_indexes[key] = len(variants)
+                    variants.append(variant)
+                indexes.append(variant_indexes[key])
+            query_variants.append(indexes)
+
+        hits = []
+        if variants:
+            self.build_index()
+            hits = self.fuzzy_index.search(variants, k=self.k, num_threads=self.num_threads, artist_blocking=self.artist_blocking)
+            hits = self.rerank(hits, variants, match_threshold)
+
+        for data, indexes in zip(query_data, query_variants):
+            # The first variant with the best confidence wins, the names as given come first
+            hit = max((hits[i] for i in indexes), key=lambda hit: hit["confidence"])
+            if hit["confidence"] < match_threshold:
+                unresolved_recording_mbids.append(data["recording_mbid"])
+            else:
+                resolved_recordings.append({
+                    "artist_name": data["artist_name"],
+                    "recording_name": data["recording_name"],
+                    "recording_mbid": data["recording_mbid"],
+                    "recording_id": hit["recording_id"],
+                    "confidence": hit["confidence"],
+                    "index": data["index"],
+                    "method": "FUZZY"
+                })
+
+        self.store_cache(query_data, resolved_recordings, match_threshold, version)
 
         ur = UnresolvedRecordingTracker()
         ur.add(unresolved_recording_mbids)
 
         return resolved_recordings
 
+    def clean_variants(self, artist_name, recording_name):
+        """
+            Return the distinct (artist_name, recording_name) variants to search for: the names as given,
+            followed by the names cleaned by the MetadataCleaner for as long as cleaning changes them.
+        """
+        variants = [(artist_name, recording_name)]
+        if artist_name is None or recording_name is None:
+            return variants
+
+        for _ in range(self.MAX_CLEAN_PASSES):
+            artist_name, recording_name = self.clean_artist(artist_name), self.clean_recording(recording_name)
+            if (artist_name, recording_name) in variants:
+                break
+            variants.append((artist_name, recording_name))
+
+        return variants
+
+    def cache_key(self, data):
+        """
+            Return the resolution cache key for the query data: the normalized artist, recording and
+            release names, the recording MBID and the duration in seconds, along with the number of
+            candidates and the artist blocking setting, since these can change the result.
+        """
+        encode = FuzzyIndex.encode_string
+        duration = data.get("duration")
+        return "\t".join((encode(data["artist_name"]) or "",
+                          encode(data["recording_name"]) or "",
+                          str(data.get("recording_mbid") or ""),
+                          encode(data.get("release_name")) or "",
+                          str(round(duration / 1000)) if duration else "",
+                          "k=%d" % self.k,
+                          "blocking" if self.artist_blocking else ""))
+
+    def lookup_cache(self, query_data, match_threshold, version):
+        """
+            Look up the query data in the resolution cache. Returns a list of (data, cache entry) tuples
+            for the recordings found and a list of the query data that was not found. An entry is only used
+            if it was made with the same threshold, since the threshold decides which candidates are reranked.
+        """
+
+        keys = {}
+        for data in query_data:
+            keys.setdefault(self.cache_key(data), []).append(data)
+
+        entries = {}
+        key_list = list(keys)
+        for i in range(0, len(key_list), self.BATCH_SIZE):
+            query = ResolutionCache.select() \
+                                   .where(ResolutionCache.query.in_(key_list[i:i + self.BATCH_SIZE])) \
+                                   .where(ResolutionCache.collection_version == version)
+            for entry in query:
+                entries[entry.query] = entry
+
+        cached = []
+        missed = []
+        for key, datas in keys.items():
+            entry = entries.get(key)
+            if entry is not None and entry.threshold == match_threshold:
+                cached.extend((data, entry) for data in datas)
+            else:
+                missed.extend(datas)
+
+        self.cache_lookups += len(query_data)
+        self.cache_hits += len(cached)
+
+        return cached, missed
+
+    def store_cache(self, query_data, resolved_recordings, match_threshold, version):
+        """
+            Store the results of resolving the query data in the resolution cache, and remove the entries
+            made for older versions of the collection.
+        """
+
+        best = {}
+        for resolved in resolved_recordings:
+            if resolved["index"] not in best or resolved["confidence"] > best[resolved["index"]]["confidence"]:
+                best[resolved["index"]] = resolved
+
+        now = datetime.datetime.now()
+        entries = {}
+        for data in query_data:
+            resolved = best.get(data["index"])
+            entries[self.cache_key(data)] = {
+                "query": self.cache_key(data),
+                "recording_id": resolved["recording_id"] if resolved else None,
+                "confidence": resolved["confidence"] if resolved else 0.0,
+                "method": resolved["method"] if resolved else None,
+                "threshold": match_threshold,
+                "collection_version": version,
+                "last_updated": now
+            }
+
+        entries = list(entries.values())
+        with db.atomic():
+            ResolutionCache.delete().where(ResolutionCache.collection_version != version).execute()
+            for i in range(0, len(entries), self.BATCH_SIZE):
+                ResolutionCache.insert_many(entries[i:i + self.BATCH_SIZE]).on_conflict_replace().execute()
+
+    def cache_stats(self):
+        """ Return a line describing how many of the lookups were found in the resolution cache """
+        if not self.cache_lookups:
+            return "No lookups in the resolution cache."
+        return "%d of %d lookups found in the resolution cache (%d%%)." % \
+            (self.cache_hits, self.cache_lookups, 100 * self.cache_hits // self.cache_lookups)
+
+    def rerank(self, hits, query_data, match_threshold):
+        """
+            Given the hits returned by the fuzzy index for query_data, pick the best of the candidates
+            of each hit, using the release name, duration and recording MBID of the query (where given)
+            as secondary signals. Only the candidates whose fuzzy confidence meets match_threshold are
+            reranked and the picked candidate keeps its fuzzy confidence, so reranking never turns a
+            resolved query into an unresolved one. Otherwise the top hit is kept.
+        """
+
+        eligible = []
+        recording_ids = set()
+        for hit, data in zip(hits, query_data):
+            candidates = [candidate for candidate in hit["candidates"] if candidate[1] >= match_threshold]
+            eligible.append(candidates)
+            if len(candidates) > 1 and (data.get("release_name") or data.get("duration") or data.get("recording_mbid")):
+                recording_ids.update(recording_id for recording_id, _ in candidates)
+        if not recording_ids:
+            return hits
+
+        recording_ids = list(recording_ids)
+        details = {}
+        for i in range(0, len(recording_ids), self.BATCH_SIZE):
+            batch = recording_ids[i:i + self.BATCH_SIZE]
+            query = "SELECT id, release_name, duration, recording_mbid FROM recording WHERE id IN (%s)" % ",".join("?" * len(batch))
+            for row in db.execute_sql(query, batch):
+                details[row[0]] = row[1:]
+
+        for hit, data, candidates in zip(hits, query_data, eligible):
+            scored = [(self.rerank_score(data, confidence, *details[recording_id]), recording_id, confidence)
+                      for recording_id, confidence in candidates if recording_id in details]
+            if len(scored) > 1:
+                # on a tie, max keeps the first, best fuzzy match
+                _, hit["recording_id"], hit["confidence"] = max(scored, key=lambda candidate: candidate[0])
+
+        return hits
+
+    def rerank_score(self, data, confidence, release_name, duration, recording_mbid):
+        """
+            Return the score of a candidate for the query data, its fuzzy confidence adjusted for agreement
+            (or disagreement) of release name, duration and recording MBID.
+        """
+
+        score = confidence
+        if data.get("recording_mbid") and recording_mbid and \
+                str(data["recording_mbid"]).replace("-", "").lower() == str(recording_mbid).replace("-", "").lower():
+            score += self.MBID_BONUS
+
+        if data.get("release_name") and release_name and \
+                FuzzyIndex.encode_string(data["release_name"]) == FuzzyIndex.encode_string(release_name):
+            score += self.RELEASE_BONUS
+
+        if data.get("duration") and duration:
+            difference = abs(data["duration"] - duration)
+            if difference <= self.DURATION_MATCH:
+                score += self.DURATION_BONUS
+            elif difference > self.DURATION_MISMATCH:
+                score -= self.DURATION_PENALTY
+
+        return score
+
+    def load_mbid_index(self):
+        """
+            Load a recording MBID -> recording id map of the whole collection into memory, so that
+            resolve_recording_by_mbid doesn't need to query the DB. This is meant for long running
+            processes, like the resolver server. The map is loaded again if the collection changed.
+        """
+        with self.index_lock:
+            version = State.collection_version()
+            if self.mbid_index is not None and self.mbid_index_version == version:
+                return
+
+            mbid_index = {}
+            for recording_id, recording_mbid in db.execute_sql("SELECT id, recording_mbid FROM recording WHERE recording_mbid IS NOT NULL"):
+                mbid_index[recording_mbid] = recording_id
+            self.mbid_index = mbid_index
+            self.mbid_index_version = version
+
     def resolve_recording_by_mbid(self, artist_recording_data):
         """
             Given artist_recording_data, check to see if any of the recording MBIDs are
             in the local collection. If so, load the recording.id for it so it can be
-            skipped later.
+            skipped later. If the MBID index was loaded, it is used instead of the DB.
         """
 
         recording_index = {}
         for r in artist_recording_data:
-            if "recording_mbid" in r:
-                recording_index[r["recording_mbid"]] = r
+            if r.get("recording_mbid"):
+                recording_index.setdefault(str(r["recording_mbid"]), []).append(r)
 
-        recording_mbids = list(recording_index.keys())
-        recordings = Recording \
-            .select(Recording) \
-            .where(Recording.recording_mbid.in_(recording_mbids)) \
-            .dicts()
+        if self.mbid_index is not None:
+            self.load_mbid_index()
+            recording_ids = ((mbid, self.mbid_index[mbid]) for mbid in recording_index if mbid in self.mbid_index)
+        else:
+            recording_ids = self.lookup_recording_mbids(list(recording_index))
 
-        for recording in recordings:
-            if recording["recording_mbid"] in recording_index:
-                recording_index[recording["recording_mbid"]]["recording_id"] = recording["id"]
+        for recording_mbid, recording_id in recording_ids:
+            for r in recording_index[recording_mbid]:
+                r["recording_id"] = recording_id
 
         return artist_recording_data
 
+    def lookup_recording_mbids(self, recording_mbids):
+        """
+            Return (recording_mbid, recording_id) tuples for the given recording MBIDs that are in the collection.
+            The MBIDs are looked up in batches, to stay below SQLite's limit on the number of query variables.
+        """
+        for i in range(0, len(recording_mbids), self.BATCH_SIZE):
+            batch = recording_mbids[i:i + self.BATCH_SIZE]
+            query = "SELECT recording_mbid, id FROM recording WHERE recording_mbid IN (%s)" % ",".join("?" * len(batch))
+            yield from db.execute_sql(query, batch)
+
     def resolve_playlist(self, match_threshold, playlist):
         """
             Given a Troi playlist element, resolve tracks in the given playlist and update the playlist accordingly.
@@ -162,26 +413,29 @@ class ContentResolver:
         for rec in playlist.playlists[0].recordings:
             artist_recording_data.append({"artist_name": rec.artist.name,
                                           "recording_name": rec.name,
-                                          "recording_mbid": rec.mbid})
+                                          "recording_mbid": rec.mbid,
+                                          "release_name": rec.release.name if rec.release else None,
+                                          "duration": rec.duration})
 
         # See what we can resolve using MBIDs
         artist_recording_data = self.resolve_recording_by_mbid(artist_recording_data)
 
-        self.build_index()
-
         # Now see what we can resolve using fuzzy index
         hits = self.resolve_recordings(artist_recording_data, match_threshold)
         hit_index = {hit["index"]: hit for hit in hits}
 
-        # load local recordings according to fuzzy search results
-        recording_ids = [r["recording_id"] for r in hits]
-        local_recordings = Recording \
-            .select(Recording) \
-            .where(Recording.id.in_(recording_ids)) \
-            .dicts()
+        # load local recordings according to fuzzy search results, in batches and only the columns needed
+        recording_ids = list(set(r["recording_id"] for r in hits))
+        rec_index = {}
+        for i in range(0, len(recording_ids), self.BATCH_SIZE):
+            local_recordings = Recording \
+                .select(Recording.id, Recording.file_id, Recording.file_id_type, Recording.duration,
+                        Recording.artist_name, Recording.release_name, Recording.recording_name) \
+                .where(Recording.id.in_(recording_ids[i:i + self.BATCH_SIZE])) \
+                .dicts()
 
-        # Build index based on recording.id
-        rec_index = {r["id"]: r for r in local_recordings}
+            # Build index based on recording.id
+            rec_index.update((r["id"], r) for r in local_recordings)
 
         print("       %-40s %-40s %-40s" % ("RECORDING", "RELEASE", "ARTIST"))
         unresolved_recordings = []
@@ -210,9 +464,9 @@ class ContentResolver:
             print(bcolors.OKGREEN + ("%-5s" % hit["method"]) + bcolors.ENDC +
                   "  %-40s %-40s %-40s" % (artist_recording["recording_name"][:39], "",
                                            artist_recording["artist_name"][:39]))
-            print("       %-40s %-40s %-40s" % (local_recording["recording_name"][:39],
-                                                local_recording["release_name"][:39],
-                                                local_recording["artist_name"][:39]))
+            print("       %-40s %-40s %-40s" % ((local_recording["recording_name"] or "")[:39],
+                                                (local_recording["release_name"] or "")[:39],
+                                                (local_recording["artist_name"] or "")[:39]))
             resolved += 1
 
         if resolved == 0:
@@ -220,4 +474,5 @@ class ContentResolver:
             return []
 
         print(f'\n{resolved} recordings resolved, {failed} not resolved.')
+        print(self.cache_stats())
         return playlist
@@ -1,10 +1,12 @@
 from abc import abstractmethod
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
 import os
 import datetime
 from mutagen import MutagenError
 from pathlib import Path
+import stat
 import sys
 from time import time
 from types import SimpleNamespace
@@ -15,13 +17,20 @@ import peewee
 from tqdm import tqdm
 
 from lb_content_resolver.model.database import db, setup_db
-from lb_content_resolver.model.recording import Recording, RecordingMetadata, FileIdType
+from lb_content_resolver.model.recording import Recording, RecordingMetadata, RecordingLookup, FileIdType
 from lb_content_resolver.model.unresolved_recording import UnresolvedRecording
 from lb_content_resolver.model.tag import Tag, RecordingTag
 from lb_content_resolver.model.directory import Directory
+from lb_content_resolver.model.scan_cursor import ScanCursor
+from lb_content_resolver.model.state import State
+from lb_content_resolver.model.resolution_cache import ResolutionCache
+from lb_content_resolver.model.subsonic_album import SubsonicAlbum
+from lb_content_resolver.model.subsonic_artist import SubsonicArtist
+from lb_content_resolver.fuzzy_index_store import FuzzyIndexStore
 from lb_content_resolver.formats import mp3, m4a, flac, ogg_opus, ogg_vorbis, wma
 
-from lb_content_resolver.utils import existing_dirs
+from lb_content_resolver.utils import existing_dirs, background_iterator, scandir_walk, threaded_map
+from lb_content_resolver.watcher import InotifyWatcher, PollingWatcher, DEFAULT_POLL_INTERVAL
 
 SUPPORTED_FORMATS = (
     flac,
@@ -54,6 +63,21 @@ STATUSMSG = {
     Status.ERROR: 'error',
 }
 
+TABLES = (
+    Recording,
+    RecordingMetadata,
+    RecordingLookup,
+    Tag,
+    RecordingTag,
+    UnresolvedRecording,
+    Directory,
+    ScanCursor,
+    State,
+    ResolutionCache,
+    SubsonicAlbum,
+    SubsonicArtist,
+)
+
 StatusDetails = namedtuple('StatusDetails', ('recording_name', 'artist_name', 'release_name'))
 StatusData = namedtuple('StatusData', ('status', 'filenumber', 'details'))
 
@@ -64,13 +88,15 @@ def match_extensions(filepath, extensions):
 
 class ScanCounters:
     total = 0
-    status = {s: 0 for s in Status}
     files = 0
     audio_files = 0
     directories = 0
     updated_directories = 0
     skipped_directories = 0
 
+    def __init__(self):
+        self.status = {s: 0 for s in Status}
+
     def dry_run_stats(self):
         return ("Found {c.audio_files} audio file(s) among {c.files} file(s) in "
                 "{c.directories} directorie(s) ({c.skipped_directories} skipped)").format(c=self)
@@ -97,10 +123,27 @@ class Database:
     Keep a database with metadata for a collection of local music files.
     '''
 
+    # Number of rows to delete in one query, to stay below the SQLite variable limit
+    DELETE_BATCH_SIZE = 500
+
+    # The number of recordings inserted per statement. Older versions of SQLite allow only 999 variables per statement.
+    INSERT_BATCH_SIZE = 70
+
+    # Directories modified this long before the last cleanup are checked again by the next one
+    CLEANUP_CLOCK_MARGIN = datetime.timedelta(hours=1)
+
     def __init__(self, db_file):
         self.db_file = db_file
         self.fuzzy_index = None
         self.forced_scan = False
+        self.music_dirs = ()
+        self.workers = 1
+        self.executor = None
+        self.prune = False
+        self.directory_mtimes = {}
+        self.recording_mtimes = None
+        self.resume_position = None
+        self.renamed_ids = set()
 
     def create(self):
         """
@@ -112,14 +155,7 @@ class Database:
             os.makedirs(db_dir, exist_ok=True)
             setup_db(self.db_file)
             db.connect()
-            db.create_tables((
-                Recording,
-                RecordingMetadata,
-                Tag,
-                RecordingTag,
-                UnresolvedRecording,
-                Directory,
-            ))
+            db.create_tables(TABLES)
         except Exception as e:
             print("Failed to create db file %r: %s" % (self.db_file, e))
 
@@ -130,6 +166,8 @@ class Database:
         try:
             setup_db(self.db_file)
             db.connect()
+            # Add tables that were added to the code since the database was created
+            db.create_tables(TABLES)
         except peewee.OperationalError:
             print("Cannot open database index file: '%s'" % self.db_file)
             sys.exit(-1)
@@ -138,17 +176,29 @@ class Database:
         """ Close the db."""
         db.close()
 
-    def scan(self, music_dirs, chunksize=100, force=False):
+    def scan(self, music_dirs, chunksize=100, force=False, workers=1, stream=False, prune=False, prefetch=False):
         """
-            Scan music directories and add tracks to sqlite.
+            Scan music directories and add tracks to sqlite. If workers is greater than 1,
+            the metadata of the files in each chunk is read by a pool of worker processes.
+
+            Normally the directories are walked once to count the files before scanning.
+            If stream is True, this dry run is skipped: the directories are walked in
+            a background thread and the files are processed as they are found.
+
+            If prune is True, the sub directories of unchanged directories are not visited at all.
+            This is much faster, but changes made deeper inside an unchanged directory are missed.
+
+            If prefetch is True, the modification times of all known files are loaded at once, so
+            that unchanged files can be detected without querying the database for each chunk.
         """
         if not music_dirs:
             print("No directory to scan")
             return
 
         self.forced_scan = force
+        self.prune = prune
 
-        self.music_dirs = tuple(sorted(set(existing_dirs(music_dirs))))
+        self.music_dirs = tuple(sorted(set(os.path.realpath(d) for d in existing_dirs(music_dirs))))
         if not self.music_dirs:
             print("No valid directories to scan")
             return
@@ -157,94 +207,258 @@ class Database:
 
         # Keep some stats
         self.counters = ScanCounters()
-        self.skip_dirs = set()
+        self.renamed_ids = set()
+
+        # If the last scan of these directories was interrupted, continue where it stopped.
+        self.resume_position = None
+        if not force:
+            cursor = ScanCursor.get_or_none(ScanCursor.music_dirs == self.music_dirs_key())
+            if cursor is not None and cursor.top_dir in self.music_dirs:
+                print("Resuming interrupted scan after %s" % cursor.dir_path)
+                self.resume_position = self.walk_position(self.music_dirs.index(cursor.top_dir), cursor.dir_path)
+
+        if prefetch and not force:
+            self.recording_mtimes = self.load_recording_mtimes()
 
-        print("Check collection size...")
-        print("Counting candidates in %s ..." % ", ".join(self.music_dirs))
-        self.traverse(dry_run=True)
-        print(self.counters.dry_run_stats())
+        if not stream:
+            print("Check collection size...")
+            print("Counting candidates in %s ..." % ", ".join(self.music_dirs))
+            self.traverse(dry_run=True)
+            print(self.counters.dry_run_stats())
 
-        with tqdm(total=self.counters.audio_files) as self.progress_bar:
-            print("Scanning ...")
-            self.traverse()
+        self.workers = workers
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
 
+        try:
+            with tqdm(total=self.counters.audio_files) as self.progress_bar:
+                print("Scanning ...")
+                self.traverse(stream=stream)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+        self.recording_mtimes = None
+        FuzzyIndexStore().update(self.renamed_ids)
         self.close()
+        if stream:
+            print(self.counters.dry_run_stats())
         print(self.counters.stats())
 
-    def traverse(self, dry_run=False):
+    def music_dirs_key(self):
+        """ Return the key of the current set of music directories in the scan_cursor table """
+        return "\n".join(self.music_dirs)
+
+    def walk_position(self, top_index, dir_path):
         """
-            This function searches for audio files and descends into sub directories
+            Return a value for a directory that sorts in the order in which walk visits directories.
+            top_index is the index of the music directory that dir_path was found in.
         """
-        seen = set()
-        changed_dirs = []
-        if dry_run:
-            self.counters.directories = 0
-            self.counters.audio_files = 0
-        filenumber = 0
-        self.chunk = dict()
+        rel_path = os.path.relpath(dir_path, self.music_dirs[top_index])
+        if rel_path == os.curdir:
+            return (top_index, ())
+        return (top_index, tuple(rel_path.split(os.sep)))
 
-        for topdir in self.music_dirs:
-            if dry_run:
+    def walk(self, count=False):
+        """
+            Walk the music directories and yield a (position, dir_path, dir_mtime, files) tuple for each
+            directory that needs to be scanned, where files is a list of (file_path, mtime timestamp)
+            tuples. dir_mtime is False if the directory didn't change since the last scan. position
+            is the index of the music directory and the path of the directory relative to it.
+            If count is True, update the directory and file counters.
+
+            The directories are visited depth first in sorted order. When resuming a scan, the files in
+            directories up to the resume position are skipped, since they were scanned already.
+
+            The file type and modification time are taken from the directory entries where possible,
+            symlinks are only resolved for entries that actually are symlinks.
+        """
+        seen = set()
+        for top_index, topdir in enumerate(self.music_dirs):
+            if count:
                 self.counters.directories += 1
 
-            for root, dirs, files in os.walk(topdir):
-                root = os.path.realpath(root)
+            for root, dirs, entries in scandir_walk(topdir):
                 dir_mtime = self.dir_has_changed(root)
 
-                if dry_run:
+                if count:
                     self.counters.directories += len(dirs)
-                    if not self.forced_scan and dir_mtime is False:
-                        self.skip_dirs.add(root)
+                    self.counters.files += len(entries)
 
-                if not self.forced_scan and root in self.skip_dirs:
-                    self.counters.skipped_directories += 1
+                if not self.forced_scan and dir_mtime is False:
+                    if count:
+                        self.counters.skipped_directories += 1
+                    if self.prune:
+                        dirs[:] = []
                     continue
 
-                for name in files:
-                    file_path = os.path.realpath(os.path.join(root, name))
-                    if file_path in seen:
+                position = self.walk_position(top_index, root)
+                if self.resume_position is not None and position <= self.resume_position:
+                    yield position, root, dir_mtime, []
+                    continue
+
+                yield position, root, dir_mtime, self.audio_files(entries, seen)
+
+    def audio_files(self, entries, seen):
+        """
+            Given the directory entries of the files in a directory, return a list of (file_path, mtime timestamp)
+            tuples for the audio files among them. Files already in the seen set are skipped, new ones are
+            added to it.
+        """
+        files = []
+        for entry in entries:
+            if not match_extensions(entry.name, ALL_EXTENSIONS):
+                continue
+            try:
+                if entry.is_symlink():
+                    file_path = os.path.realpath(entry.path)
+                    stats = os.stat(file_path)
+                    if not stat.S_ISREG(stats.st_mode) or not match_extensions(file_path, ALL_EXTENSIONS):
                         continue
-                    seen.add(file_path)
-                    if os.path.isfile(file_path) and match_extensions(file_path, ALL_EXTENSIONS):
-                        filenumber += 1
-                        if not dry_run:
-                            self.add(file_path, filenumber)
-                            if filenumber % self.chunksize == 0:
-                                self.process_chunk()
-
-                if not dry_run and dir_mtime is not False:
-                    # add changed directory info after it was explored
-                    changed_dirs.append({'dir_path': root, 'mtime': dir_mtime})
+                else:
+                    file_path = entry.path
+                    stats = entry.stat(follow_symlinks=False)
+                timestamp = stats[8]
+            except OSError:
+                # let add() report the problem
+                file_path = entry.path
+                timestamp = None
+
+            if file_path in seen:
+                continue
+            seen.add(file_path)
+            files.append((file_path, timestamp))
+
+        return files
+
+    def traverse(self, dry_run=False, stream=False):
+        """
+            This function searches for audio files and descends into sub directories.
+
+            In dry run mode the audio files are only counted. In stream mode the directories
+            are walked in a background thread while the audio files are counted and processed.
+
+            After each chunk the scan is checkpointed: the directories whose subtrees were completely
+            scanned are stored along with the position of the scan, so that an interrupted scan
+            can be resumed.
+        """
+        count = dry_run or stream
+        if count:
+            self.counters.directories = 0
+            self.counters.skipped_directories = 0
+            self.counters.files = 0
+            self.counters.audio_files = 0
+
+        # Load all known directories at once, instead of querying them one by one
+        self.directory_mtimes = self.load_directory_mtimes()
+
+        directories = self.walk(count=count)
+        if stream:
+            directories = background_iterator(directories)
+
+        # changed directories whose subtrees are still being scanned and those that are done
+        open_dirs = []
+        self.completed_dirs = []
+        self.scanned_dir = None
+        filenumber = 0
+        self.chunk = dict()
+
+        for position, root, dir_mtime, files in directories:
+            if dry_run:
+                filenumber += len(files)
+                continue
+
+            # Directories are visited depth first, so once we get to a directory outside of an
+            # open directory, everything below that open directory has been scanned.
+            while open_dirs and not root.startswith(os.path.join(open_dirs[-1]['dir_path'], "")):
+                self.completed_dirs.append(open_dirs.pop())
+            if dir_mtime is not False:
+                open_dirs.append({'dir_path': root, 'mtime': dir_mtime})
+
+            if stream:
+                # grow the progress bar as new files are found
+                self.counters.audio_files += len(files)
+                self.progress_bar.total = self.counters.audio_files
+                self.progress_bar.refresh()
+
+            for file_path, timestamp in files:
+                filenumber += 1
+                self.add(file_path, filenumber, timestamp)
+                if filenumber % self.chunksize == 0:
+                    self.process_chunk()
+                    self.checkpoint()
+
+            self.scanned_dir = (position[0], root)
 
         if not dry_run:
             self.process_chunk()
-            # update directory table after everything was processed.
-            # It reduces the risk of issues in case of interruption or crash
-            if changed_dirs:
-                with db.atomic():
-                    Directory.insert_many(changed_dirs).on_conflict_replace().execute()
-                    self.counters.updated_directories = len(changed_dirs)
+            self.completed_dirs.extend(reversed(open_dirs))
+            self.checkpoint()
+            # The scan is complete, no need to resume it later
+            ScanCursor.delete().where(ScanCursor.music_dirs == self.music_dirs_key()).execute()
         else:
-            self.counters.files = len(seen)
             self.counters.audio_files = filenumber
 
+    def checkpoint(self):
+        """
+            Store the directories that were completely scanned and the position of the scan. Must be called
+            after the chunk was processed, so that all files up to this point are in the database.
+        """
+        if self.forced_scan:
+            # A forced scan doesn't skip anything, so it doesn't resume either
+            self.scanned_dir = None
+
+        with db.atomic():
+            if self.completed_dirs:
+                Directory.insert_many(self.completed_dirs).on_conflict_replace().execute()
+                self.counters.updated_directories += len(self.completed_dirs)
+                self.completed_dirs = []
+
+            if self.scanned_dir is not None:
+                top_index, dir_path = self.scanned_dir
+                ScanCursor.replace(music_dirs=self.music_dirs_key(),
+                                   top_dir=self.music_dirs[top_index],
+                                   dir_path=dir_path,
+                                   last_updated=datetime.datetime.now()).execute()
+                self.scanned_dir = None
+
+    def load_directory_mtimes(self):
+        """
+            Return a dict that maps the path of all directories in the database to their modification time.
+        """
+        return dict(Directory.select(Directory.dir_path, Directory.mtime).tuples())
+
+    def load_recording_mtimes(self):
+        """
+            Return a dict that maps the path of all files in the database to a (timestamp, details) tuple: their
+            modification time as a raw timestamp, as stored by the database, and the StatusDetails with their names.
+        """
+        cursor = db.execute_sql("""SELECT file_id, mtime, recording_name, artist_name, release_name
+                                     FROM recording
+                                    WHERE file_id_type = ?""", (FileIdType.FILE_PATH.value,))
+        return {file_id: (mtime, StatusDetails(recording_name=recording_name, artist_name=artist_name, release_name=release_name))
+                for file_id, mtime, recording_name, artist_name, release_name in cursor}
+
     def dir_has_changed(self, dir_path):
         """ Returns directory mtime if it changed since last run, or False"""
         try:
             stats = os.stat(dir_path)
             mtime = datetime.datetime.fromtimestamp(stats[8])
-            directory = Directory.get_or_none(Directory.dir_path == dir_path)
-            if directory is None or directory.mtime != mtime:
+            if self.directory_mtimes.get(dir_path) != mtime:
                 return mtime
         except Exception as e:
             print("Can't stat dir %r: %s" % (dir_path, e))
         return False
 
-    def read_metadata(self, file_path, mtime):
+    @staticmethod
+    def read_metadata(file_path, mtime):
         """
             Read metadata from audio file
             On error, returns None, error msg
             On success, returns metadata dict, StatusDetails
+
+            This is a static method so that it can be run in worker processes.
         """
         data = None
         try:
@@ -254,15 +468,15 @@ class Database:
             mdata = handler.get_metadata(tags)
             if mdata is not None:
                 data = {
-                    "artist_mbid": self.convert_to_uuid(mdata["artist_mbid"]),
+                    "artist_mbid": Database.convert_to_uuid(mdata["artist_mbid"]),
                     "artist_name": mdata["artist_name"],
                     "disc_num": mdata["disc_num"],
                     "file_id": file_path,
                     "file_id_type": FileIdType.FILE_PATH,
                     "mtime": mtime,
-                    "recording_mbid": self.convert_to_uuid(mdata["recording_mbid"]),
+                    "recording_mbid": Database.convert_to_uuid(mdata["recording_mbid"]),
                     "recording_name": mdata["recording_name"],
-                    "release_mbid": self.convert_to_uuid(mdata["release_mbid"]),
+                    "release_mbid": Database.convert_to_uuid(mdata["release_mbid"]),
                     "release_name": mdata["release_name"],
                     "track_num": mdata["track_num"],
                 }
@@ -283,9 +497,20 @@ class Database:
         """
             For all items in the chunk, read metadata and yield resulting data (or None),
             and matching details (status, filenumber, and details (or error string))
+
+            If a process pool is available the files are parsed in parallel, but the results
+            are still yielded in chunk order.
         """
-        for file_path, chunkitemdata in chunk.items():
-            data, details = self.read_metadata(file_path, chunkitemdata.mtime)
+        file_paths = tuple(chunk)
+        mtimes = tuple(chunk[file_path].mtime for file_path in file_paths)
+        if self.executor is not None:
+            chunksize = max(1, len(file_paths) // (self.workers * 4))
+            results = self.executor.map(self.read_metadata, file_paths, mtimes, chunksize=chunksize)
+        else:
+            results = map(self.read_metadata, file_paths, mtimes)
+
+        for file_path, (data, details) in zip(file_paths, results):
+            chunkitemdata = chunk[file_path]
             if data is not None:
                 status = Status.UPDATE if chunkitemdata.is_update else Status.ADD
             else:
@@ -307,12 +532,47 @@ class Database:
                 datas.append(data)
 
         if datas:
-            with db.atomic():
-                result = Recording.insert_many(datas).on_conflict_replace().execute()
+            self.add_recordings(datas)
 
         return statuses
 
-    def convert_to_uuid(self, value):
+    def add_recordings(self, datas):
+        """
+            Add the given recording rows for files to the database, or replace the recordings that already exist.
+            Existing recordings keep their id, so that the metadata and tags referring to them stay valid. The ids
+            of the recordings whose names changed are added to renamed_ids, to update them in the fuzzy index.
+        """
+        file_ids = [data["file_id"] for data in datas]
+        existing = {}
+        with db.atomic():
+            for i in range(0, len(file_ids), self.DELETE_BATCH_SIZE):
+                query = Recording.select(Recording.file_id, Recording.id, Recording.artist_name, Recording.recording_name) \
+                                 .where(Recording.file_id_type == FileIdType.FILE_PATH) \
+                                 .where(Recording.file_id.in_(file_ids[i:i + self.DELETE_BATCH_SIZE])) \
+                                 .tuples()
+                for file_id, recording_id, artist_name, recording_name in query:
+                    existing[file_id] = (recording_id, artist_name, recording_name)
+
+            new_datas = []
+            updated_datas = []
+            for data in datas:
+                if data["file_id"] not in existing:
+                    new_datas.append(data)
+                    continue
+
+                recording_id, artist_name, recording_name = existing[data["file_id"]]
+                if artist_name != data["artist_name"] or recording_name != data["recording_name"]:
+                    self.renamed_ids.add(recording_id)
+                updated_datas.append(dict(data, id=recording_id))
+
+            # insert_many takes the columns from the first row, so the rows with and without an id are inserted separately
+            for rows in (new_datas, updated_datas):
+                for batch in peewee.chunked(rows, self.INSERT_BATCH_SIZE):
+                    Recording.insert_many(batch).on_conflict_replace().execute()
+            State.bump_collection_version()
+
+    @staticmethod
+    def convert_to_uuid(value):
         """
             Convert the given string to a UUID or return None if not a valid UUID.
         """
@@ -347,11 +607,14 @@ class Database:
         self.counters.status[statusdata.status] += 1
         self.progress_bar.write(self.fmtdetails(statusdata))
 
-    def add(self, file_path, audio_file_count):
+    def add(self, file_path, audio_file_count, timestamp=None):
         """
             Given a file, check to see if we already have it and if we do,
             if it has changed since the last time we read it. If it is new
             or has been changed, update in the DB.
+
+            If the modification timestamp of the file is already known, pass it
+            in timestamp to avoid another stat call.
         """
 
         # update the progress bar
@@ -362,9 +625,10 @@ class Database:
         # Check to see if the file in question has changed since the last time
         # we looked at it.
         try:
-            stats = os.stat(file_path)
-            mtime = datetime.datetime.fromtimestamp(stats[8])
-            chunkitemdata = SimpleNamespace(mtime=mtime, filenumber=audio_file_count, is_update=False)
+            if timestamp is None:
+                timestamp = os.stat(file_path)[8]
+            mtime = datetime.datetime.fromtimestamp(timestamp)
+            chunkitemdata = SimpleNamespace(mtime=mtime, timestamp=timestamp, filenumber=audio_file_count, is_update=False)
             self.chunk[file_path] = chunkitemdata
         except Exception as e:
             details = "Can't stat file %r: %s" % (file_path, e)
@@ -378,7 +642,19 @@ class Database:
         statuses = list()
 
         # find existing recordings and compare modification time
-        if not self.forced_scan:
+        if not self.forced_scan and self.recording_mtimes is not None:
+            for file_path, chunkitemdata in tuple(self.chunk.items()):
+                known = self.recording_mtimes.get(file_path)
+                if known is None:
+                    continue
+                timestamp, details = known
+                if timestamp == chunkitemdata.timestamp:
+                    # file didn't change since last time, skip it
+                    statuses.append(StatusData(Status.NOCHANGE, chunkitemdata.filenumber, details))
+                    del self.chunk[file_path]
+                else:
+                    chunkitemdata.is_update = True
+        elif not self.forced_scan:
             for recording in Recording.select().where(Recording.file_id.in_(tuple(self.chunk))):
                 if recording.mtime == self.chunk[recording.file_id].mtime:
                     # file didn't change since last time, skip it
@@ -405,43 +681,234 @@ class Database:
         for statusdata in sorted(statuses, key=lambda s: s.filenumber):
             self.update_status(statusdata)
 
-    def database_cleanup(self, dry_run):
+    def watch(self, music_dirs, chunksize=100, workers=1, poll_interval=None):
+        """
+            Scan the music directories and then keep watching them for changes, updating the
+            database for the directories that changed. inotify is used if it is available,
+            otherwise (or if poll_interval is given) the directories are checked for changes
+            every poll_interval seconds.
+        """
+        self.scan(music_dirs, chunksize=chunksize, workers=workers, stream=True)
+        if not self.music_dirs:
+            return
+
+        watcher = None
+        if poll_interval is None:
+            watcher = InotifyWatcher.create(self, self.music_dirs)
+            if watcher is None:
+                print("inotify is not available, falling back to polling.")
+
+        if watcher is None:
+            watcher = PollingWatcher(self, self.music_dirs, poll_interval or DEFAULT_POLL_INTERVAL)
+
+        print("Watching %s for changes. Press ctrl+c to stop." % ", ".join(self.music_dirs))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def update_directories(self, dir_paths):
         """
-        Look for missing files and directory entries and remove them from the DB.
+            Bring the given directories up to date: Add new files and update changed files, remove the files
+            that were deleted and remove directories that no longer exist along with all files below them.
+            Sub directories are not visited.
+        """
+        self.counters = ScanCounters()
+        self.renamed_ids = set()
+        self.chunk = dict()
+
+        seen = set()
+        files = []
+        changed_dirs = []
+        removed_files = []
+        removed_dirs = []
+        for dir_path in sorted(set(dir_paths)):
+            try:
+                dir_mtime = datetime.datetime.fromtimestamp(os.stat(dir_path)[8])
+                with os.scandir(dir_path) as it:
+                    entries = [entry for entry in it if not entry.is_dir(follow_symlinks=False)]
+            except FileNotFoundError:
+                removed_dirs.append(dir_path)
+                continue
+            except OSError as e:
+                print("Can't read dir %r: %s" % (dir_path, e))
+                continue
+
+            dir_files = self.audio_files(entries, seen)
+            found = set(file_path for file_path, _ in dir_files)
+            removed_files.extend(file_path for file_path in self.files_in_directory(dir_path) if file_path not in found)
+            files.extend(dir_files)
+            changed_dirs.append({'dir_path': dir_path, 'mtime': dir_mtime})
+
+        self.counters.audio_files = len(files)
+        with tqdm(total=len(files), disable=True) as self.progress_bar:
+            for filenumber, (file_path, timestamp) in enumerate(files, 1):
+                self.add(file_path, filenumber, timestamp)
+                if filenumber % self.chunksize == 0:
+                    self.process_chunk()
+            self.process_chunk()
+
+        self.remove_files(removed_files)
+        self.remove_directories(removed_dirs)
+        if changed_dirs:
+            with db.atomic():
+                Directory.insert_many(changed_dirs).on_conflict_replace().execute()
+
+        # the watcher keeps running, so don't hold it up with a refit of the index
+        FuzzyIndexStore().update(self.renamed_ids, background_refit=True)
+
+    def files_in_directory(self, dir_path, recursive=False):
+        """
+            Return the paths of the files in the database that are in the given directory,
+            or anywhere below it if recursive is True.
+        """
+        prefix = os.path.join(dir_path, "")
+        # all paths starting with prefix sort between prefix and prefix with its last character incremented
+        query = Recording.select(Recording.file_id) \
+                         .where(Recording.file_id_type == FileIdType.FILE_PATH) \
+                         .where(Recording.file_id >= prefix) \
+                         .where(Recording.file_id < prefix[:-1] + chr(ord(prefix[-1]) + 1)) \
+                         .tuples()
+        file_paths = [row[0] for row in query]
+        if recursive:
+            return file_paths
+        return [file_path for file_path in file_paths if os.path.dirname(file_path) == dir_path]
+
+    def remove_files(self, file_paths):
+        """
+            Remove the recordings for the given file paths from the database.
+        """
+        file_paths = tuple(file_paths)
+        ids = []
+        for i in range(0, len(file_paths), self.DELETE_BATCH_SIZE):
+            query = Recording.select(Recording.id) \
+                             .where(Recording.file_id_type == FileIdType.FILE_PATH) \
+                             .where(Recording.file_id.in_(file_paths[i:i + self.DELETE_BATCH_SIZE])) \
+                             .tuples()
+            ids.extend(row[0] for row in query)
+
+        for file_path in sorted(file_paths):
+            print("RM %s" % file_path)
+
+        return self.remove_recordings(ids)
+
+    def remove_recordings(self, ids):
+        """
+            Remove the recordings with the given ids, along with their metadata and tags, from the database.
+            Returns the number of recordings removed.
+        """
+        ids = tuple(ids)
+        if not ids:
+            return 0
+
+        count = 0
+        with db.atomic():
+            State.bump_collection_version()
+            for i in range(0, len(ids), self.DELETE_BATCH_SIZE):
+                batch = ids[i:i + self.DELETE_BATCH_SIZE]
+                RecordingTag.delete().where(RecordingTag.recording.in_(batch)).execute()
+                RecordingMetadata.delete().where(RecordingMetadata.recording.in_(batch)).execute()
+                RecordingLookup.delete().where(RecordingLookup.recording.in_(batch)).execute()
+                count += Recording.delete().where(Recording.id.in_(batch)).execute()
+
+        return count
+
+    def remove_directories(self, dir_paths):
+        """
+            Remove the given directories and all directories and recordings below them from the database.
+        """
+        for dir_path in dir_paths:
+            self.remove_files(self.files_in_directory(dir_path, recursive=True))
+            prefix = os.path.join(dir_path, "")
+            with db.atomic():
+                print("RM %s" % dir_path)
+                Directory.delete().where((Directory.dir_path == dir_path) | (
+                    (Directory.dir_path >= prefix) & (Directory.dir_path < prefix[:-1] + chr(ord(prefix[-1]) + 1)))).execute()
+
+    def database_cleanup(self, dry_run, concurrency=8, changed_only=False):
+        """
+        Look for missing files and directory entries and remove them from the DB. The file system is
+        checked by concurrency threads in parallel.
+
+        If changed_only is True, only the files in directories that were modified since they were
+        scanned or since the last cleanup are checked, since deleting a file modifies its directory.
         """
         PathId = namedtuple('PathId', ('path', 'id'))
 
-        recordings = tuple(
-            PathId(r.file_id, r.id)
-            for r in Recording.select(Recording.file_id, Recording.id).where(Recording.file_id_type == FileIdType.FILE_PATH)
-            if not os.path.isfile(r.file_id))
-        directories = tuple(
-            PathId(d.dir_path, d.id) for d in Directory.select(Directory.dir_path, Directory.id) if not os.path.isdir(d.dir_path))
+        started = datetime.datetime.now()
+        last_cleanup = State.get_value("last_cleanup")
+        if changed_only and last_cleanup is not None:
+            # allow for clocks of file servers that are a bit off
+            check_after = datetime.datetime.fromisoformat(last_cleanup) - self.CLEANUP_CLOCK_MARGIN
+        else:
+            check_after = None
+            changed_only = False
+
+        directories = []
+        unchanged_dirs = set()
+        known_dirs = tuple(Directory.select(Directory.dir_path, Directory.id, Directory.mtime).tuples())
+        dir_mtimes = threaded_map(self.directory_mtime, (d[0] for d in known_dirs), concurrency)
+        for (dir_path, dir_id, mtime), current_mtime in zip(known_dirs, dir_mtimes):
+            if current_mtime is None:
+                print("RM %s" % dir_path)
+                directories.append(PathId(dir_path, dir_id))
+            elif changed_only and current_mtime == mtime and current_mtime < check_after:
+                unchanged_dirs.add(dir_path)
+        removed_dirs = set(d.path for d in directories)
+
+        recordings = []
+        file_paths = []
+        query = Recording.select(Recording.file_id, Recording.id).where(Recording.file_id_type == FileIdType.FILE_PATH).tuples()
+        for file_path, recording_id in query:
+            dir_path = os.path.dirname(file_path)
+            if dir_path in removed_dirs:
+                print("RM %s" % file_path)
+                recordings.append(PathId(file_path, recording_id))
+            elif not changed_only or dir_path not in unchanged_dirs:
+                file_paths.append(PathId(file_path, recording_id))
+
+        print("Checking %d files..." % len(file_paths))
+        for recording, exists in zip(file_paths, threaded_map(os.path.isfile, (r.path for r in file_paths), concurrency)):
+            if not exists:
+                print("RM %s" % recording.path)
+                recordings.append(recording)
 
         if not recordings and not directories:
             print("No cleanup needed.")
+            if not dry_run:
+                State.set_value("last_cleanup", started.isoformat())
             return
 
-        for elem in sorted(recordings + directories):
-            print("RM %s" % elem.path)
-
         print("%d recordings and %d directory entries to remove from database" % (len(recordings), len(directories)))
         if not dry_run:
             with db.atomic():
-                ids = tuple(r.id for r in recordings)
-                query = Recording.delete().where(Recording.id.in_(ids))
-                count = query.execute()
+                count = self.remove_recordings(r.id for r in recordings)
                 print("%d recordings removed" % count)
                 ids = tuple(d.id for d in directories)
-                query = Directory.delete().where(Directory.id.in_(ids))
-                count = query.execute()
+                count = 0
+                for i in range(0, len(ids), self.DELETE_BATCH_SIZE):
+                    count += Directory.delete().where(Directory.id.in_(ids[i:i + self.DELETE_BATCH_SIZE])).execute()
                 print("%d directory entries removed" % count)
+                State.set_value("last_cleanup", started.isoformat())
+            FuzzyIndexStore().update()
             print("Vacuuming database...")
             db.execute_sql('VACUUM')
             print("Done.")
         else:
             print("Use command cleanup --remove to actually remove those.")
 
+    @staticmethod
+    def directory_mtime(dir_path):
+        """ Return the modification time of a directory, or None if it doesn't exist. """
+        try:
+            stats = os.stat(dir_path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(stats.st_mode):
+            return None
+        return datetime.datetime.fromtimestamp(stats[8])
+
     def metadata_sanity_check(self, include_subsonic=False):
         """
         Run a sanity check on the DB to see if data is missing that is required for LB Radio to work.
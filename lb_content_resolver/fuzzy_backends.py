@@ -0,0 +1,136 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import nmslib
+except ImportError:
+    nmslib = None
+
+
+class SearchBackend(ABC):
+    '''
+       Finds the rows of a tf-idf matrix with the highest dot product with each row of a query matrix.
+       Since the rows are normalized, the dot product is the cosine similarity, which is used as the
+       confidence of a match. Subclasses implement search().
+    '''
+
+    name = None
+
+    def __init__(self, matrix, ids):
+        """ matrix is the csr tf-idf matrix of the index, ids the recording id of each row """
+        self.matrix = matrix
+        self.ids = ids
+
+    @classmethod
+    def available(cls):
+        return True
+
+    @abstractmethod
+    def search(self, query_matrix, k, num_threads):
+        """
+            Return a list with a (recording ids, similarities) tuple of arrays for each row of the query matrix,
+            holding at most k matches with a similarity above 0, best match first.
+        """
+
+
+class NmslibBackend(SearchBackend):
+    '''
+       Search with an nmslib sparse inverted index.
+    '''
+
+    name = "nmslib"
+
+    def __init__(self, matrix, ids):
+        SearchBackend.__init__(self, matrix, ids)
+        self.index = nmslib.init(method='simple_invindx', space='negdotprod_sparse_fast', data_type=nmslib.DataType.SPARSE_VECTOR)
+        self.index.addDataPointBatch(matrix, ids)
+        self.index.createIndex()
+
+    @classmethod
+    def available(cls):
+        return nmslib is not None
+
+    def search(self, query_matrix, k, num_threads):
+        results = []
+        for ids, distances in self.index.knnQueryBatch(query_matrix, k=k, num_threads=num_threads):
+            # nmslib returns the negative dot product as distance
+            results.append((ids.astype(np.int64), np.abs(distances)))
+        return results
+
+
+class SparseMatrixBackend(SearchBackend):
+    '''
+       Search by multiplying the query matrix with the transposed index matrix using SciPy and picking
+       the top k of each row with argpartition. This is an exact search, like the nmslib inverted
+       index, but needs nothing beyond numpy and scipy. The queries are multiplied in chunks, so that
+       the memory used for the products stays bounded.
+    '''
+
+    name = "scipy"
+
+    # The maximum number of (non zero) products of a chunk of queries
+    MAX_CHUNK_PRODUCTS = 1 << 24
+
+    def __init__(self, matrix, ids):
+        SearchBackend.__init__(self, matrix, ids)
+        self.matrix_t = matrix.T.tocsr()
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def search(self, query_matrix, k, num_threads):
+        # Estimate the number of products per query from the number of rows that share each trigram
+        rows_per_term = np.diff(self.matrix_t.indptr)
+        products = max(1, int(rows_per_term[query_matrix.indices].sum() / max(query_matrix.shape[0], 1)))
+        chunk_size = max(1, self.MAX_CHUNK_PRODUCTS // products)
+        chunks = [query_matrix[i:i + chunk_size] for i in range(0, query_matrix.shape[0], chunk_size)]
+
+        if num_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                chunk_results = list(executor.map(lambda chunk: self.search_chunk(chunk, k), chunks))
+        else:
+            chunk_results = [self.search_chunk(chunk, k) for chunk in chunks]
+
+        return [result for results in chunk_results for result in results]
+
+    def search_chunk(self, query_matrix, k):
+        scores = (query_matrix @ self.matrix_t).tocsr()
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            data = scores.data[start:end]
+            indices = scores.indices[start:end]
+            if len(data) > k:
+                top = np.argpartition(-data, k - 1)[:k]
+                data, indices = data[top], indices[top]
+            order = np.argsort(-data, kind="stable")
+            results.append((self.ids[indices[order]], data[order]))
+        return results
+
+
+BACKENDS = {backend.name: backend for backend in (NmslibBackend, SparseMatrixBackend)}
+
+# The backend used if none is given: nmslib if it is installed, otherwise scipy.
+default_backend = None
+
+
+def set_default_backend(name):
+    """ Set the backend used by fuzzy indexes that don't ask for a specific one. None picks the best available. """
+    global default_backend
+    if name is not None and name not in BACKENDS:
+        raise ValueError("Unknown fuzzy index backend '%s', use one of %s" % (name, ", ".join(BACKENDS)))
+    default_backend = name
+
+
+def get_backend(name=None):
+    """ Return the backend class with the given name, or the default backend if name is None """
+    name = name or default_backend
+    if name is None:
+        return NmslibBackend if NmslibBackend.available() else SparseMatrixBackend
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown fuzzy index backend '%s', use one of %s" % (name, ", ".join(BACKENDS)))
+    backend = BACKENDS[name]
+    if not backend.available():
+        raise ValueError("The fuzzy index backend '%s' is not installed" % name)
+    return backend
@@ -1,80 +1,404 @@
 import os
 import datetime
-from math import fabs
+from functools import lru_cache
+import json
 from time import time
 import re
 import sys
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-import nmslib
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
 from unidecode import unidecode
 
+from lb_content_resolver.fuzzy_backends import get_backend, SparseMatrixBackend
+
+# Bump this if the data saved to disk changes
+INDEX_FORMAT = 3
+INDEX_ARRAYS = ("vocabulary", "idf", "data", "indices", "indptr", "ids",
+                "artists", "row_artists", "artist_data", "artist_indices", "artist_indptr")
+
+
+# Artist names repeat a lot, in the collection and in the queries, so keep the most recent encodings around
+ENCODE_CACHE_SIZE = 65536
+
+NON_WORD_CHARACTERS = re.compile(r'\W+')
+
 
 def ngrams(string, n=3):
     """ Take a lookup string (noise removed, lower case, etc) and turn into a list of trigrams """
 
     string = ' ' + string + ' '  # pad names for ngrams...
-    ngrams = zip(*[string[i:] for i in range(n)])
-    return [''.join(ngram) for ngram in ngrams]
+    return [string[i:i + n] for i in range(len(string) - n + 1)]
+
+
+@lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def encode_string(text):
+    """ Turn a name into a lookup string: Remove everything but letters and digits, lower case and transliterate to ASCII """
+
+    text = NON_WORD_CHARACTERS.sub('', text).lower()
+    if text.isascii():
+        return text
+    return unidecode(text)
+
+
+def encode_strings(texts):
+    """ Encode a list of names, encoding each distinct name only once """
+
+    encoded = {text: encode_string(text) for text in set(texts)}
+    return [encoded[text] for text in texts]
+
+
+def count_trigrams(lookup_strings):
+    """
+        Count the trigrams of a list of lookup strings, the same way a vectorizer using ngrams() does, but
+        for all strings at once: the lookup strings are ASCII, so each trigram can be turned into a number
+        made of its three bytes. Returns a sparse matrix with the counts of each trigram per lookup string
+        and the sorted vocabulary, a list of the trigrams of the matrix columns.
+    """
+
+    text = "".join(' ' + string + ' ' for string in lookup_strings).encode("ascii", "replace")
+    chars = np.frombuffer(text, dtype=np.uint8).astype(np.int32)
+    codes = (chars[:-2] << 16) | (chars[1:-1] << 8) | chars[2:]
+
+    # A padded string of length n + 2 has n trigrams, drop the trigrams that span two strings
+    lengths = np.fromiter(map(len, lookup_strings), dtype=np.int64, count=len(lookup_strings))
+    indptr = np.zeros(len(lookup_strings) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    starts = indptr[:-1] + 2 * np.arange(len(lookup_strings))
+    codes = codes[np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, lengths)]
+
+    vocabulary_codes, columns = np.unique(codes, return_inverse=True)
+    counts = csr_matrix((np.ones(len(columns)), columns, indptr), shape=(len(lookup_strings), len(vocabulary_codes)))
+    counts.sum_duplicates()
+
+    terms = np.stack([vocabulary_codes >> 16, vocabulary_codes >> 8, vocabulary_codes], axis=1).astype(np.uint8).tobytes()
+    vocabulary = [terms[i:i + 3].decode("ascii") for i in range(0, len(terms), 3)]
+
+    return counts, vocabulary
 
 
 class FuzzyIndex:
     '''
        Create a fuzzy index using a Term Frequency, Inverse Document Frequency (tf-idf)
-       algorithm. Currently the libraries that implement this cannot be serialized to disk,
-       so this is an in memory operation. Fortunately for our amounts of data, it should
-       be quick to rebuild this index.
+       algorithm. The matches are searched for by a backend from fuzzy_backends: nmslib
+       or scipy. The nmslib index itself cannot be serialized to disk, but the fitted
+       vocabulary, the idf weights, the tf-idf matrix and the ids can be. These are saved
+       as numpy arrays that are memory mapped when loaded, so that only the quick backend
+       index creation needs to be done again.
+
+       Recordings can be added and removed with update() without fitting the vectorizer again.
+       The vocabulary and idf weights stay fixed, so new trigrams are ignored and the weights
+       slowly go stale. needs_refit() tells when the index has drifted far enough from its
+       fit that it should be built again.
+
+       Next to the index of all recordings, there is a small index of the artists. With
+       artist blocking, a search first looks for the artist and then only searches the
+       recordings of the best matching artists, falling back to searching all recordings
+       if no artist matched. This keeps the cost of a query down to the size of an artist's
+       recordings and stops common recording names from pulling in the wrong artists.
     '''
 
-    def __init__(self):
+    # Refit once this fraction of the fitted rows have been added or removed
+    REFIT_CHANGED_FRACTION = .1
+    # Refit once this fraction of the trigrams in added rows are not in the vocabulary
+    REFIT_UNKNOWN_FRACTION = .05
+
+    # With artist blocking, search the recordings of up to this many artists with at least this similarity
+    ARTIST_CANDIDATES = 3
+    ARTIST_THRESHOLD = .5
+
+    def __init__(self, backend=None):
+        """ backend is the name of the search backend to use, by default the best one available """
+        self.backend = get_backend(backend)
         self.vectorizer = None
         self.index = None
+        self.lookup_matrix = None
+        self.lookup_ids = None
+        self.artists = None
+        self.artist_matrix = None
+        self.row_artists = None
+        self.version = None
+        self.fitted_rows = 0
+        self.changed_rows = 0
+        self.added_terms = 0
+        self.unknown_terms = 0
 
-    def encode_string(self, text):
+    @staticmethod
+    def encode_string(text):
         if text is None:
             return None
-        return unidecode(re.sub(" +", "", re.sub(r'[^\w ]+', '', text)).strip().lower())
+        return encode_string(text)
+
+    def encode_data(self, artist_recording_data):
+        """
+            Turn (artist_name, recording_name, recording_id) tuples into lookup strings, an array of ids
+            and the encoded artist names. Recordings without an artist or recording name are skipped.
+        """
+        rows = [row for row in artist_recording_data if row[0] is not None and row[1] is not None]
+        artist_names = encode_strings([row[0] for row in rows])
+        recording_names = encode_strings([row[1] for row in rows])
+        lookup_strings = [artist_name + recording_name for artist_name, recording_name in zip(artist_names, recording_names)]
+
+        return lookup_strings, np.array([row[2] for row in rows], dtype=np.int64), artist_names
 
     def build(self, artist_recording_data):
         """
             Builds a new index and saves it to disk and keeps it in ram as well.
         """
-        self.lookup_strings = []
-        lookup_ids = []
-        for artist_name, recording_name, lookup_id in artist_recording_data:
-            if artist_name is None or recording_name is None:
-                continue
-            self.lookup_strings.append(self.encode_string(artist_name) + self.encode_string(recording_name))
-            lookup_ids.append(lookup_id)
+        self.lookup_strings, self.lookup_ids, artist_names = self.encode_data(artist_recording_data)
+        counts, vocabulary = count_trigrams(self.lookup_strings)
+        transformer = TfidfTransformer()
+        self.lookup_matrix = transformer.fit_transform(counts)
+        self.vectorizer = self.create_vectorizer(vocabulary, transformer.idf_)
 
-        self.vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
-        lookup_matrix = self.vectorizer.fit_transform(self.lookup_strings)
+        artists, row_artists = np.unique(np.array(artist_names, dtype=str), return_inverse=True)
+        self.artists = artists.tolist()
+        self.row_artists = row_artists.astype(np.int32)
+        self.artist_matrix = self.vectorizer.transform(self.artists)
+        self.fitted_rows = len(self.lookup_ids)
+        self.changed_rows = 0
+        self.added_terms = 0
+        self.unknown_terms = 0
+        self.create_index()
 
-        self.index = nmslib.init(method='simple_invindx', space='negdotprod_sparse_fast', data_type=nmslib.DataType.SPARSE_VECTOR)
-        self.index.addDataPointBatch(lookup_matrix, lookup_ids)
-        self.index.createIndex()
+    def update(self, artist_recording_data, remove_ids, create_index=True):
+        """
+            Remove the recordings with ids in remove_ids from the index and add the recordings in
+            artist_recording_data, using the fitted vocabulary and idf weights. To change a recording,
+            pass its id in remove_ids and its new data in artist_recording_data. If create_index is
+            False, the search backend index isn't created again, e.g. if the index is only saved.
+        """
+        changed = False
+        if remove_ids:
+            keep = ~np.isin(self.lookup_ids, np.fromiter(remove_ids, dtype=np.int64))
+            removed = len(keep) - int(keep.sum())
+            if removed:
+                self.lookup_matrix = self.lookup_matrix[keep]
+                self.lookup_ids = self.lookup_ids[keep]
+                self.row_artists = self.row_artists[keep]
+                self.changed_rows += removed
+                changed = True
+
+        lookup_strings, lookup_ids, artist_names = self.encode_data(artist_recording_data)
+        if lookup_strings:
+            self.add_artists(artist_names)
+            matrix = self.vectorizer.transform(lookup_strings)
+            vocabulary = self.vectorizer.vocabulary_
+            for lookup_string in lookup_strings:
+                terms = ngrams(lookup_string)
+                self.added_terms += len(terms)
+                self.unknown_terms += sum(1 for term in terms if term not in vocabulary)
+
+            self.lookup_matrix = vstack([self.lookup_matrix, matrix], format="csr")
+            self.lookup_ids = np.concatenate([self.lookup_ids, lookup_ids])
+            self.changed_rows += len(lookup_ids)
+            changed = True
+
+        if changed and create_index:
+            self.create_index()
 
-    def search(self, query_data):
+    def add_artists(self, artist_names):
         """
-            Return IDs for the matches in a list. Returns a list of dicts with keys of lookup_string, confidence and recording_id.
+            Add the artists of new rows to the artist index, if they're not in there yet, and append the
+            artist of each new row to row_artists.
         """
+        artist_index = {artist: i for i, artist in enumerate(self.artists)}
+        new_artists = []
+        for artist in artist_names:
+            if artist not in artist_index:
+                artist_index[artist] = len(artist_index)
+                new_artists.append(artist)
 
-        query_strings = []
-        for data in query_data:
-            if data["artist_name"] is None or data["recording_name"] is None:
-                continue
+        if new_artists:
+            self.artists = self.artists + new_artists
+            self.artist_matrix = vstack([self.artist_matrix, self.vectorizer.transform(new_artists)], format="csr")
 
-            query_strings.append(self.encode_string(data["artist_name"]) + self.encode_string(data["recording_name"]))
+        row_artists = np.array([artist_index[artist] for artist in artist_names], dtype=np.int32)
+        self.row_artists = np.concatenate([self.row_artists, row_artists])
+
+    def needs_refit(self):
+        """
+            Return True if enough rows have changed, or enough of the added trigrams are missing from
+            the vocabulary, that the index should be built from scratch.
+        """
+        if self.changed_rows > self.REFIT_CHANGED_FRACTION * max(self.fitted_rows, 1):
+            return True
+        return self.added_terms > 0 and self.unknown_terms > self.REFIT_UNKNOWN_FRACTION * self.added_terms
+
+    @staticmethod
+    def create_vectorizer(vocabulary, idf):
+        """
+            Create a vectorizer for queries from a fitted vocabulary (a list of trigrams) and idf weights.
+        """
+        vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams, vocabulary={term: i for i, term in enumerate(vocabulary)})
+        vectorizer.idf_ = idf
+        return vectorizer
+
+    def create_index(self):
+        """
+            Create the search backend index from the tf-idf matrix.
+        """
+        self.index = self.backend(self.lookup_matrix, self.lookup_ids)
+
+        # The artist index is small, the scipy backend does fine for it. The rows of each artist are
+        # artist_rows[artist_indptr[artist]:artist_indptr[artist + 1]].
+        self.artist_index = SparseMatrixBackend(self.artist_matrix, np.arange(len(self.artists)))
+        self.artist_rows = np.argsort(self.row_artists, kind="stable")
+        self.artist_indptr = np.searchsorted(self.row_artists[self.artist_rows], np.arange(len(self.artists) + 1))
+
+    def save(self, index_dir, version):
+        """
+            Save the fitted vocabulary, idf weights, tf-idf matrix and ids to index_dir. version is the
+            collection version the index was built from, load() only accepts an index with the same version.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        meta_file = os.path.join(index_dir, "index.json")
+        # remove the meta file first, so that a partially written index is never loaded
+        if os.path.exists(meta_file):
+            os.unlink(meta_file)
+
+        vocabulary = sorted(self.vectorizer.vocabulary_, key=self.vectorizer.vocabulary_.get)
+        arrays = {
+            "vocabulary": np.array(vocabulary, dtype=str),
+            "idf": self.vectorizer.idf_,
+            "data": self.lookup_matrix.data,
+            "indices": self.lookup_matrix.indices,
+            "indptr": self.lookup_matrix.indptr,
+            "ids": self.lookup_ids,
+            "artists": np.array(self.artists, dtype=str),
+            "row_artists": self.row_artists,
+            "artist_data": self.artist_matrix.data,
+            "artist_indices": self.artist_matrix.indices,
+            "artist_indptr": self.artist_matrix.indptr,
+        }
+        for name, array in arrays.items():
+            # The arrays may be memory mapped from the files that are replaced here. Writing to a new file and
+            # renaming it leaves the mapped files intact, instead of truncating them while they are being read.
+            file_name = os.path.join(index_dir, name + ".npy")
+            with open(file_name + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(file_name + ".tmp", file_name)
+
+        with open(meta_file, "w") as f:
+            json.dump({"format": INDEX_FORMAT,
+                       "version": version,
+                       "shape": self.lookup_matrix.shape,
+                       "fitted_rows": self.fitted_rows,
+                       "changed_rows": self.changed_rows,
+                       "added_terms": self.added_terms,
+                       "unknown_terms": self.unknown_terms}, f)
+        self.version = version
+
+    @staticmethod
+    def read_meta(index_dir):
+        """
+            Return the metadata saved with the index in index_dir, including the collection version it was
+            built from, or None if there is no saved index of the current format. This doesn't load the index.
+        """
+        try:
+            with open(os.path.join(index_dir, "index.json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(meta, dict) or meta.get("format") != INDEX_FORMAT:
+            return None
+        return meta
+
+    def load(self, index_dir, version=None, create_index=True):
+        """
+            Load an index saved with save(). The arrays are memory mapped. Returns False if there is no saved
+            index, or if it was built from a different collection version. If version is None, an index
+            of any version is loaded, e.g. to update() it. If create_index is False, the search backend
+            index isn't created, which is left to update().
+        """
+        meta = self.read_meta(index_dir)
+        if meta is None or (version is not None and meta["version"] != version):
+            return False
+        try:
+            arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r") for name in INDEX_ARRAYS}
+        except (OSError, ValueError):
+            return False
+
+        self.vectorizer = self.create_vectorizer(arrays["vocabulary"].tolist(), np.asarray(arrays["idf"]))
+        self.lookup_matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"]))
+        self.lookup_ids = arrays["ids"]
+        self.artists = arrays["artists"].tolist()
+        self.row_artists = arrays["row_artists"]
+        self.artist_matrix = csr_matrix((arrays["artist_data"], arrays["artist_indices"], arrays["artist_indptr"]),
+                                        shape=(len(self.artists), self.lookup_matrix.shape[1]))
+        self.version = meta["version"]
+        self.fitted_rows = meta["fitted_rows"]
+        self.changed_rows = meta["changed_rows"]
+        self.added_terms = meta["added_terms"]
+        self.unknown_terms = meta["unknown_terms"]
+        if create_index:
+            self.create_index()
+
+        return True
+
+    def search(self, query_data, k=1, num_threads=1, artist_blocking=False):
+        """
+            Return IDs for the matches in a list, one for each item in query_data, in the same order.
+            Returns a list of dicts with keys of confidence and recording_id for the best match and
+            candidates, a list of (recording_id, confidence) tuples of the k best matches. Items
+            without an artist or recording name get confidence 0.0 and no candidates. If artist_blocking
+            is set, only the recordings of the best matching artists are searched, see search_by_artist().
+        """
+
+        query_rows = [i for i, data in enumerate(query_data) if data["artist_name"] is not None and data["recording_name"] is not None]
+        artist_names = encode_strings([query_data[i]["artist_name"] for i in query_rows])
+        recording_names = encode_strings([query_data[i]["recording_name"] for i in query_rows])
+        query_strings = [artist_name + recording_name for artist_name, recording_name in zip(artist_names, recording_names)]
+
+        output = [{"confidence": 0.0, "recording_id": 0, "candidates": []} for _ in query_data]
+        if not query_strings:
+            return output
 
         query_matrix = self.vectorizer.transform(query_strings)
-        results = self.index.knnQueryBatch(query_matrix, k=1, num_threads=1)
+        if artist_blocking:
+            results = self.search_by_artist(artist_names, query_matrix, k, num_threads)
+        else:
+            results = self.index.search(query_matrix, k, num_threads)
 
-        output = []
-        for i, result in enumerate(results):
-            if len(result[0]):
-                output.append({"confidence": fabs(result[1][0]),
-                               "recording_id": result[0][0]})
-            else:
-                output.append({"confidence": 0.0, "recording_id": 0})
+        for i, (ids, similarities) in zip(query_rows, results):
+            candidates = [(int(recording_id), float(similarity)) for recording_id, similarity in zip(ids, similarities)]
+            if candidates:
+                output[i] = {"confidence": candidates[0][1], "recording_id": candidates[0][0], "candidates": candidates}
 
         return output
+
+    def search_by_artist(self, artist_names, query_matrix, k, num_threads):
+        """
+            Search in two stages: find the artists that match the encoded artist names, then search only
+            the recordings of those artists. Queries for which no artist matched (or whose artists have no
+            recordings that match at all) are searched for in the whole index. Returns the results like
+            the search backends do.
+        """
+        artist_matches = self.artist_index.search(self.vectorizer.transform(artist_names), self.ARTIST_CANDIDATES, num_threads)
+
+        results = [None] * len(artist_names)
+        global_queries = []
+        for i, (artists, similarities) in enumerate(artist_matches):
+            blocks = [self.artist_rows[self.artist_indptr[artist]:self.artist_indptr[artist + 1]]
+                      for artist in artists[similarities >= self.ARTIST_THRESHOLD]]
+            rows = np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int64)
+            if len(rows):
+                scores = (self.lookup_matrix[rows] @ query_matrix[i].T).toarray().ravel()
+                if len(scores) > k:
+                    top = np.argpartition(-scores, k - 1)[:k]
+                    rows, scores = rows[top], scores[top]
+                order = np.argsort(-scores, kind="stable")
+                order = order[scores[order] > 0]
+                if len(order):
+                    results[i] = (self.lookup_ids[rows[order]], scores[order])
+                    continue
+
+            global_queries.append(i)
+
+        if global_queries:
+            for i, result in zip(global_queries, self.index.search(query_matrix[global_queries], k, num_threads)):
+                results[i] = result
+
+        return results
@@ -0,0 +1,125 @@
+import os
+import threading
+
+import numpy as np
+
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.state import State
+from lb_content_resolver.fuzzy_index import FuzzyIndex
+
+# Saving the index from a background refit and from an update at the same time would mix up the files
+save_lock = threading.Lock()
+
+
+class FuzzyIndexStore:
+    '''
+       Keep the fuzzy index of the collection saved next to the database file. The saved index
+       is loaded when it is up to date, built when it isn't and updated in place after a scan or
+       sync changed the collection, so that resolving doesn't have to build it from scratch.
+    '''
+
+    BATCH_SIZE = 500
+
+    def get_index_dir(self):
+        """
+            Return the directory where the fuzzy index is saved, next to the database file, or None
+            for in memory databases.
+        """
+        if not db.database or db.database == ":memory:":
+            return None
+        return os.path.splitext(db.database)[0] + "-fuzzy-index"
+
+    def get_artist_recording_metadata(self, recording_ids=None):
+        """
+            Fetch the metadata needed to build a fuzzy search index, as a list of
+            (artist_name, recording_name, recording_id) tuples, for all recordings or only the
+            given recording ids. This reads only the needed columns straight from the cursor,
+            rather than creating model instances for all recordings.
+        """
+
+        if recording_ids is None:
+            return db.execute_sql("SELECT artist_name, recording_name, id FROM recording").fetchall()
+
+        recording_ids = list(recording_ids)
+        data = []
+        for i in range(0, len(recording_ids), self.BATCH_SIZE):
+            batch = recording_ids[i:i + self.BATCH_SIZE]
+            query = "SELECT artist_name, recording_name, id FROM recording WHERE id IN (%s)" % ",".join("?" * len(batch))
+            data.extend(db.execute_sql(query, batch).fetchall())
+
+        return data
+
+    def load(self):
+        """
+            Return the saved fuzzy index if it is up to date, otherwise build it and save it for next time.
+        """
+        index_dir = self.get_index_dir()
+        index = FuzzyIndex()
+        if index_dir is not None and index.load(index_dir, State.collection_version()):
+            return index
+
+        return self.rebuild()
+
+    def rebuild(self):
+        """
+            Build the fuzzy index from scratch, save it and return it.
+        """
+        version = State.collection_version()
+        index = FuzzyIndex()
+        index.build(self.get_artist_recording_metadata())
+        index.version = version
+        self.save(index, version)
+        return index
+
+    def save(self, index, version):
+        """
+            Save the index, if the database isn't in memory. Failing to save is not fatal, the index
+            will simply be built again next time.
+        """
+        index_dir = self.get_index_dir()
+        if index_dir is None:
+            return
+
+        with save_lock:
+            try:
+                index.save(index_dir, version)
+            except OSError as err:
+                print("Cannot save fuzzy index to %s: %s" % (index_dir, err))
+
+    def update(self, changed_ids=(), background_refit=False):
+        """
+            Bring the saved fuzzy index up to date with the collection, without fitting it again:
+            recordings that were deleted are removed from the index, new recordings are added and
+            the recordings in changed_ids (updated without changing their id) are replaced.
+
+            If the index has drifted too far from its fit, it is rebuilt instead, in a background
+            thread if background_refit is set. If no index was saved yet, nothing is done: it will be
+            built the first time it is needed. The version of the saved index is checked before it is
+            loaded, so that nothing is loaded if it is already up to date.
+        """
+        index_dir = self.get_index_dir()
+        meta = FuzzyIndex.read_meta(index_dir) if index_dir is not None else None
+        if meta is None:
+            return
+
+        version = State.collection_version()
+        if meta["version"] == version and not changed_ids:
+            return
+
+        index = FuzzyIndex()
+        if not index.load(index_dir, create_index=False):
+            return
+
+        recording_ids = np.array([row[0] for row in db.execute_sql("SELECT id FROM recording")], dtype=np.int64)
+        removed_ids = set(np.setdiff1d(index.lookup_ids, recording_ids).tolist())
+        changed_ids = set(np.intersect1d(index.lookup_ids, np.fromiter(changed_ids, dtype=np.int64)).tolist())
+        added_ids = set(np.setdiff1d(recording_ids, index.lookup_ids).tolist()) | changed_ids
+
+        index.update(self.get_artist_recording_metadata(added_ids), removed_ids | changed_ids, create_index=False)
+        self.save(index, version)
+
+        if index.needs_refit():
+            if not background_refit:
+                self.rebuild()
+            else:
+                threading.Thread(target=self.rebuild).start()
@@ -5,11 +5,15 @@ import sys
 
 import peewee
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from lb_content_resolver.model.database import db
-from lb_content_resolver.model.recording import Recording, RecordingMetadata
+from lb_content_resolver.model.recording import Recording, RecordingMetadata, RecordingLookup
+from lb_content_resolver.model.state import State
 from lb_content_resolver.model.tag import RecordingTag
+from lb_content_resolver.utils import threaded_map
 
 
 RecordingRow = namedtuple('RecordingRow', ('id', 'mbid', 'metadata_id'))
@@ -18,21 +22,82 @@ RecordingRow = namedtuple('RecordingRow', ('id', 'mbid', 'metadata_id'))
 class MetadataLookup:
     '''
     Given the local database, lookup metadata from MusicBrainz to allow local playlist resolution.
+
+    The batches of recordings are looked up by a pool of threads that share a session, so that the
+    connections are kept alive. The results are written to the DB in order by the calling thread,
+    while the next batches are being looked up.
     '''
 
     BATCH_SIZE = 1000
 
-    def lookup(self):
+    DEFAULT_URL = "https://labs.api.listenbrainz.org/bulk-tag-lookup/json"
+
+    # The number of batches that are looked up at the same time
+    DEFAULT_CONCURRENCY = 4
+
+    # Requests that fail with these status codes or a connection error are retried, waiting
+    # RETRY_BACKOFF seconds and then twice as long each time.
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    MAX_RETRIES = 5
+    RETRY_BACKOFF = 1.0
+
+    # Which recordings are looked up: all of them, the ones without metadata, the ones whose metadata
+    # is missing or older than max_age days, or the ones that were added since the last lookup. Recordings
+    # without metadata that were looked up in the last max_age days are not looked up again by missing or stale.
+    REFRESH_POLICIES = ("all", "missing", "stale", "new")
+    DEFAULT_MAX_AGE = 30
+
+    # The number of rows inserted per statement. Older versions of SQLite allow only 999 variables per statement.
+    INSERT_BATCH_SIZE = 200
+
+    def __init__(self, url=None, concurrency=DEFAULT_CONCURRENCY):
+        self.url = url or self.DEFAULT_URL
+        self.concurrency = concurrency
+
+        retry = Retry(total=self.MAX_RETRIES,
+                      backoff_factor=self.RETRY_BACKOFF,
+                      status_forcelist=self.RETRY_STATUS_CODES,
+                      allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=concurrency)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def lookup(self, refresh="all", max_age=DEFAULT_MAX_AGE):
         """
-        Iterate over all recordings in the database and call lookup_chunk for chunks of recordings.
+        Iterate over the recordings in the database selected by the refresh policy (see REFRESH_POLICIES)
+        and look up the metadata for chunks of recordings. max_age is in days.
+
+        Every policy looks up the recordings added since the last lookup, so after a lookup without
+        failures the highest recording id is stored as the starting point of the "new" policy. This
+        doesn't depend on the file modification times, which copied files keep and subsonic syncs reset.
         """
 
+        if refresh not in self.REFRESH_POLICIES:
+            raise ValueError("Unknown refresh policy '%s', use one of %s" % (refresh, ", ".join(self.REFRESH_POLICIES)))
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=max_age)
+        last_id = db.execute_sql("SELECT MAX(id) FROM recording").fetchone()[0] or 0
+        conditions, params = {
+            "all": ("", ()),
+            "missing": ("""AND recording_metadata.id IS NULL
+                           AND (recording_lookup.id IS NULL OR recording_lookup.last_updated < ?)""", (cutoff, )),
+            "stale": ("""AND (recording_metadata.last_updated < ?
+                              OR (recording_metadata.id IS NULL
+                                  AND (recording_lookup.id IS NULL OR recording_lookup.last_updated < ?)))""", (cutoff, cutoff)),
+            "new": ("AND recording.id > ?", (int(State.get_value("metadata_lookup_last_id", 0)), )),
+        }[refresh]
+
         cursor = db.execute_sql("""SELECT recording.id, recording.recording_mbid, recording_metadata.id
                                      FROM recording
                                 LEFT JOIN recording_metadata
                                        ON recording.id = recording_metadata.recording_id
+                                LEFT JOIN recording_lookup
+                                       ON recording.id = recording_lookup.recording_id
                                     WHERE recording_mbid IS NOT NULL
-                                 ORDER BY artist_name, release_name""")
+                                      %s
+                                 ORDER BY artist_name, release_name""" % conditions, params)
         recordings = tuple(
             RecordingRow(id=row[0], mbid=str(row[1]), metadata_id=row[2])
             for row in cursor.fetchall()
@@ -40,71 +105,84 @@ class MetadataLookup:
 
         print("[ %d recordings to lookup ]" % len(recordings))
 
-        offset = 0
+        failed = False
+        batches = [recordings[offset:offset + self.BATCH_SIZE] for offset in range(0, len(recordings), self.BATCH_SIZE)]
         with tqdm(total=len(recordings)) as self.pbar:
-            while offset <= len(recordings):
-                self.process_recordings(recordings[offset:offset+self.BATCH_SIZE])
-                offset += self.BATCH_SIZE
+            for recordings, rows in zip(batches, threaded_map(self.fetch_metadata, batches, self.concurrency)):
+                if rows is None:
+                    failed = True
+                else:
+                    self.save_metadata(recordings, rows)
+                self.pbar.update(len(recordings))
 
-    def process_recordings(self, recordings):
+        if not failed:
+            State.set_value("metadata_lookup_last_id", str(last_id))
+
+    def fetch_metadata(self, recordings):
         """
-            This function carries out the actual lookup of the metadata and inserting the
-            popularity and tags into the DB for the given chunk of recordings.
+            Look up the popularity and tags of the given recordings. Returns the rows of the
+            response, or None if the lookup failed. This is called from the lookup threads.
         """
 
-        args = []
-        mbid_to_recording = {}
-        for rec in recordings:
-            mbid_to_recording[rec.mbid] = rec
-            args.append({"[recording_mbid]": rec.mbid})
+        args = [{"[recording_mbid]": rec.mbid} for rec in recordings]
+        try:
+            r = self.session.post(self.url, json=args)
+        except requests.RequestException as err:
+            print("Fail: %s" % err)
+            return None
 
-        r = requests.post("https://labs.api.listenbrainz.org/bulk-tag-lookup/json", json=args)
         if r.status_code != 200:
             print("Fail: %d %s" % (r.status_code, r.text))
-            return False
+            return None
+
+        return r.json()
 
+    def save_metadata(self, recordings, rows):
+        """
+            Insert the popularity and tags from the rows of a lookup response into the DB,
+            replacing the previous ones of the recordings. The time of the lookup is stored for all
+            the recordings, including those that the response has no rows for.
+        """
+
+        mbid_to_recording = {rec.mbid: rec for rec in recordings}
         recording_pop = {}
         recording_tags = defaultdict(lambda: defaultdict(list))
         tags = set()
-        for row in r.json():
+        for row in rows:
             mbid = str(row["recording_mbid"])
             recording_pop[mbid] = row["percent"]
             recording_tags[mbid][row["source"]].append(row["tag"])
             tags.add(row["tag"])
 
-        self.pbar.update(len(recordings))
-
         with db.atomic():
 
-            # This DB code is pretty messy -- things I take for granted with Postgres are not
-            # available in SQLite or the PeeWee ORM. But, this might be ok, since we're not
-            # updating millions of rows constantly.
-
-            # First update recording_metadata table
-            for mbid in set(recording_pop):
+            # First update recording_metadata table. Existing rows are replaced with their own id,
+            # rows with and without an id are inserted separately since insert_many takes the
+            # columns from the first row.
+            now = datetime.datetime.now()
+            new_metadata = []
+            updated_metadata = []
+            for mbid in recording_pop:
                 recording = mbid_to_recording[mbid]
+                metadata = {"recording": recording.id, "popularity": recording_pop[mbid], "last_updated": now}
                 if recording.metadata_id is None:
-                    recording_metadata = RecordingMetadata.create(recording=recording.id,
-                                                                  popularity=recording_pop[mbid],
-                                                                  last_updated=datetime.datetime.now())
-                    recording_metadata.save()
+                    new_metadata.append(metadata)
                 else:
-                    recording_metadata = RecordingMetadata.replace(id=recording.metadata_id,
-                                                                   recording=recording.id,
-                                                                   popularity=recording_pop[mbid],
-                                                                   last_updated=datetime.datetime.now())
+                    updated_metadata.append(dict(metadata, id=recording.metadata_id))
+
+            for metadata in (new_metadata, updated_metadata):
+                for batch in peewee.chunked(metadata, self.INSERT_BATCH_SIZE):
+                    RecordingMetadata.insert_many(batch).on_conflict_replace().execute()
 
-                    recording_metadata.execute()
+            lookups = [{"recording": recording.id, "last_updated": now} for recording in recordings]
+            for batch in peewee.chunked(lookups, self.INSERT_BATCH_SIZE):
+                RecordingLookup.insert_many(batch).on_conflict_replace().execute()
 
             # Next delete recording_tags
-            RecordingTag.delete().where(
-                RecordingTag.recording_id.in_(
-                    Recording.select(Recording.id).where(
-                        Recording.recording_mbid.in_(set(recording_tags))
-
-                    )
-                )
-            ).execute()
+            recording_ids = [mbid_to_recording[mbid].id for mbid in recording_tags]
+            for batch in peewee.chunked(recording_ids, self.INSERT_BATCH_SIZE):
+                RecordingTag.delete().where(RecordingTag.recording_id.in_(batch)).execute()
+
             # This is the better way to insert the tags into the DB, but on some installations
             # of Sqlite/Python the UPSERT is not supported. Once it is widely supported,
             # remove the section below and uncomment this.
@@ -117,19 +195,16 @@ class MetadataLookup:
             #    tag_ids[tag] = row[0]
 
             # insert new recording tags
-            for tag in tags:
-                db.execute_sql("""INSERT OR IGNORE INTO tag (name) VALUES (?)""", (tag,))
+            cursor = db.cursor()
+            cursor.executemany("""INSERT OR IGNORE INTO tag (name) VALUES (?)""", [(tag,) for tag in tags])
 
             tag_str = ",".join([ "'%s'" % t.replace("'", "''") for t in tags])
             cursor = db.execute_sql("""SELECT id, name FROM tag WHERE name IN (%s)""" % tag_str)
             tag_ids = {row[1]: row[0] for row in cursor.fetchall()}
 
             # insert recording_tag rows
-            with db.atomic():
-                now = datetime.datetime.now()
-                for row in r.json():
-                    recording = mbid_to_recording[row["recording_mbid"]]
-                    db.execute_sql("""INSERT INTO recording_tag (recording_id, tag_id, entity, last_updated)
-                                       VALUES (?, ?, ?, ?)""", (recording.id, tag_ids[row["tag"]], row["source"], now))
-
-        return True
+            cursor = db.cursor()
+            cursor.executemany("""INSERT INTO recording_tag (recording_id, tag_id, entity, last_updated)
+                                       VALUES (?, ?, ?, ?)""",
+                               [(mbid_to_recording[str(row["recording_mbid"])].id, tag_ids[row["tag"]], row["source"], now)
+                                for row in rows])
@@ -77,3 +77,21 @@ class RecordingMetadata(Model):
 
     def __repr__(self):
         return "<RecordingMetadata('%d','%.3f')>" % (self.recording or 0, self.popularity)
+
+
+class RecordingLookup(Model):
+    """
+    When the metadata of a recording was last looked up, whether or not anything was found, so that
+    recordings that have no metadata aren't looked up again on every run.
+    """
+
+    class Meta:
+        database = db
+        table_name = "recording_lookup"
+
+    id = AutoField()
+    recording = ForeignKeyField(Recording, backref="lookups", unique=True)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<RecordingLookup('%d')>" % (self.recording or 0)
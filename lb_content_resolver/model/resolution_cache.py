@@ -0,0 +1,28 @@
+import datetime
+from peewee import *
+from lb_content_resolver.model.database import db
+
+
+class ResolutionCache(Model):
+    """
+    Memo of the results of resolving recordings with the fuzzy index, since the same recordings get
+    resolved again and again for daily playlists. recording_id is NULL for recordings that could not
+    be resolved with the given threshold. Entries are only valid for the collection version they were
+    made for.
+    """
+
+    class Meta:
+        database = db
+        table_name = "resolution_cache"
+
+    id = AutoField()
+    query = TextField(null=False, unique=True)
+    recording_id = IntegerField(null=True)
+    confidence = FloatField(null=False)
+    method = TextField(null=True)
+    threshold = FloatField(null=False)
+    collection_version = IntegerField(null=False, index=True)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<ResolutionCache('%s',%s)>" % (self.query, self.recording_id)
@@ -0,0 +1,23 @@
+import datetime
+from peewee import *
+from lb_content_resolver.model.database import db
+
+
+class ScanCursor(Model):
+    """
+    The position of an unfinished scan of a set of music directories. Everything up to and including
+    the files in dir_path has been scanned, so an interrupted scan can resume after it.
+    """
+
+    class Meta:
+        database = db
+        table_name = "scan_cursor"
+
+    id = AutoField()
+    music_dirs = TextField(null=False, unique=True)
+    top_dir = TextField(null=False)
+    dir_path = TextField(null=False)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<ScanCursor('%s')>" % self.dir_path
@@ -0,0 +1,50 @@
+import datetime
+from peewee import *
+from lb_content_resolver.model.database import db
+
+COLLECTION_VERSION = "collection_version"
+
+
+class State(Model):
+    """
+    Key/value pairs for bits of state that need to be kept between runs, like the time
+    of the last cleanup.
+    """
+
+    class Meta:
+        database = db
+
+    id = AutoField()
+    key = TextField(null=False, unique=True)
+    value = TextField(null=True)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    @classmethod
+    def get_value(cls, key, default=None):
+        """ Return the value stored for key, or default if there is none. """
+        state = cls.get_or_none(cls.key == key)
+        if state is None:
+            return default
+        return state.value
+
+    @classmethod
+    def set_value(cls, key, value):
+        """ Store value for key, replacing any existing value. """
+        cls.replace(key=key, value=value, last_updated=datetime.datetime.now()).execute()
+
+    @classmethod
+    def collection_version(cls):
+        """
+            Return the version of the collection. It is bumped each time recordings are added, changed or
+            removed, so that data derived from the recordings, like the fuzzy index, can be invalidated.
+        """
+        return int(cls.get_value(COLLECTION_VERSION, 0))
+
+    @classmethod
+    def bump_collection_version(cls):
+        """ Increment the collection version. Call this in the transaction that changes recordings. """
+        with db.atomic():
+            cls.set_value(COLLECTION_VERSION, str(cls.collection_version() + 1))
+
+    def __repr__(self):
+        return "<State('%s','%s')>" % (self.key, self.value)
@@ -0,0 +1,24 @@
+import datetime
+from peewee import *
+from lb_content_resolver.model.database import db
+
+
+class SubsonicAlbum(Model):
+    """
+    An album of the subsonic collection as of the last sync. The fingerprint is made from the change
+    markers of the album in the album list, so that albums that didn't change don't need to be fetched
+    again. song_ids is a JSON list of the ids of the album's songs.
+    """
+
+    class Meta:
+        database = db
+        table_name = "subsonic_album"
+
+    id = AutoField()
+    album_id = TextField(null=False, unique=True)
+    fingerprint = TextField(null=False)
+    song_ids = TextField(null=False)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<SubsonicAlbum('%s')>" % self.album_id
@@ -0,0 +1,22 @@
+import datetime
+from peewee import *
+from lb_content_resolver.model.database import db
+
+
+class SubsonicArtist(Model):
+    """
+    The artist MBID of a subsonic artist, as returned by getArtistInfo2, so that it doesn't need to be
+    looked up again on every sync. artist_mbid is NULL for artists that have no MBID.
+    """
+
+    class Meta:
+        database = db
+        table_name = "subsonic_artist"
+
+    id = AutoField()
+    artist_id = TextField(null=False, unique=True)
+    artist_mbid = TextField(null=True)
+    last_updated = DateTimeField(null=False, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<SubsonicArtist('%s','%s')>" % (self.artist_id, self.artist_mbid or "")
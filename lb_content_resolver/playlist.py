@@ -11,7 +11,15 @@ def read_jspf_playlist(jspf_file):
     with open(jspf_file, "r") as f:
         jspf = f.read()
 
-    playlist = _deserialize_from_jspf(json.loads(jspf))
+    return parse_jspf_playlist(json.loads(jspf))
+
+
+def parse_jspf_playlist(jspf):
+    """
+        Turn a JSPF playlist, already parsed from JSON, into a troi PlaylistElement.
+    """
+
+    playlist = _deserialize_from_jspf(jspf)
     playlist_element = PlaylistElement()
     playlist_element.playlists = [ playlist ]
 
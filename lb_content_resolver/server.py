@@ -0,0 +1,209 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import socketserver
+from urllib.parse import urlparse
+
+from lb_content_resolver.content_resolver import ContentResolver
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.state import State
+from lb_content_resolver.playlist import parse_jspf_playlist
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_THRESHOLD = .8
+DEFAULT_WORKERS = 4
+
+
+class ResolverService:
+    '''
+       Keeps a ContentResolver with its fuzzy index and recording MBID map in memory and resolves
+       requests with it. The indexes are loaded again whenever the collection version changes, e.g. after a scan.
+    '''
+
+    def __init__(self, num_threads=None, k=ContentResolver.DEFAULT_CANDIDATES, artist_blocking=False):
+        self.resolver = ContentResolver(num_threads=num_threads, k=k, artist_blocking=artist_blocking)
+
+    def load_index(self):
+        """ Load the indexes, if they aren't loaded yet or the collection changed since they were loaded """
+        self.resolver.build_index()
+        self.resolver.load_mbid_index()
+
+    def status(self):
+        self.load_index()
+        return {"collection_version": State.collection_version(),
+                "recordings": len(self.resolver.fuzzy_index.lookup_ids),
+                "cache_lookups": self.resolver.cache_lookups,
+                "cache_hits": self.resolver.cache_hits}
+
+    def resolve_recordings(self, request):
+        """
+            Resolve {"recordings": [{"artist_name", "recording_name", "recording_mbid", "release_name", "duration"}, ...],
+            "threshold": 0.8}. Only the artist and recording names are required, they must be strings or null.
+            Recordings with a null name are not resolved. Returns the resolved recordings with their recording_id,
+            file_id and file_id_type.
+        """
+        threshold = float(request.get("threshold", DEFAULT_THRESHOLD))
+        query_data = []
+        for recording in request["recordings"]:
+            for name in ("artist_name", "recording_name"):
+                if recording[name] is not None and not isinstance(recording[name], str):
+                    raise ValueError("%s must be a string or null" % name)
+            query_data.append({"artist_name": recording["artist_name"],
+                               "recording_name": recording["recording_name"],
+                               "recording_mbid": recording.get("recording_mbid"),
+                               "release_name": recording.get("release_name"),
+                               "duration": recording.get("duration")})
+
+        query_data = self.resolver.resolve_recording_by_mbid(query_data)
+        hits = self.resolver.resolve_recordings(query_data, threshold)
+
+        recording_ids = list(set(hit["recording_id"] for hit in hits))
+        file_ids = {}
+        for i in range(0, len(recording_ids), ContentResolver.BATCH_SIZE):
+            batch = recording_ids[i:i + ContentResolver.BATCH_SIZE]
+            query = "SELECT id, file_id, file_id_type FROM recording WHERE id IN (%s)" % ",".join("?" * len(batch))
+            for recording_id, file_id, file_id_type in db.execute_sql(query, batch):
+                file_ids[recording_id] = (file_id, file_id_type)
+
+        for hit in hits:
+            hit["file_id"], hit["file_id_type"] = file_ids.get(hit["recording_id"], (None, None))
+
+        return {"recordings": hits}
+
+    def resolve_playlist(self, request):
+        """
+            Resolve {"playlist": <JSPF playlist>, "threshold": 0.8}. Returns the JSPF playlist with the locations
+            (or subsonic ids) of the tracks that were resolved filled in.
+        """
+        threshold = float(request.get("threshold", DEFAULT_THRESHOLD))
+        playlist = parse_jspf_playlist(request["playlist"])
+        self.resolver.resolve_playlist(threshold, playlist)
+        return playlist.get_jspf()
+
+
+class ResolverRequestHandler(BaseHTTPRequestHandler):
+    '''
+       Handles the HTTP requests for the resolver server:
+
+       GET /status
+       POST /resolve_recordings
+       POST /resolve_playlist
+    '''
+
+    protocol_version = "HTTP/1.1"
+
+    # Each open connection holds one of the pool threads, so idle keep-alive connections are closed after this
+    # many seconds, to let other clients in.
+    timeout = 5
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/status":
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        endpoints = {
+            "/resolve_recordings": self.server.service.resolve_recordings,
+            "/resolve_playlist": self.server.service.resolve_playlist,
+        }
+        if path not in endpoints:
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as err:
+            self.send_json(400, {"error": "Invalid request: %s" % err})
+            return
+
+        try:
+            response = endpoints[path](request)
+        except (KeyError, TypeError, ValueError) as err:
+            self.send_json(400, {"error": "Invalid request: %s" % err})
+            return
+
+        self.send_json(200, response)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix socket"
+
+
+class PooledServerMixIn:
+    '''
+       Handle each request in a fixed pool of threads, rather than in a new thread for each request,
+       so that the threads keep their database connections open between requests.
+    '''
+
+    def start_pool(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # Don't wait for clients that keep their connections open
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class ResolverHTTPServer(PooledServerMixIn, HTTPServer):
+    pass
+
+
+class ResolverUnixServer(PooledServerMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, workers=DEFAULT_WORKERS, num_threads=None, k=None,
+          artist_blocking=False):
+    """
+        Run the resolver server on host:port, or on the unix socket socket_path if given, until interrupted.
+        The database must have been opened already.
+    """
+    service = ResolverService(num_threads=num_threads, k=k or ContentResolver.DEFAULT_CANDIDATES, artist_blocking=artist_blocking)
+    print("Loading fuzzy index...")
+    service.load_index()
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ResolverUnixServer(socket_path, ResolverRequestHandler)
+        print("Listening on %s" % socket_path)
+    else:
+        server = ResolverHTTPServer((host, port), ResolverRequestHandler)
+        print("Listening on http://%s:%d" % (host, port))
+
+    server.service = service
+    server.start_pool(workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
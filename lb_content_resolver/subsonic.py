@@ -1,15 +1,26 @@
+from concurrent.futures import Future
 import datetime
+from http.client import HTTPException
+import json
 import os
 import sys
+import threading
+from time import sleep
+from urllib.error import HTTPError
 from uuid import UUID
 
 import peewee
+from libsonic.errors import SonicError
 from tqdm import tqdm
 
 from lb_content_resolver.database import Database
 from lb_content_resolver.model.database import db
 from lb_content_resolver.model.recording import Recording, FileIdType
-from lb_content_resolver.utils import bcolors
+from lb_content_resolver.model.state import State
+from lb_content_resolver.model.subsonic_album import SubsonicAlbum
+from lb_content_resolver.model.subsonic_artist import SubsonicArtist
+from lb_content_resolver.fuzzy_index_store import FuzzyIndexStore
+from lb_content_resolver.utils import bcolors, threaded_map
 from lb_content_resolver.py_sonic_fix import FixedConnection
 
 
@@ -21,25 +32,53 @@ class SubsonicDatabase(Database):
     # Determined by the number of albums we can fetch in one go
     BATCH_SIZE = 500
 
+    # The number of songs inserted per statement. Older versions of SQLite allow only 999 variables per statement.
+    INSERT_BATCH_SIZE = 70
+
+    # The number of albums fetched at the same time
+    DEFAULT_CONCURRENCY = 8
+
+    # Failed requests are retried, after RETRY_DELAY seconds and then twice as long each time
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1.0
+
+    # How long the artist MBIDs that were looked up are kept, and how long it takes before artists
+    # without an MBID are looked up again, since they might have been tagged in the meantime.
+    ARTIST_TTL = datetime.timedelta(days=30)
+    ARTIST_MISSING_TTL = datetime.timedelta(days=7)
+
     def __init__(self, index_dir, config):
         self.config = config
         Database.__init__(self, index_dir)
 
-    def sync(self):
+    def sync(self, concurrency=DEFAULT_CONCURRENCY, incremental=False):
         """
-            Scan the subsonic client specified in config.py
+            Scan the subsonic client specified in config.py. concurrency is the number of albums
+            that are fetched from the subsonic server at the same time. If incremental is set, only
+            the albums that changed since the last sync are fetched.
         """
 
+        self.concurrency = concurrency
+
         # Keep some stats
         self.total = 0
         self.matched = 0
         self.error = 0
+        self.removed = 0
+
+        # Ids of existing recordings whose names changed, these need to be updated in the fuzzy index
+        self.renamed_ids = set()
 
-        self.run_sync()
+        # The collection version is bumped before the first change and after the sync, so that no
+        # index built while syncing is considered up to date.
+        if self.run_sync(incremental):
+            State.bump_collection_version()
+            FuzzyIndexStore().update(self.renamed_ids)
 
         print("Checked %s albums:" % self.total)
         print("  %5d albums matched" % self.matched)
         print("  %5d recordings with errors" % self.error)
+        print("  %5d recordings removed" % self.removed)
 
     def connect(self):
         if not self.config:
@@ -48,6 +87,9 @@ class SubsonicDatabase(Database):
 
         print("[ connect to subsonic ]")
 
+        return self.create_connection()
+
+    def create_connection(self):
         return FixedConnection(
             self.config.SUBSONIC_HOST,
             self.config.SUBSONIC_USER,
@@ -55,23 +97,53 @@ class SubsonicDatabase(Database):
             self.config.SUBSONIC_PORT,
         )
 
-    def run_sync(self):
+    def call(self, method, *args, **kwargs):
         """
-            Perform the sync between the local collection and the subsonic one.
+            Call a subsonic API method with the connection of the current thread. Requests that fail because of
+            network errors or server errors are retried up to MAX_RETRIES times, waiting twice as long each time.
         """
+        if not hasattr(self.local, "conn"):
+            self.local.conn = self.create_connection()
 
-        conn = self.connect()
-        if not conn:
-            return
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                return getattr(self.local.conn, method)(*args, **kwargs)
+            except (OSError, HTTPException) as err:
+                if isinstance(err, HTTPError) and err.code < 500 and err.code != 429:
+                    raise
+                if attempt == self.MAX_RETRIES:
+                    raise
+                sleep(self.RETRY_DELAY * 2 ** attempt)
+
+    def run_sync(self, incremental=False):
+        """
+            Perform the sync between the local collection and the subsonic one. The albums are fetched
+            by a pool of threads, but they are added to the database in order, in this thread. If incremental
+            is set, only the albums whose fingerprint changed since the last sync are fetched. The recordings
+            of songs that were removed from the server are removed. Returns True if the collection was changed.
+        """
+
+        if not self.config:
+            print("Missing credentials to connect to subsonic")
+            return False
 
-        cursor = db.connection().cursor()
+        print("[ connect to subsonic ]")
+
+        # Each fetcher thread has its own connection
+        self.local = threading.local()
+
+        # cross reference subsonic artist id to artist_mbid. Holds a future for each artist, so that
+        # every artist is only looked up once, even if several threads need it at the same time.
+        self.artist_lock = threading.Lock()
+        self.artist_mbids = self.load_artist_mbids()
+        self.new_artists = []
 
         print("[ load albums ]")
         album_ids = set()
         albums = []
         offset = 0
         while True:
-            results = conn.getAlbumList2(ltype="alphabeticalByArtist", size=self.BATCH_SIZE, offset=offset)
+            results = self.call("getAlbumList2", ltype="alphabeticalByArtist", size=self.BATCH_SIZE, offset=offset)
             albums.extend(results["albumList2"]["album"])
             album_ids.update([r["id"] for r in results["albumList2"]["album"]])
 
@@ -82,157 +154,261 @@ class SubsonicDatabase(Database):
 
         print("[ loaded %d albums ]" % len(album_ids))
 
-        pbar = tqdm(total=len(album_ids))
-        recordings = []
-
-        # cross reference subsonic artist id to artitst_mbid
-        artist_id_index = {}
-
-        for album in albums:
-            album_info = conn.getAlbum(id=album["id"])
+        # The song ids of each album as of the last sync, for the albums that are still there
+        stored_albums = {album.album_id: album for album in SubsonicAlbum.select()}
+        album_song_ids = {album_id: set(json.loads(album.song_ids)) for album_id, album in stored_albums.items()
+                          if album_id in album_ids}
+        removed_song_ids = set()
+        for album_id, album in stored_albums.items():
+            if album_id not in album_ids:
+                removed_song_ids.update(json.loads(album.song_ids))
+        vanished_album_ids = [album_id for album_id in stored_albums if album_id not in album_ids]
+
+        if incremental:
+            albums = [album for album in albums if album["id"] not in stored_albums or
+                      stored_albums[album["id"]].fingerprint != self.album_fingerprint(album)]
+            print("[ %d albums changed ]" % len(albums))
+
+        if not albums and not vanished_album_ids:
+            return False
+
+        State.bump_collection_version()
+
+        pbar = tqdm(total=len(albums))
+        songs = []
+        album_rows = []
+        for album, (album_info, album_mbid, artist_mbids, error) in zip(albums, threaded_map(self.fetch_album, albums, self.concurrency)):
+            self.total += 1
+            pbar.update(1)
+            if album_info is not None:
+                song_ids = [song["id"] for song in album_info["song"]]
+                removed_song_ids.update(album_song_ids.get(album["id"], set()).difference(song_ids))
+                album_song_ids[album["id"]] = set(song_ids)
+
+            if error:
+                pbar.write(bcolors.FAIL + "FAIL " + bcolors.ENDC + error)
+                self.error += 1
+                if album_info is not None:
+                    album_rows.append(self.album_row(album, song_ids, complete=False))
+                continue
 
-            # Some servers might already include the MBID in the list or album response
-            album_mbid = album_info.get("musicBrainzId", album.get("musicBrainzId"))
-            if not album_mbid:
-                album_info2 = conn.getAlbumInfo2(aid=album["id"])
-                try:
-                    album_mbid = album_info2["albumInfo"]["musicBrainzId"]
-                except KeyError:
-                    pbar.write(bcolors.FAIL + "FAIL " + bcolors.ENDC + "subsonic album '%s' by '%s' has no MBID" %
-                               (album["name"], album["artist"]))
+            complete = True
+            for song in album_info["song"]:
+                artist_mbid = artist_mbids[song.get("artistId", album_info.get("artistId"))]
+                if artist_mbid is None:
+                    pbar.write(bcolors.FAIL + "FAIL " + bcolors.ENDC + "recording '%s' by '%s' has no artist MBID" %
+                               (album_info["name"], album_info["artist"]))
+                    pbar.write("Consider retagging this file with Picard! ( https://picard.musicbrainz.org )")
                     self.error += 1
+                    complete = False
                     continue
 
-
-            recordings = []
-            for song in album_info["album"]["song"]:
-                album = album_info["album"]
-            
-                if "artistId" in song:
-                    artist_id = song["artistId"]
-                else:
-                    artist_id = album["artistId"]
-
-                if artist_id not in artist_id_index:
-                    artist = conn.getArtistInfo2(artist_id)
-                    try:
-                        artist_id_index[artist_id] = artist["artistInfo2"]["musicBrainzId"]
-                    except KeyError:
-                        pbar.write(bcolors.FAIL + "FAIL " + bcolors.ENDC + "recording '%s' by '%s' has no artist MBID" %
-                                (album["name"], album["artist"]))
-                        pbar.write("Consider retagging this file with Picard! ( https://picard.musicbrainz.org )")
-                        self.error += 1
-                        continue
-
-#                if "musicBrainzId" not in song:
-#                    song_details = conn.getSong(song["id"])
-#                    ic(song_details)
-
-                self.add_subsonic({
+                songs.append({
+                    "file_id": song["id"],
+                    "file_id_type": FileIdType.SUBSONIC_ID,
                     "artist_name": song["artist"],
                     "release_name": song["album"],
                     "recording_name": song["title"],
-                    "artist_mbid": artist_id_index[artist_id],
+                    "artist_mbid": artist_mbid,
                     "release_mbid": album_mbid,
                     "recording_mbid": song["musicBrainzId"],
                     "duration": song["duration"] * 1000,
                     "track_num": song["track"],
                     "disc_num": song["discNumber"],
-                    "subsonic_id": song["id"],
                     "mtime": datetime.datetime.now()
                     })
 
+            album_rows.append(self.album_row(album, song_ids, complete))
             pbar.write(bcolors.OKGREEN + "OK   " + bcolors.ENDC + "album %-50s %-50s" %
-                       (album["name"][:49], album["artist"][:49]))
+                       (album_info["name"][:49], album_info["artist"][:49]))
             self.matched += 1
-            self.total += 1
-            pbar.update(1)
 
-        if len(recordings) >= self.BATCH_SIZE:
-            self.update_recordings(recordings)
+            if len(songs) >= self.BATCH_SIZE:
+                self.add_subsonic_songs(songs)
+                self.save_artist_mbids()
+                songs = []
 
-    def add_subsonic(self, mdata):
-        """ 
-            Given recording metadata, add it to the database or update it if it already exists
-            update the recording instead
+        self.add_subsonic_songs(songs)
+        self.save_artist_mbids()
+        pbar.close()
+
+        # Songs can move from one album to another
+        for song_ids in album_song_ids.values():
+            removed_song_ids.difference_update(song_ids)
+
+        # The album rows are written only after the songs they no longer list are removed, in the same
+        # transaction. If the sync is interrupted before that, the next sync still knows the old song ids.
+        with db.atomic():
+            self.remove_subsonic_songs(removed_song_ids)
+
+            # A full sync also removes the recordings that no album lists, such as those synced before the
+            # albums were stored. This is only safe if the songs of every album on the server are known.
+            if not incremental and album_ids.issubset(album_song_ids):
+                self.remove_unlisted_subsonic_songs(set().union(*album_song_ids.values()))
+
+            for batch in peewee.chunked(album_rows, self.INSERT_BATCH_SIZE):
+                SubsonicAlbum.insert_many(batch).on_conflict_replace().execute()
+            for batch in peewee.chunked(vanished_album_ids, self.BATCH_SIZE):
+                SubsonicAlbum.delete().where(SubsonicAlbum.album_id.in_(batch)).execute()
+
+        return True
+
+    def album_row(self, album, song_ids, complete):
+        """
+            Return the SubsonicAlbum row of an album. The fingerprint of albums that were not synced
+            completely is left empty, so that incremental syncs fetch them again.
         """
+        return {"album_id": album["id"],
+                "fingerprint": self.album_fingerprint(album) if complete else "",
+                "song_ids": json.dumps(song_ids),
+                "last_updated": datetime.datetime.now()}
 
-        with db.atomic() as transaction:
+    @staticmethod
+    def album_fingerprint(album):
+        """ Return the fingerprint of an album in the album list, which changes whenever the album changes """
+        return "%s|%s|%s" % (album.get("changed", ""), album.get("created", ""), album.get("songCount", ""))
+
+    def fetch_album(self, album):
+        """
+            Fetch the songs of an album from the subsonic API, along with the album MBID and the MBIDs of its
+            artists. This is called from the fetcher threads and doesn't touch the database. Returns a tuple
+            (album_info, album_mbid, artist_mbids, error), where error is a message if the album can't be used.
+            album_info is still set if the album was fetched but has no MBID.
+        """
+        try:
+            album_info = self.call("getAlbum", id=album["id"])["album"]
+
+            # Some servers might already include the MBID in the list or album response
+            album_mbid = album_info.get("musicBrainzId") or album.get("musicBrainzId")
+            album_info.setdefault("song", [])
+            if not album_mbid:
+                album_info2 = self.call("getAlbumInfo2", aid=album["id"])
+                try:
+                    album_mbid = album_info2["albumInfo"]["musicBrainzId"]
+                except KeyError:
+                    return album_info, None, None, "subsonic album '%s' by '%s' has no MBID" % (album["name"], album["artist"])
+
+            artist_mbids = {}
+            for song in album_info["song"]:
+                artist_id = song.get("artistId", album_info.get("artistId"))
+                if artist_id not in artist_mbids:
+                    artist_mbids[artist_id] = self.get_artist_mbid(artist_id)
+
+            return album_info, album_mbid, artist_mbids, None
+        except (OSError, HTTPException, SonicError) as err:
+            return None, None, None, "subsonic album '%s' by '%s' could not be fetched: %s" % (album["name"], album["artist"], err)
+
+    def get_artist_mbid(self, artist_id):
+        """ Return the MBID of a subsonic artist, or None if the artist has no MBID """
+        with self.artist_lock:
+            future = self.artist_mbids.get(artist_id)
+            fetch = future is None
+            if fetch:
+                future = self.artist_mbids[artist_id] = Future()
+
+        if fetch:
             try:
-                recording = Recording.select().where(Recording.file_id == mdata['subsonic_id']).get()
-                recording.artist_name = mdata["artist_name"]
-                recording.release_name = mdata["release_name"]
-                recording.recording_name = mdata["recording_name"]
-                recording.artist_mbid = mdata["artist_mbid"]
-                recording.release_mbid = mdata["release_mbid"]
-                recording.recording_mbid = mdata["recording_mbid"]
-                recording.mtime = mdata["mtime"]
-                recording.track_num = mdata["track_num"]
-                recording.disc_num = mdata["disc_num"]
-                recording.save()
-                return "updated"
-            except peewee.DoesNotExist:
-                recording = Recording.create(file_id=mdata["subsonic_id"],
-                                             file_id_type=FileIdType(FileIdType.SUBSONIC_ID),
-                                             artist_name=mdata["artist_name"],
-                                             release_name=mdata["release_name"],
-                                             recording_name=mdata["recording_name"],
-                                             artist_mbid=mdata["artist_mbid"],
-                                             release_mbid=mdata["release_mbid"],
-                                             recording_mbid=mdata["recording_mbid"],
-                                             mtime=mdata["mtime"],
-                                             duration=mdata["duration"],
-                                             track_num=mdata["track_num"],
-                                             disc_num=mdata["disc_num"])
-                recording.save()
-                return "added"
-
-
-    def update_recordings(self, recordings):
-        """
-            Given a list of recording_subsonic records, update the DB.
-            Updates recording_id, subsonic_id, last_update
-        """
-
-        recording_index = { r[0]:r[1] for r in recordings }
-
-        cursor = db.connection().cursor()
+                artist = self.call("getArtistInfo2", artist_id)
+                artist_mbid = artist.get("artistInfo2", {}).get("musicBrainzId")
+                with self.artist_lock:
+                    self.new_artists.append({"artist_id": artist_id,
+                                             "artist_mbid": artist_mbid,
+                                             "last_updated": datetime.datetime.now()})
+                future.set_result(artist_mbid)
+            except Exception as err:
+                future.set_exception(err)
+
+        return future.result()
+
+    def load_artist_mbids(self):
+        """
+            Load the artist MBIDs that were looked up in earlier syncs and haven't expired yet, as
+            futures for get_artist_mbid.
+        """
+        now = datetime.datetime.now()
+        artist_mbids = {}
+        query = SubsonicArtist.select(SubsonicArtist.artist_id, SubsonicArtist.artist_mbid, SubsonicArtist.last_updated).tuples()
+        for artist_id, artist_mbid, last_updated in query:
+            ttl = self.ARTIST_TTL if artist_mbid else self.ARTIST_MISSING_TTL
+            if now - last_updated < ttl:
+                future = artist_mbids[artist_id] = Future()
+                future.set_result(artist_mbid)
+
+        return artist_mbids
+
+    def save_artist_mbids(self):
+        """ Save the artist MBIDs that were looked up since they were last saved """
+        with self.artist_lock:
+            artists = self.new_artists
+            self.new_artists = []
+
+        with db.atomic():
+            for batch in peewee.chunked(artists, self.INSERT_BATCH_SIZE):
+                SubsonicArtist.insert_many(batch).on_conflict_replace().execute()
+
+    def add_subsonic_songs(self, songs):
+        """
+            Given a list of recording rows for subsonic songs, add them to the database or replace
+            the recordings that already exist, in one transaction. Existing recordings keep their id,
+            so that the rows referring to them stay valid.
+        """
+        if not songs:
+            return
+
+        file_ids = [song["file_id"] for song in songs]
+        existing = {}
         with db.atomic():
+            for i in range(0, len(file_ids), self.BATCH_SIZE):
+                batch = file_ids[i:i + self.BATCH_SIZE]
+                query = """SELECT file_id, id, artist_name, recording_name
+                             FROM recording
+                            WHERE file_id_type = ?
+                              AND file_id IN (%s)""" % ",".join("?" * len(batch))
+                for file_id, recording_id, artist_name, recording_name in db.execute_sql(query, [FileIdType.SUBSONIC_ID.value] + batch):
+                    existing[file_id] = (recording_id, artist_name, recording_name)
+
+            new_songs = []
+            updated_songs = []
+            for song in songs:
+                if song["file_id"] not in existing:
+                    new_songs.append(song)
+                    continue
+
+                recording_id, artist_name, recording_name = existing[song["file_id"]]
+                if artist_name != song["artist_name"] or recording_name != song["recording_name"]:
+                    self.renamed_ids.add(recording_id)
+                updated_songs.append(dict(song, id=recording_id))
 
-            placeholders = ",".join(("?", ) * len(recording_index))
-            cursor.execute("""SELECT recording_id
-                                FROM recording_subsonic
-                               WHERE recording_id in (%s)""" % placeholders, tuple(recording_index.keys()))
-            existing_ids = { row[0]:None for row in cursor.fetchall() }
-            existing_recordings = []
-            new_recordings = []
-            for r in recordings:
-                if r[0] in existing_ids:
-                    existing_recordings.append((r[0], r[1], datetime.datetime.now(), r[0]))
-                else:
-                    new_recordings.append((r[0], r[1], datetime.datetime.now()))
-
-            cursor.executemany("""INSERT INTO recording_subsonic (recording_id, subsonic_id, last_updated)
-                                       VALUES (?, ?, ?)""", tuple(new_recordings))
-
-            cursor.executemany("""UPDATE recording_subsonic
-                                     SET recording_id = ?
-                                       , subsonic_id = ?
-                                       , last_updated = ?
-                                   WHERE recording_id = ?""", tuple(existing_recordings))
-
-
-        # This concise query does the same as above. But older versions of python/sqlite on Raspberry Pis 
-        # don't support upserts yet. :(
-        #recordings = [(r[0], r[1], datetime.datetime.now()) for r in recordings]
-        #cursor.executemany(
-        #    """INSERT INTO recording_subsonic (recording_id, subsonic_id, last_updated)
-        #                            VALUES (?, ?, ?)
-        #         ON CONFLICT DO UPDATE SET recording_id = excluded.recording_id
-        #                                 , subsonic_id = excluded.subsonic_id
-        #                                 , last_updated = excluded.last_updated""", recordings)
+            # insert_many takes the columns from the first row, so the rows with and without an id are inserted separately
+            for rows in (new_songs, updated_songs):
+                for batch in peewee.chunked(rows, self.INSERT_BATCH_SIZE):
+                    Recording.insert_many(batch).on_conflict_replace().execute()
 
+    def remove_subsonic_songs(self, song_ids):
+        """
+            Remove the recordings of the given subsonic song ids from the database.
+        """
+        song_ids = tuple(song_ids)
+        ids = []
+        for i in range(0, len(song_ids), self.DELETE_BATCH_SIZE):
+            query = Recording.select(Recording.id) \
+                             .where(Recording.file_id_type == FileIdType.SUBSONIC_ID) \
+                             .where(Recording.file_id.in_(song_ids[i:i + self.DELETE_BATCH_SIZE])) \
+                             .tuples()
+            ids.extend(row[0] for row in query)
+
+        self.removed += self.remove_recordings(ids)
+
+    def remove_unlisted_subsonic_songs(self, song_ids):
+        """
+            Remove the recordings of all subsonic songs that are not in the given set of song ids.
+        """
+        query = Recording.select(Recording.id, Recording.file_id) \
+                         .where(Recording.file_id_type == FileIdType.SUBSONIC_ID) \
+                         .tuples()
+        ids = [recording_id for recording_id, file_id in query if file_id not in song_ids]
 
+        self.removed += self.remove_recordings(ids)
 
     def upload_playlist(self, playlist):
         """
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+    A stand-in Subsonic API server with a generated library, for testing and benchmarking the subsonic
+    sync without a real Navidrome/Gonic/Funkwhale server. It answers the JSON API calls the sync uses and
+    can add latency to every request and fail some of them, to simulate a slow or flaky network.
+
+    Usage: python lb_content_resolver/test/fake_subsonic.py [--albums 1000] [--latency 0.05] [--port 4533]
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+import click
+
+API_VERSION = "1.16.1"
+
+
+def make_mbid(*names):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "/".join(str(n) for n in names)))
+
+
+class FakeLibrary:
+    '''
+       A generated music library: albums of songs by a number of artists, all with MBIDs. Albums
+       whose index is in albums_without_mbid only have an MBID in getAlbumInfo2, like on servers
+       that don't include MBIDs in album responses.
+    '''
+
+    def __init__(self, albums=10, songs_per_album=10, artists=3, albums_without_mbid=()):
+        self.artists = {}
+        for i in range(artists):
+            artist_id = "ar-%d" % i
+            self.artists[artist_id] = {"id": artist_id, "name": "Artist %d" % i, "musicBrainzId": make_mbid("artist", i)}
+
+        self.albums = {}
+        self.album_mbids = {}
+        for i in range(albums):
+            album_id = "al-%d" % i
+            artist = self.artists["ar-%d" % (i % artists)]
+            self.album_mbids[album_id] = make_mbid("album", i)
+            album = {
+                "id": album_id,
+                "name": "Album %d" % i,
+                "artist": artist["name"],
+                "artistId": artist["id"],
+                "songCount": songs_per_album,
+                "created": "2023-01-01T00:00:00Z",
+                "changed": "2023-01-01T00:00:00Z",
+                "song": [],
+            }
+            if i not in albums_without_mbid:
+                album["musicBrainzId"] = self.album_mbids[album_id]
+
+            for j in range(songs_per_album):
+                album["song"].append({
+                    "id": "so-%d-%d" % (i, j),
+                    "title": "Song %d of album %d" % (j, i),
+                    "album": album["name"],
+                    "albumId": album_id,
+                    "artist": artist["name"],
+                    "artistId": artist["id"],
+                    "track": j + 1,
+                    "discNumber": 1,
+                    "duration": 180 + j,
+                    "musicBrainzId": make_mbid("recording", i, j),
+                })
+            self.albums[album_id] = album
+
+    def album_list(self):
+        """ The albums without their songs, as returned by getAlbumList2 """
+        return [{k: v for k, v in album.items() if k != "song"} for album in self.albums.values()]
+
+
+class FakeSubsonicHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.handle_api(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        params = parse_qs(urlparse(self.path).query)
+        length = int(self.headers.get("Content-Length", 0))
+        params.update(parse_qs(self.rfile.read(length).decode("utf-8")))
+        self.handle_api(params)
+
+    def handle_api(self, params):
+        server = self.server.fake
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        if method.endswith(".view"):
+            method = method[:-len(".view")]
+        params = {k: v[0] for k, v in params.items()}
+
+        with server.lock:
+            server.requests[method] += 1
+            count = sum(server.requests.values())
+
+        if server.latency:
+            sleep(server.latency)
+
+        if server.fail_every and count % server.fail_every == 0:
+            self.send_error(503, "Service Unavailable")
+            return
+
+        handler = getattr(server, "api_" + method, None)
+        if handler is None:
+            self.send_json({"status": "failed", "error": {"code": 0, "message": "Unknown method %s" % method}})
+            return
+
+        try:
+            response = handler(params)
+        except KeyError as err:
+            self.send_json({"status": "failed", "error": {"code": 70, "message": "Not found: %s" % err}})
+            return
+
+        response["status"] = "ok"
+        self.send_json(response)
+
+    def send_json(self, response):
+        response["version"] = API_VERSION
+        body = json.dumps({"subsonic-response": response}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSubsonicServer:
+    '''
+       Serve a FakeLibrary with the Subsonic API on localhost, in a background thread. latency is the
+       time in seconds each request takes. If fail_every is set, every fail_every-th request fails with
+       a 503 error. requests counts the requests made for each API method.
+
+       with FakeSubsonicServer(FakeLibrary(albums=100)) as server:
+           config = server.config()
+    '''
+
+    def __init__(self, library=None, latency=0, fail_every=0, port=0):
+        self.library = library or FakeLibrary()
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.playlists = []
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), FakeSubsonicHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def config(self):
+        """ A config object to pass to SubsonicDatabase """
+
+        class Config:
+            SUBSONIC_HOST = "http://127.0.0.1"
+            SUBSONIC_USER = "user"
+            SUBSONIC_PASSWORD = "password"
+            SUBSONIC_PORT = self.port
+
+        return Config
+
+    def api_ping(self, params):
+        return {}
+
+    def api_getAlbumList2(self, params):
+        size = int(params.get("size", 10))
+        offset = int(params.get("offset", 0))
+        return {"albumList2": {"album": self.library.album_list()[offset:offset + size]}}
+
+    def api_getAlbum(self, params):
+        return {"album": self.library.albums[params["id"]]}
+
+    def api_getAlbumInfo2(self, params):
+        return {"albumInfo": {"musicBrainzId": self.library.album_mbids[params["id"]]}}
+
+    def api_getArtistInfo2(self, params):
+        artist = self.library.artists[params["id"]]
+        return {"artistInfo2": {"musicBrainzId": artist["musicBrainzId"]}}
+
+    def api_createPlaylist(self, params):
+        self.playlists.append(params)
+        return {}
+
+
+@click.command()
+@click.option("--albums", default=1000, help="Number of albums in the library")
+@click.option("--songs", default=10, help="Number of songs per album")
+@click.option("--artists", default=100, help="Number of artists")
+@click.option("--latency", default=0.05, help="Seconds each request takes")
+@click.option("--fail-every", default=0, help="Fail every Nth request with a 503 error")
+@click.option("--port", default=4533, help="Port to listen on")
+def main(albums, songs, artists, latency, fail_every, port):
+    library = FakeLibrary(albums=albums, songs_per_album=songs, artists=artists)
+    server = FakeSubsonicServer(library, latency=latency, fail_every=fail_every, port=port)
+    print("Serving %d albums on http://127.0.0.1:%d" % (albums, server.port))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+    A stand-in for the ListenBrainz bulk-tag-lookup endpoint, for testing and benchmarking the metadata
+    lookup. It returns a popularity and a few made up tags for every recording MBID it is sent, and can
+    add latency to every request and fail some of them, to simulate a slow or flaky network.
+
+    Usage: python lb_content_resolver/test/fake_tag_lookup.py [--latency 0.5] [--port 8100]
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from time import sleep
+import zlib
+
+import click
+
+TAGS = ("rock", "pop", "jazz", "electronic", "hip hop", "folk", "punk", "ambient", "soul", "metal", "trip hop", "rock 'n' roll")
+SOURCES = ("recording", "artist", "release-group")
+
+
+def tag_rows(recording_mbid):
+    """ The made up, but stable, rows returned for a recording MBID """
+    n = zlib.crc32(recording_mbid.encode("utf-8"))
+    rows = []
+    for i, source in enumerate(SOURCES):
+        rows.append({"recording_mbid": recording_mbid,
+                     "percent": (n % 1000) / 1000,
+                     "source": source,
+                     "tag": TAGS[(n >> (4 * i)) % len(TAGS)]})
+    return rows
+
+
+class FakeTagLookupHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        args = json.loads(self.rfile.read(length))
+
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+            server.connections[self.client_address] += 1
+
+        if server.latency:
+            sleep(server.latency)
+
+        if server.fail_every and count % server.fail_every == 0:
+            self.send_json(503, {"error": "Service Unavailable"})
+            return
+
+        rows = []
+        for arg in args:
+            if arg["[recording_mbid]"] not in server.unknown:
+                rows.extend(tag_rows(arg["[recording_mbid]"]))
+        self.send_json(200, rows)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTagLookupServer:
+    '''
+       Serve the bulk tag lookup on localhost, in a background thread. latency is the time in seconds
+       each request takes. If fail_every is set, every fail_every-th request fails with a 503 error.
+       requests counts the requests and connections the requests made per client connection. The MBIDs
+       in unknown get no rows, like recordings that ListenBrainz has no data for.
+
+       with FakeTagLookupServer() as server:
+           lookup = MetadataLookup(url=server.url)
+    '''
+
+    def __init__(self, latency=0, fail_every=0, port=0, unknown=()):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.unknown = set(unknown)
+        self.requests = 0
+        self.connections = Counter()
+        self.lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), FakeTagLookupHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.port = self.httpd.server_address[1]
+        self.url = "http://127.0.0.1:%d/bulk-tag-lookup/json" % self.port
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+@click.command()
+@click.option("--latency", default=0.5, help="Seconds each request takes")
+@click.option("--fail-every", default=0, help="Fail every Nth request with a 503 error")
+@click.option("--port", default=8100, help="Port to listen on")
+def main(latency, fail_every, port):
+    server = FakeTagLookupServer(latency=latency, fail_every=fail_every, port=port)
+    print("Serving %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
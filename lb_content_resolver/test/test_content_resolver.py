@@ -0,0 +1,106 @@
+import datetime
+import os
+
+import pytest
+from troi.playlist import PLAYLIST_TRACK_EXTENSION_URI
+
+from lb_content_resolver.content_resolver import ContentResolver
+from lb_content_resolver.database import Database
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, FileIdType
+from lb_content_resolver.model.resolution_cache import ResolutionCache
+from lb_content_resolver.model.state import State
+from lb_content_resolver.playlist import parse_jspf_playlist
+from lb_content_resolver.server import ResolverService
+
+
+def create_db(tmp_path, recordings):
+    database = Database(os.path.join(tmp_path, "resolver.db"))
+    database.create()
+    database.open()
+    with db.atomic():
+        for artist_name, recording_name, duration in recordings:
+            Recording.create(file_id="/music/%s/%s.flac" % (artist_name, recording_name),
+                             file_id_type=FileIdType.FILE_PATH,
+                             mtime=datetime.datetime.now(),
+                             artist_name=artist_name,
+                             recording_name=recording_name,
+                             duration=duration)
+
+
+class TestContentResolver:
+
+    def test_rerank_keeps_threshold(self, tmp_path):
+        create_db(tmp_path, [("Portishead", "Roads", 100000), ("Portishead", "Roads (live)", 300000)])
+        resolver = ContentResolver()
+        query = [{"artist_name": "Portishead", "recording_name": "Roads", "duration": 300000}]
+
+        # The second candidate matches the duration, but it is below the threshold
+        hits = resolver.rerank([{"confidence": .82, "recording_id": 1, "candidates": [(1, .82), (2, .79)]}], query, .8)
+        assert (hits[0]["recording_id"], hits[0]["confidence"]) == (1, .82)
+
+        # Among the candidates that meet the threshold, the one that matches the duration wins
+        hits = resolver.rerank([{"confidence": .82, "recording_id": 1, "candidates": [(1, .82), (2, .79)]}], query, .75)
+        assert (hits[0]["recording_id"], hits[0]["confidence"]) == (2, .79)
+        db.close()
+
+    def test_server_names(self, tmp_path):
+        create_db(tmp_path, [("Portishead", "Roads", 100000), ("None", "Roads", 100000)])
+        service = ResolverService()
+
+        response = service.resolve_recordings({"recordings": [
+            {"artist_name": "Portishead", "recording_name": "Roads"},
+            {"artist_name": None, "recording_name": "Roads"},
+        ]})
+        assert [hit["index"] for hit in response["recordings"]] == [0]
+
+        with pytest.raises(ValueError):
+            service.resolve_recordings({"recordings": [{"artist_name": 311, "recording_name": "Amber"}]})
+        db.close()
+
+    def test_resolution_cache(self, tmp_path):
+        create_db(tmp_path, [("Portishead", "Roads", 100000), ("Massive Attack", "Teardrop", 200000)])
+        resolver = ContentResolver()
+
+        def resolve(resolver, artist_name, recording_name, threshold):
+            hits_before = resolver.cache_hits
+            query = [{"artist_name": artist_name, "recording_name": recording_name,
+                      "recording_mbid": "0d9a6f7a-0fe4-4b8e-8a5c-2e0e3c6e7a01"}]
+            resolved = resolver.resolve_recordings(query, threshold)
+            return [hit["recording_id"] for hit in resolved], resolver.cache_hits > hits_before
+
+        # A miss, then a hit
+        assert resolve(resolver, "Portishead", "Roads", .8) == ([1], False)
+        assert resolve(resolver, "Portishead", "Roads", .8) == ([1], True)
+        # Entries are only reused with the same threshold
+        assert resolve(resolver, "portishead", "Roads!", .8) == ([1], True)
+        assert resolve(resolver, "portishead", "Roads!", .9) == ([1], False)
+        assert resolve(resolver, "Nobody", "Nothing", .8) == ([], False)
+        assert resolve(resolver, "Nobody", "Nothing", .8) == ([], True)
+        assert resolve(resolver, "Nobody", "Nothing", .9) == ([], False)
+        assert resolve(resolver, "Nobody", "Nothing", .5) == ([], False)
+
+        # The number of candidates and artist blocking are part of the key
+        assert resolve(ContentResolver(k=1), "Portishead", "Roads", .8) == ([1], False)
+        assert resolve(ContentResolver(artist_blocking=True), "Portishead", "Roads", .8) == ([1], False)
+
+        # Changing the collection invalidates the cache
+        State.bump_collection_version()
+        assert resolve(resolver, "Portishead", "Roads", .8) == ([1], False)
+        assert ResolutionCache.select().where(ResolutionCache.collection_version != State.collection_version()).count() == 0
+        db.close()
+
+    def test_resolve_playlist(self, tmp_path, monkeypatch):
+        create_db(tmp_path, [("Artist %d" % i, "Recording %d" % i, 1000 * i) for i in range(12)])
+        monkeypatch.setattr(ContentResolver, "BATCH_SIZE", 5)
+        tracks = [{"title": "Recording %d" % i, "creator": "Artist %d" % i,
+                   "identifier": "https://musicbrainz.org/recording/0d9a6f7a-0fe4-4b8e-8a5c-2e0e3c6e7a%02d" % i,
+                   "extension": {PLAYLIST_TRACK_EXTENSION_URI: {}}}
+                  for i in range(12)]
+        playlist = parse_jspf_playlist({"playlist": {"title": "Test", "track": tracks}})
+
+        ContentResolver().resolve_playlist(.8, playlist)
+        recordings = playlist.playlists[0].recordings
+        assert [r.musicbrainz["filename"] for r in recordings] == ["/music/Artist %d/Recording %d.flac" % (i, i) for i in range(12)]
+        assert recordings[3].duration == 3000
+        db.close()
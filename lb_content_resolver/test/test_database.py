@@ -0,0 +1,295 @@
+import datetime
+import os
+
+import pytest
+
+from lb_content_resolver.database import Database, Status, StatusDetails
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.directory import Directory
+from lb_content_resolver.model.recording import Recording, RecordingMetadata, FileIdType
+from lb_content_resolver.model.scan_cursor import ScanCursor
+from lb_content_resolver.model.state import State
+from lb_content_resolver.watcher import PollingWatcher, update_directories
+
+
+def create_music_dir(tmp_path, artists=3, albums=4, tracks=5):
+    music_dir = os.path.join(tmp_path, "music")
+    for i in range(artists):
+        for j in range(albums):
+            album_dir = os.path.join(music_dir, "artist %d" % i, "album %d" % j)
+            os.makedirs(album_dir)
+            for k in range(tracks):
+                open(os.path.join(album_dir, "%02d.flac" % k), "wb").close()
+    return music_dir
+
+
+def read_metadata(file_path, mtime):
+    """ Stands in for Database.read_metadata: the recording name is the content of the file, or its name if it is empty """
+    album_dir, file_name = os.path.split(file_path)
+    artist_dir, album_name = os.path.split(album_dir)
+    with open(file_path, "r") as f:
+        recording_name = f.read() or file_name
+    data = {"artist_mbid": None,
+            "artist_name": os.path.basename(artist_dir),
+            "disc_num": 1,
+            "file_id": file_path,
+            "file_id_type": FileIdType.FILE_PATH,
+            "mtime": mtime,
+            "recording_mbid": None,
+            "recording_name": recording_name,
+            "release_mbid": None,
+            "release_name": album_name,
+            "track_num": 1}
+    return data, StatusDetails(recording_name=recording_name, artist_name=data["artist_name"], release_name=album_name)
+
+
+def scan(tmp_path, db_name, music_dir, **kwargs):
+    """ Scan music_dir into the database db_name and return its recordings """
+    database = Database(os.path.join(tmp_path, db_name))
+    database.create()
+    database.scan([music_dir], chunksize=7, **kwargs)
+    database.open()
+    rows = sorted(Recording.select(Recording.file_id, Recording.artist_name, Recording.release_name,
+                                   Recording.recording_name, Recording.mtime).tuples())
+    db.close()
+    return rows
+
+
+class TestDatabase:
+
+    def test_resume_scan(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path)
+        db_file = os.path.join(tmp_path, "scan.db")
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+
+        read_chunks = []
+        read_metadata_and_add = Database.read_metadata_and_add
+
+        def interrupt(self, chunk):
+            read_chunks.append(len(chunk))
+            if len(read_chunks) == 4:
+                raise KeyboardInterrupt
+            return read_metadata_and_add(self, chunk)
+
+        def count(self, chunk):
+            read_chunks.append(len(chunk))
+            return read_metadata_and_add(self, chunk)
+
+        database = Database(db_file)
+        database.create()
+        with monkeypatch.context() as m:
+            m.setattr(Database, "read_metadata_and_add", interrupt)
+            with pytest.raises(KeyboardInterrupt):
+                database.scan([music_dir], chunksize=7)
+
+        # The first three chunks were added and the scan can be resumed after the last scanned directory
+        assert Recording.select().count() == 21
+        assert ScanCursor.select().count() == 1
+        assert 0 < Directory.select().count() < 16
+        db.close()
+
+        read_chunks.clear()
+        database = Database(db_file)
+        database.open()
+        with monkeypatch.context() as m:
+            m.setattr(Database, "read_metadata_and_add", count)
+            database.scan([music_dir], chunksize=7)
+
+        database.open()
+        assert Recording.select().count() == 60
+        assert Directory.select().count() == 16
+        assert ScanCursor.select().count() == 0
+        # The directories scanned before the interruption were not walked again
+        assert sum(read_chunks) == 39
+        assert database.counters.total < 60 - 14
+        db.close()
+
+    def test_watch_updates(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path, artists=1, albums=2, tracks=3)
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        database = Database(os.path.join(tmp_path, "watch.db"))
+        database.create()
+        database.scan([music_dir])
+        database.open()
+
+        watcher = PollingWatcher(database, database.music_dirs)
+        assert watcher.changed_directories() == set()
+
+        # Retag a file that has metadata and add a file, which changes the directory
+        album_dir = os.path.join(music_dir, "artist 0", "album 1")
+        file_path = os.path.join(album_dir, "01.flac")
+        recording = Recording.get(Recording.file_id == file_path)
+        RecordingMetadata.create(recording=recording, popularity=.5)
+        with open(file_path, "w") as f:
+            f.write("Retagged")
+        open(os.path.join(album_dir, "03.flac"), "wb").close()
+        later = datetime.datetime.now().timestamp() + 10
+        os.utime(file_path, (later, later))
+        os.utime(album_dir, (later, later))
+
+        changed = watcher.changed_directories()
+        assert changed == {album_dir}
+        database.update_directories(changed)
+
+        # The recording keeps its id and metadata
+        retagged = Recording.get(Recording.file_id == file_path)
+        assert retagged.id == recording.id
+        assert retagged.recording_name == "Retagged"
+        assert database.renamed_ids == {recording.id}
+        assert RecordingMetadata.get().recording_id == recording.id
+        assert Recording.select().count() == 7
+        assert watcher.changed_directories() == set()
+        db.close()
+
+    def test_watch_errors(self):
+        class FailingDatabase:
+            def update_directories(self, changed):
+                raise OSError("disk on fire")
+
+        # The error is reported, the watcher keeps going
+        update_directories(FailingDatabase(), {"/music"})
+
+    def test_prefetch_scan(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path)
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        expected = scan(tmp_path, "scan.db", music_dir)
+        assert len(expected) == 60
+
+        statuses = {}
+
+        def update_status(self, statusdata):
+            statuses[self.recording_mtimes is not None].append((statusdata.status, statusdata.details))
+
+        # Rescan a changed directory, with and without prefetching the known recordings
+        album_dir = os.path.join(music_dir, "artist 1", "album 2")
+        for prefetch in (False, True):
+            statuses[prefetch] = []
+            os.utime(album_dir, (prefetch + 1, prefetch + 1))
+            with monkeypatch.context() as m:
+                m.setattr(Database, "update_status", update_status)
+                assert scan(tmp_path, "scan.db", music_dir, prefetch=prefetch) == expected
+
+        assert statuses[True] == statuses[False]
+        assert len(statuses[True]) == 5
+        assert statuses[True][0] == (Status.NOCHANGE, StatusDetails(recording_name="00.flac", artist_name="artist 1",
+                                                                   release_name="album 2"))
+
+    def test_worker_scan(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path)
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        expected = scan(tmp_path, "serial.db", music_dir)
+        assert len(expected) == 60
+
+        # The metadata is read by worker processes, the result is the same
+        assert scan(tmp_path, "workers.db", music_dir, workers=3) == expected
+
+    def test_stream_scan(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path)
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        expected = scan(tmp_path, "serial.db", music_dir)
+
+        # The directories are walked while the files are scanned, the result is the same
+        assert scan(tmp_path, "stream.db", music_dir, stream=True) == expected
+        assert scan(tmp_path, "stream.db", music_dir, stream=True) == expected
+
+    def test_prune_scan(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path)
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        expected = scan(tmp_path, "prune.db", music_dir, prune=True)
+        assert expected == scan(tmp_path, "serial.db", music_dir)
+
+        # A new album of an existing artist is missed, since the music directory didn't change
+        album_dir = os.path.join(music_dir, "artist 0", "album 9")
+        os.makedirs(album_dir)
+        open(os.path.join(album_dir, "00.flac"), "wb").close()
+        os.utime(os.path.join(music_dir, "artist 0"), (1, 1))
+        assert scan(tmp_path, "prune.db", music_dir, prune=True) == expected
+
+        # Adding an artist changes the music directory, so the changed artist directories are walked again
+        artist_dir = os.path.join(music_dir, "artist 9")
+        os.makedirs(os.path.join(artist_dir, "album 0"))
+        open(os.path.join(artist_dir, "album 0", "00.flac"), "wb").close()
+        os.utime(music_dir, (1, 1))
+        file_ids = [row[0] for row in scan(tmp_path, "prune.db", music_dir, prune=True)]
+        assert len(file_ids) == 62
+        assert os.path.join(album_dir, "00.flac") in file_ids
+        assert os.path.join(artist_dir, "album 0", "00.flac") in file_ids
+
+        # Files of a removed album are removed by a cleanup of the changed directories
+        album_dir = os.path.join(music_dir, "artist 2", "album 3")
+        for file_name in os.listdir(album_dir):
+            os.unlink(os.path.join(album_dir, file_name))
+        os.rmdir(album_dir)
+        os.utime(os.path.join(music_dir, "artist 2"), (2, 2))
+        assert len(scan(tmp_path, "prune.db", music_dir, prune=True)) == 62
+
+        database = Database(os.path.join(tmp_path, "prune.db"))
+        database.open()
+        database.database_cleanup(dry_run=False, changed_only=True)
+        assert Recording.select().count() == 57
+        assert not Recording.select().where(Recording.file_id.startswith(os.path.join(album_dir, ""))).exists()
+        assert not Directory.select().where(Directory.dir_path == album_dir).exists()
+        db.close()
+
+    def test_walk(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path, artists=2, albums=2, tracks=3)
+        album_dir = os.path.join(music_dir, "artist 1", "album 0")
+        open(os.path.join(album_dir, "cover.jpg"), "wb").close()
+        # Symlinked files are scanned once, under their real path, symlinked directories aren't followed
+        os.symlink(os.path.join(album_dir, "00.flac"), os.path.join(music_dir, "link.flac"))
+        os.symlink(album_dir, os.path.join(music_dir, "artist 0", "linked album"))
+        os.symlink(os.path.join(album_dir, "missing.flac"), os.path.join(album_dir, "broken.flac"))
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+
+        # The files are found as os.walk finds them, with the same modification times
+        expected = []
+        for root, dirs, files in os.walk(music_dir):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                if file_name.endswith(".flac") and not os.path.islink(file_path):
+                    expected.append((file_path, datetime.datetime.fromtimestamp(int(os.stat(file_path).st_mtime))))
+
+        rows = scan(tmp_path, "walk.db", music_dir)
+        assert sorted((row[0], row[4]) for row in rows) == sorted(expected)
+        assert len(rows) == 12
+
+    def test_cleanup(self, tmp_path, monkeypatch):
+        music_dir = create_music_dir(tmp_path, artists=1, albums=3, tracks=3)
+        album_dirs = [os.path.join(music_dir, "artist 0", "album %d" % i) for i in range(3)]
+        for album_dir in album_dirs:
+            os.utime(album_dir, (1, 1))
+        monkeypatch.setattr(Database, "read_metadata", staticmethod(read_metadata))
+        scan(tmp_path, "cleanup.db", music_dir)
+
+        database = Database(os.path.join(tmp_path, "cleanup.db"))
+        database.open()
+
+        # A dry run only lists the missing files, --remove deletes them
+        os.unlink(os.path.join(album_dirs[0], "00.flac"))
+        database.database_cleanup(dry_run=True)
+        assert Recording.select().count() == 9
+        assert State.get_value("last_cleanup") is None
+        database.database_cleanup(dry_run=False)
+        assert Recording.select().count() == 8
+        assert not Recording.select().where(Recording.file_id == os.path.join(album_dirs[0], "00.flac")).exists()
+
+        checked = []
+        isfile = os.path.isfile
+
+        def check(path):
+            checked.append(path)
+            return isfile(path)
+
+        # Only the files of directories that changed are checked, a file removed from a directory
+        # whose modification time was restored is missed
+        os.unlink(os.path.join(album_dirs[1], "00.flac"))
+        os.utime(album_dirs[1], (1, 1))
+        os.unlink(os.path.join(album_dirs[2], "00.flac"))
+        monkeypatch.setattr(os.path, "isfile", check)
+        database.database_cleanup(dry_run=False, changed_only=True)
+        assert sorted(checked) == [os.path.join(album_dirs[0], "01.flac"), os.path.join(album_dirs[0], "02.flac"),
+                                   os.path.join(album_dirs[2], "00.flac"), os.path.join(album_dirs[2], "01.flac"),
+                                   os.path.join(album_dirs[2], "02.flac")]
+        assert Recording.select().count() == 7
+        assert Recording.select().where(Recording.file_id == os.path.join(album_dirs[1], "00.flac")).exists()
+        db.close()
@@ -0,0 +1,135 @@
+import datetime
+import os
+import re
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
+from unidecode import unidecode
+
+from lb_content_resolver.database import Database
+from lb_content_resolver.fuzzy_backends import SearchBackend
+from lb_content_resolver.fuzzy_index import FuzzyIndex, count_trigrams, encode_string, encode_strings, ngrams
+from lb_content_resolver.fuzzy_index_store import FuzzyIndexStore
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, FileIdType
+from lb_content_resolver.model.state import State
+
+NAMES = ["Portishead", "Roads", "Björk", "Jóga", "!!!", "", "Sigur Rós", "Hoppípolla", "坂本龍一", "戦場のメリークリスマス",
+         "Мумий Тролль", "Guns N' Roses", "AC/DC", "The  The", "a", "ab", "Portishead", "Motörhead", "under_score", "\tTab"]
+
+
+def create_db(tmp_path, count):
+    database = Database(os.path.join(tmp_path, "index.db"))
+    database.create()
+    database.open()
+    add_recordings(0, count)
+
+
+def add_recordings(start, end):
+    with db.atomic():
+        for i in range(start, end):
+            Recording.create(file_id="/music/%d.flac" % i,
+                             file_id_type=FileIdType.FILE_PATH,
+                             mtime=datetime.datetime.now(),
+                             artist_name="Artist %d" % (i % 7),
+                             recording_name="Recording number %d" % (i % 100))
+    State.bump_collection_version()
+
+
+def search(index, artist_name, recording_name):
+    hit = index.search([{"artist_name": artist_name, "recording_name": recording_name}])[0]
+    return hit["recording_id"], hit["confidence"]
+
+
+def old_encode_string(text):
+    return unidecode(re.sub(" +", "", re.sub(r'[^\w ]+', '', text)).strip().lower())
+
+
+class TestFuzzyIndex:
+
+    def test_encode_string(self):
+        for name in NAMES:
+            assert encode_string(name) == old_encode_string(name), name
+        assert encode_strings(NAMES) == [old_encode_string(name) for name in NAMES]
+
+    def test_count_trigrams(self):
+        lookup_strings = [artist + recording for artist, recording in zip(encode_strings(NAMES), encode_strings(NAMES[::-1]))]
+        lookup_strings += encode_strings(NAMES)
+
+        vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
+        expected = vectorizer.fit_transform(lookup_strings)
+
+        counts, vocabulary = count_trigrams(lookup_strings)
+        matrix = TfidfTransformer().fit_transform(counts)
+
+        assert vocabulary == list(vectorizer.get_feature_names_out())
+        assert matrix.shape == expected.shape
+        assert np.abs((matrix - expected).toarray()).max() < 1e-12
+
+    def test_update(self, tmp_path, monkeypatch):
+        create_db(tmp_path, 100)
+        store = FuzzyIndexStore()
+        index = store.load()
+        assert len(index.lookup_ids) == 100
+
+        # Nothing changed, so the saved index isn't loaded
+        def fail(*args, **kwargs):
+            raise AssertionError("the index was loaded")
+        with monkeypatch.context() as m:
+            m.setattr(FuzzyIndex, "load", fail)
+            store.update()
+
+        # Add, remove and rename a few recordings
+        add_recordings(100, 103)
+        Recording.delete().where(Recording.id.in_((1, 2))).execute()
+        Recording.update(recording_name="Recording number 17").where(Recording.id == 3).execute()
+        State.bump_collection_version()
+        store.update(changed_ids={3})
+
+        index = FuzzyIndex()
+        assert index.load(store.get_index_dir(), State.collection_version())
+        assert index.version == State.collection_version()
+        assert sorted(index.lookup_ids.tolist()) == list(range(3, 104))
+        assert index.changed_rows == 7
+        assert index.fitted_rows == 100
+        assert not index.needs_refit()
+
+        assert search(index, "Artist 4", "Recording number 2")[0] == 103
+        assert search(index, "Artist 2", "Recording number 17")[0] == 3
+        assert search(index, "Artist 1", "Recording number 1")[0] != 2
+        db.close()
+
+    def test_update_refits(self, tmp_path):
+        create_db(tmp_path, 100)
+        store = FuzzyIndexStore()
+        store.load()
+
+        # More than REFIT_CHANGED_FRACTION of the rows were added, so the index is built from scratch
+        add_recordings(100, 115)
+        store.update()
+        index = FuzzyIndex()
+        assert index.load(store.get_index_dir(), State.collection_version())
+        assert (index.fitted_rows, index.changed_rows) == (115, 0)
+        db.close()
+
+    def test_needs_refit(self):
+        index = FuzzyIndex(backend="scipy")
+        index.build([("Artist %d" % i, "Recording %d" % i, i) for i in range(100)])
+        assert not index.needs_refit()
+
+        index.update([("Artist 10", "Recording 10", 1000)], {1, 2})
+        assert index.changed_rows == 3
+        assert not index.needs_refit()
+
+        # Most trigrams of these names are not in the vocabulary
+        index.update([("Zyxwv", "Qqqjjj", 1001)], ())
+        assert index.unknown_terms > FuzzyIndex.REFIT_UNKNOWN_FRACTION * index.added_terms
+        assert index.needs_refit()
+
+    def test_incomplete_backend(self):
+        class IncompleteBackend(SearchBackend):
+            name = "incomplete"
+
+        with pytest.raises(TypeError):
+            IncompleteBackend(None, [])
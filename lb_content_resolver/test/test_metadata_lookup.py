@@ -0,0 +1,112 @@
+import datetime
+import os
+import uuid
+
+from lb_content_resolver.database import Database
+from lb_content_resolver.metadata_lookup import MetadataLookup
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, RecordingMetadata, RecordingLookup, FileIdType
+from lb_content_resolver.model.tag import RecordingTag
+from lb_content_resolver.test.fake_tag_lookup import FakeTagLookupServer
+
+
+def create_db(tmp_path, recordings):
+    database = Database(os.path.join(tmp_path, "metadata.db"))
+    database.create()
+    database.open()
+    add_recordings(0, recordings)
+
+
+def add_recordings(start, end):
+    rows = [{"file_id": "/music/%d.flac" % i,
+             "file_id_type": FileIdType.FILE_PATH,
+             "mtime": datetime.datetime.now(),
+             "recording_name": "Recording %d" % i,
+             "recording_mbid": str(uuid.uuid4())} for i in range(start, end)]
+    with db.atomic():
+        for i in range(0, len(rows), 50):
+            Recording.insert_many(rows[i:i + 50]).execute()
+
+
+class SmallBatchMetadataLookup(MetadataLookup):
+    BATCH_SIZE = 4
+    RETRY_BACKOFF = 0
+
+
+class TestMetadataLookup:
+
+    def test_lookup(self, tmp_path):
+        create_db(tmp_path, 25)
+        with FakeTagLookupServer(fail_every=3) as server:
+            lookup = SmallBatchMetadataLookup(url=server.url, concurrency=3)
+            lookup.lookup()
+            assert RecordingMetadata.select().count() == 25
+            assert RecordingTag.select().count() == 75
+
+            # Looking up again replaces the metadata and tags
+            lookup.lookup()
+            # The connections are kept alive
+            assert len(server.connections) <= 3
+
+        assert RecordingMetadata.select().count() == 25
+        assert RecordingTag.select().count() == 75
+        db.close()
+
+    def test_refresh_policies(self, tmp_path):
+        create_db(tmp_path, 8)
+        with FakeTagLookupServer() as server:
+            lookup = SmallBatchMetadataLookup(url=server.url)
+            lookup.lookup(refresh="missing")
+            assert server.requests == 2
+
+            # Nothing is missing or stale
+            lookup.lookup(refresh="missing")
+            lookup.lookup(refresh="stale")
+            assert server.requests == 2
+
+            # Only the new recordings are missing
+            add_recordings(8, 10)
+            lookup.lookup(refresh="missing")
+            assert server.requests == 3
+            assert RecordingMetadata.select().count() == 10
+
+            # The metadata of a few recordings is older than max_age
+            old = datetime.datetime.now() - datetime.timedelta(days=10)
+            RecordingMetadata.update(last_updated=old).where(RecordingMetadata.recording << (1, 2, 3)).execute()
+            lookup.lookup(refresh="stale", max_age=5)
+            assert server.requests == 4
+            assert RecordingMetadata.select().where(RecordingMetadata.last_updated < old + datetime.timedelta(days=1)).count() == 0
+
+            # Only the recordings added since the last lookup are new, whatever their mtime
+            lookup.lookup(refresh="new")
+            assert server.requests == 4
+            add_recordings(10, 15)
+            Recording.update(mtime=old).execute()
+            lookup.lookup(refresh="new")
+            assert server.requests == 6
+            assert RecordingMetadata.select().count() == 15
+
+        db.close()
+
+    def test_lookup_without_metadata(self, tmp_path):
+        create_db(tmp_path, 4)
+        unknown = Recording.get_by_id(2)
+        with FakeTagLookupServer(unknown=[unknown.recording_mbid]) as server:
+            lookup = SmallBatchMetadataLookup(url=server.url)
+            lookup.lookup(refresh="missing")
+            assert server.requests == 1
+            assert RecordingMetadata.select().count() == 3
+            assert RecordingLookup.select().count() == 4
+
+            # The recording without metadata was looked up recently, so it isn't looked up again
+            lookup.lookup(refresh="missing")
+            lookup.lookup(refresh="stale")
+            assert server.requests == 1
+
+            # Until the lookup is older than max_age
+            old = datetime.datetime.now() - datetime.timedelta(days=10)
+            RecordingLookup.update(last_updated=old).where(RecordingLookup.recording == unknown.id).execute()
+            lookup.lookup(refresh="missing", max_age=5)
+            assert server.requests == 2
+
+        db.close()
@@ -0,0 +1,47 @@
+from http.client import HTTPConnection
+import json
+import threading
+from time import monotonic
+
+from lb_content_resolver.model.database import db
+from lb_content_resolver.server import ResolverHTTPServer, ResolverRequestHandler, ResolverService
+from lb_content_resolver.test.test_content_resolver import create_db
+
+
+class TestServer:
+
+    def test_keep_alive_clients(self, tmp_path, monkeypatch):
+        create_db(tmp_path, [("Portishead", "Roads", 100000)])
+        monkeypatch.setattr(ResolverRequestHandler, "timeout", 1)
+        server = ResolverHTTPServer(("127.0.0.1", 0), ResolverRequestHandler)
+        server.service = ResolverService()
+        server.start_pool(2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def status(conn):
+            conn.request("GET", "/status")
+            response = conn.getresponse()
+            assert response.status == 200
+            return json.loads(response.read())
+
+        # More idle keep-alive clients than pool threads
+        port = server.server_address[1]
+        idle = [HTTPConnection("127.0.0.1", port, timeout=10) for _ in range(3)]
+        started = monotonic()
+        for conn in idle:
+            assert status(conn)["recordings"] == 1
+
+        # Once the idle connections time out, other clients get in
+        conn = HTTPConnection("127.0.0.1", port, timeout=10)
+        assert status(conn)["recordings"] == 1
+        assert monotonic() - started < 5
+
+        # Closing the server doesn't wait for clients that are still connected
+        busy = [HTTPConnection("127.0.0.1", port, timeout=10) for _ in range(2)]
+        for conn in busy:
+            status(conn)
+        server.shutdown()
+        started = monotonic()
+        server.server_close()
+        assert monotonic() - started < .5
+        db.close()
@@ -0,0 +1,151 @@
+import datetime
+import json
+import os
+
+import pytest
+
+from lb_content_resolver.model.database import db
+from lb_content_resolver.model.recording import Recording, RecordingMetadata
+from lb_content_resolver.model.subsonic_album import SubsonicAlbum
+from lb_content_resolver.model.subsonic_artist import SubsonicArtist
+from lb_content_resolver.subsonic import SubsonicDatabase
+from lb_content_resolver.test.fake_subsonic import FakeLibrary, FakeSubsonicServer
+
+
+def sync(tmp_path, server, concurrency=4, incremental=False):
+    subsonic_db = SubsonicDatabase(os.path.join(tmp_path, "subsonic.db"), server.config())
+    subsonic_db.RETRY_DELAY = .01
+    subsonic_db.create()
+    subsonic_db.open()
+    subsonic_db.sync(concurrency=concurrency, incremental=incremental)
+    return subsonic_db
+
+
+class TestSubsonicSync:
+
+    def test_sync(self, tmp_path):
+        library = FakeLibrary(albums=20, songs_per_album=3, artists=4, albums_without_mbid=(5, ))
+        with FakeSubsonicServer(library, fail_every=7) as server:
+            subsonic_db = sync(tmp_path, server)
+
+        assert subsonic_db.total == 20
+        assert subsonic_db.matched == 20
+        assert subsonic_db.error == 0
+        assert Recording.select().count() == 60
+        recording = Recording.get(Recording.file_id == "so-5-1")
+        assert recording.release_mbid == library.album_mbids["al-5"]
+        assert recording.artist_mbid == library.artists["ar-1"]["musicBrainzId"]
+        db.close()
+
+    def test_sync_again(self, tmp_path):
+        library = FakeLibrary(albums=5, songs_per_album=2)
+        with FakeSubsonicServer(library) as server:
+            sync(tmp_path, server)
+            recording = Recording.get(Recording.file_id == "so-0-0")
+            RecordingMetadata.create(recording=recording, popularity=.5)
+            library.albums["al-0"]["song"][0]["title"] = "Renamed"
+            subsonic_db = sync(tmp_path, server, concurrency=1)
+
+        assert Recording.select().count() == 10
+        # Updated recordings keep their id
+        renamed = Recording.get(Recording.file_id == "so-0-0")
+        assert renamed.id == recording.id
+        assert renamed.recording_name == "Renamed"
+        assert subsonic_db.renamed_ids == {recording.id}
+        assert RecordingMetadata.get().recording_id == recording.id
+        # Every artist is looked up only once, the second sync uses the stored artist MBIDs
+        assert server.requests["getArtistInfo2"] == 3
+        db.close()
+
+    def test_incremental_sync(self, tmp_path):
+        library = FakeLibrary(albums=5, songs_per_album=3)
+        with FakeSubsonicServer(library) as server:
+            sync(tmp_path, server)
+            assert server.requests["getAlbum"] == 5
+
+            # Nothing changed
+            subsonic_db = sync(tmp_path, server, incremental=True)
+            assert subsonic_db.total == 0
+            assert server.requests["getAlbum"] == 5
+
+            # A song was removed from an album and another album was removed
+            album = library.albums["al-1"]
+            album["song"].pop()
+            album["songCount"] = 2
+            album["changed"] = "2024-01-01T00:00:00Z"
+            del library.albums["al-3"]
+            subsonic_db = sync(tmp_path, server, incremental=True)
+
+        assert subsonic_db.total == 1
+        assert server.requests["getAlbum"] == 6
+        assert subsonic_db.removed == 4
+        assert Recording.select().count() == 11
+        assert not Recording.select().where(Recording.file_id.in_(("so-1-2", "so-3-0"))).exists()
+        db.close()
+
+    def test_incremental_sync_retries_errors(self, tmp_path):
+        library = FakeLibrary(albums=6, songs_per_album=2, artists=3)
+        library.artists["ar-1"]["musicBrainzId"] = None
+        with FakeSubsonicServer(library) as server:
+            subsonic_db = sync(tmp_path, server)
+            assert subsonic_db.error == 4
+            assert Recording.select().count() == 8
+            assert SubsonicAlbum.get(SubsonicAlbum.album_id == "al-1").fingerprint == ""
+
+            # The albums with errors are fetched again
+            subsonic_db = sync(tmp_path, server, incremental=True)
+            assert subsonic_db.total == 2
+            assert server.requests["getAlbum"] == 8
+
+            # Once the artist without an MBID is looked up again, its songs are added
+            library.artists["ar-1"]["musicBrainzId"] = "8f6bd1e4-fbe1-4f50-aa9b-94c450ec0f11"
+            SubsonicArtist.update(last_updated=datetime.datetime(2000, 1, 1)).execute()
+            subsonic_db = sync(tmp_path, server, incremental=True)
+            assert subsonic_db.error == 0
+
+            subsonic_db = sync(tmp_path, server, incremental=True)
+            assert subsonic_db.total == 0
+
+        assert Recording.select().count() == 12
+        db.close()
+
+    def test_interrupted_sync(self, tmp_path, monkeypatch):
+        library = FakeLibrary(albums=3, songs_per_album=3)
+        with FakeSubsonicServer(library) as server:
+            sync(tmp_path, server)
+            album = library.albums["al-1"]
+            album["song"].pop()
+            album["songCount"] = 2
+
+            def interrupt(self, song_ids):
+                raise KeyboardInterrupt
+
+            with monkeypatch.context() as m:
+                m.setattr(SubsonicDatabase, "remove_subsonic_songs", interrupt)
+                with pytest.raises(KeyboardInterrupt):
+                    sync(tmp_path, server, incremental=True)
+
+            # The album still lists the removed song, so the next sync removes it
+            assert len(json.loads(SubsonicAlbum.get(SubsonicAlbum.album_id == "al-1").song_ids)) == 3
+            subsonic_db = sync(tmp_path, server, incremental=True)
+
+        assert subsonic_db.removed == 1
+        assert not Recording.select().where(Recording.file_id == "so-1-2").exists()
+        db.close()
+
+    def test_full_sync_removes_unlisted_songs(self, tmp_path):
+        library = FakeLibrary(albums=4, songs_per_album=2)
+        with FakeSubsonicServer(library) as server:
+            sync(tmp_path, server)
+
+            # Recordings synced before the albums were stored are only removed by a full sync
+            SubsonicAlbum.delete().execute()
+            del library.albums["al-2"]
+            subsonic_db = sync(tmp_path, server, incremental=True)
+            assert subsonic_db.removed == 0
+            subsonic_db = sync(tmp_path, server)
+
+        assert subsonic_db.removed == 2
+        assert Recording.select().count() == 6
+        assert not Recording.select().where(Recording.file_id.in_(("so-2-0", "so-2-1"))).exists()
+        db.close()
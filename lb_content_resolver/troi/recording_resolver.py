@@ -37,9 +37,9 @@ class RecordingResolverElement(Element):
 
             lookup_data.append({"artist_name": recording.artist.name,
                                 "recording_name": recording.name,
-                                "recording_mbid": recording.mbid})
-
-        self.resolve.build_index()
+                                "recording_mbid": recording.mbid,
+                                "release_name": recording.release.name if recording.release else None,
+                                "duration": recording.duration})
 
         # Resolve the recordings
         resolved = self.resolve.resolve_recordings(lookup_data, self.match_threshold)
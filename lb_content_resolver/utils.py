@@ -1,4 +1,8 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
+import threading
 
 from troi.splitter import plist
 from troi import Recording as TroiRecording
@@ -103,3 +107,85 @@ def existing_dirs(paths):
         abspath = os.path.abspath(path)
         if os.path.isdir(abspath):
             yield abspath
+
+
+def scandir_walk(top):
+    """
+        Walk the directory tree below top, depth first and in sorted order. Like os.walk, yield
+        a (dir_path, dir_names, file_entries) tuple for each directory, where file_entries are
+        the os.DirEntry objects of everything that isn't a directory, so that the cached
+        file type and stat information can be used by the caller. Symlinked directories
+        are not followed. Entries can be removed from dir_names to prune the walk.
+    """
+    stack = [top]
+    while stack:
+        dir_path = stack.pop()
+        dir_names = []
+        file_entries = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        dir_names.append(entry.name)
+                    else:
+                        file_entries.append(entry)
+        except OSError:
+            continue
+
+        dir_names.sort()
+        file_entries.sort(key=lambda entry: entry.name)
+        yield dir_path, dir_names, file_entries
+
+        stack.extend(os.path.join(dir_path, name) for name in reversed(dir_names))
+
+
+def background_iterator(iterable, maxsize=1000):
+    """
+        Iterate over iterable in a background thread and yield its items as they become
+        available. At most maxsize items are buffered. Exceptions raised in the background
+        thread are raised again in the consuming thread.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as err:
+            items.put((done, err))
+            return
+        items.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    while True:
+        item, err = items.get()
+        if err is not None:
+            raise err
+        if item is done:
+            break
+        yield item
+
+
+def threaded_map(func, iterable, threads=8):
+    """
+        Like map, but call func from a pool of threads. This is useful for functions that wait
+        on I/O, like stat calls on network file systems. Results are yielded in order as soon as
+        they are available and only a few items per thread are queued at a time, so long
+        iterables are streamed rather than submitted all at once.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= threads * 4:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
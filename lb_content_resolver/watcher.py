@@ -0,0 +1,163 @@
+import os
+from time import sleep
+import datetime
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from lb_content_resolver.utils import scandir_walk
+
+DEFAULT_POLL_INTERVAL = 60
+
+
+def update_directories(database, changed):
+    """
+        Pass the changed directories on to Database.update_directories. Errors are reported, but they
+        don't stop the watcher: the directories are checked again the next time they change.
+    """
+    try:
+        database.update_directories(changed)
+    except Exception as err:
+        print("Failed to update %d changed directories: %s" % (len(changed), err))
+
+
+class InotifyWatcher:
+    '''
+    Watch music directories for changes using inotify (Linux only), and pass the directories
+    that changed on to Database.update_directories.
+    '''
+
+    # Wait for this many seconds without events before processing changes, so that
+    # copying a whole album is processed in one go.
+    SETTLE_TIME = 2.0
+
+    def __init__(self, database, music_dirs):
+        self.database = database
+        self.music_dirs = music_dirs
+        self.inotify = INotify()
+        self.mask = flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO | \
+                    flags.ATTRIB | flags.DELETE_SELF
+        # maps watch descriptors to directory paths
+        self.watches = {}
+
+    @classmethod
+    def create(cls, database, music_dirs):
+        """
+            Create a watcher with watches on all directories, or return None if inotify is not available.
+        """
+        if INotify is None:
+            return None
+
+        try:
+            watcher = cls(database, music_dirs)
+            for music_dir in music_dirs:
+                watcher.add_watches(music_dir)
+        except OSError as err:
+            print("Cannot set up inotify watches: %s" % err)
+            return None
+
+        return watcher
+
+    def add_watches(self, top):
+        """
+            Add watches for top and all directories below it and return the list of those directories.
+        """
+        dir_paths = []
+        for dir_path, _, _ in scandir_walk(top):
+            wd = self.inotify.add_watch(dir_path, self.mask)
+            self.watches[wd] = dir_path
+            dir_paths.append(dir_path)
+
+        return dir_paths
+
+    def read_events(self):
+        """
+            Block until events arrive and then keep reading until things settle down.
+        """
+        events = self.inotify.read()
+        while True:
+            more = self.inotify.read(timeout=int(self.SETTLE_TIME * 1000))
+            if not more:
+                return events
+            events.extend(more)
+
+    def run(self):
+        while True:
+            changed = set()
+            for event in self.read_events():
+                if event.mask & flags.Q_OVERFLOW:
+                    # We lost events, so check everything
+                    for music_dir in self.music_dirs:
+                        changed.update(dir_path for dir_path, _, _ in scandir_walk(music_dir))
+                    continue
+
+                if event.mask & flags.IGNORED:
+                    self.watches.pop(event.wd, None)
+                    continue
+
+                dir_path = self.watches.get(event.wd)
+                if dir_path is None:
+                    continue
+
+                changed.add(dir_path)
+                if event.mask & flags.ISDIR:
+                    path = os.path.join(dir_path, event.name)
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        try:
+                            changed.update(self.add_watches(path))
+                        except OSError as err:
+                            print("Cannot watch %r: %s" % (path, err))
+                    elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                        changed.add(path)
+
+            if changed:
+                update_directories(self.database, changed)
+
+
+class PollingWatcher:
+    '''
+    Check music directories for changes every interval seconds, by comparing the modification
+    time of all directories to the ones stored in the database, and pass the directories
+    that changed on to Database.update_directories.
+
+    Unlike inotify, this doesn't notice files that were changed in place (e.g. retagged),
+    since that doesn't change the modification time of the directory.
+    '''
+
+    def __init__(self, database, music_dirs, interval=DEFAULT_POLL_INTERVAL):
+        self.database = database
+        self.music_dirs = music_dirs
+        self.interval = interval
+
+    def changed_directories(self):
+        """
+            Return the directories that were added, removed or changed since they were last scanned.
+        """
+        known = self.database.load_directory_mtimes()
+        changed = set()
+        seen = set()
+        for music_dir in self.music_dirs:
+            for dir_path, _, _ in scandir_walk(music_dir):
+                seen.add(dir_path)
+                try:
+                    mtime = datetime.datetime.fromtimestamp(os.stat(dir_path)[8])
+                except OSError:
+                    continue
+                if known.get(dir_path) != mtime:
+                    changed.add(dir_path)
+
+        prefixes = tuple(os.path.join(music_dir, "") for music_dir in self.music_dirs)
+        for dir_path in known:
+            if dir_path not in seen and (dir_path in self.music_dirs or dir_path.startswith(prefixes)):
+                changed.add(dir_path)
+
+        return changed
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            changed = self.changed_directories()
+            if changed:
+                update_directories(self.database, changed)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from multiprocessing import freeze_support
 import os
 import sys
 
@@ -18,6 +19,8 @@ from lb_content_resolver.artist_search import LocalRecordingSearchByArtistServic
 from lb_content_resolver.troi.periodic_jams import LocalPeriodicJams
 from lb_content_resolver.playlist import read_jspf_playlist, write_m3u_playlist, write_jspf_playlist
 from lb_content_resolver.unresolved_recording import UnresolvedRecordingTracker
+from lb_content_resolver import server
+from lb_content_resolver.fuzzy_backends import BACKENDS, get_backend, set_default_backend
 from troi.playlist import PLAYLIST_TRACK_EXTENSION_URI
 
 try:
@@ -98,8 +101,16 @@ def music_directories_from_config():
 
 
 @click.group()
-def cli():
-    pass
+@click.option("-b", "--backend", help="Fuzzy index search backend: nmslib or scipy (default: nmslib if installed)",
+              type=click.Choice(list(BACKENDS)), required=False)
+def cli(backend):
+    backend = backend or getattr(config, "FUZZY_INDEX_BACKEND", None) or None
+    try:
+        set_default_backend(backend)
+        get_backend()
+    except ValueError as err:
+        print(err)
+        sys.exit(-1)
 
 
 @click.command()
@@ -115,8 +126,20 @@ def create(db_file):
 @click.option("-d", "--db_file", help="Database file for the local collection", required=False, is_flag=False)
 @click.option('-c', '--chunksize', default=DEFAULT_CHUNKSIZE, help="Number of files to add/update at once")
 @click.option("-f", "--force", required=False, is_flag=True, default=False, help="Force scanning, ignoring any cache")
+@click.option('-w', '--workers', default=1, help="Number of processes used to read metadata from files")
+@click.option("-s", "--stream", required=False, is_flag=True, default=False,
+              help="Process files while walking the directories, instead of counting them first")
+@click.option("-p", "--prune", required=False, is_flag=True, default=False,
+              help="Skip the subdirectories of unchanged directories. Fast, but misses changes deeper in the tree")
+@click.option("--prefetch", required=False, is_flag=True, default=False,
+              help="Load the modification times of all known files at once, instead of querying them in chunks")
+@click.option("--watch", required=False, is_flag=True, default=False,
+              help="After scanning, keep watching the directories and update the database when files change")
+@click.option("--poll-interval", required=False, type=int, default=None,
+              help="Check for changes every N seconds in watch mode, instead of using inotify")
 @click.argument('music_dirs', nargs=-1, type=click.Path())
-def scan(db_file, music_dirs, chunksize=DEFAULT_CHUNKSIZE, force=False):
+def scan(db_file, music_dirs, chunksize=DEFAULT_CHUNKSIZE, force=False, workers=1, stream=False, prune=False, prefetch=False,
+         watch=False, poll_interval=None):
     """Scan one or more directories and their subdirectories for music files to add to the collection.
        If no path is passed, check for MUSIC_DIRECTORIES in config instead.
     """
@@ -125,7 +148,11 @@ def scan(db_file, music_dirs, chunksize=DEFAULT_CHUNKSIZE, force=False):
     db.open()
     if not music_dirs:
         music_dirs = music_directories_from_config()
-    db.scan(music_dirs, chunksize=chunksize, force=force)
+    if watch:
+        db.watch(music_dirs, chunksize=chunksize, workers=workers, poll_interval=poll_interval)
+    else:
+        db.scan(music_dirs, chunksize=chunksize, force=force, workers=workers, stream=stream, prune=prune,
+                prefetch=prefetch)
 
     # Remove any recordings from the unresolved recordings that may have just been added.
     urt = UnresolvedRecordingTracker()
@@ -134,24 +161,32 @@ def scan(db_file, music_dirs, chunksize=DEFAULT_CHUNKSIZE, force=False):
 
 @click.command()
 @click.option("-d", "--db_file", help="Database file for the local collection", required=False, is_flag=False)
-@click.option("-r", "--remove", required=False, is_flag=True, default=True)
-def cleanup(db_file, remove):
+@click.option("-r", "--remove", required=False, is_flag=True, default=False, help="Remove missing files from the index")
+@click.option("-j", "--concurrency", default=8, help="Number of files to check at the same time")
+@click.option("--changed-only", required=False, is_flag=True, default=False,
+              help="Only check files in directories that were modified since the last cleanup")
+def cleanup(db_file, remove, concurrency, changed_only):
     """Perform a database cleanup. Check that files exist and if they don't remove from the index"""
     db_file = db_file_check(db_file)
     db = Database(db_file)
     db.open()
-    db.database_cleanup(remove)
+    db.database_cleanup(not remove, concurrency=concurrency, changed_only=changed_only)
 
 
 @click.command()
 @click.option("-d", "--db_file", help="Database file for the local collection", required=False, is_flag=False)
-def metadata(db_file):
+@click.option("-j", "--concurrency", default=MetadataLookup.DEFAULT_CONCURRENCY, help="Number of batches of recordings to look up at the same time")
+@click.option("-r", "--refresh", type=click.Choice(MetadataLookup.REFRESH_POLICIES), default="all",
+              help="Look up all recordings, those without metadata, those with metadata older than --max-age "
+                   "or those added since the last lookup")
+@click.option("--max-age", default=MetadataLookup.DEFAULT_MAX_AGE, help="Age in days for the stale and missing refresh policies")
+def metadata(db_file, concurrency, refresh, max_age):
     """Lookup metadata (popularity and tags) for recordings"""
     db_file = db_file_check(db_file)
     db = Database(db_file)
     db.open()
-    lookup = MetadataLookup()
-    lookup.lookup()
+    lookup = MetadataLookup(url=getattr(config, "METADATA_LOOKUP_URL", None), concurrency=concurrency)
+    lookup.lookup(refresh=refresh, max_age=max_age)
 
     print("\nThese top tags describe your collection:")
     tt = TopTags()
@@ -160,12 +195,15 @@ def metadata(db_file):
 
 @click.command()
 @click.option("-d", "--db_file", help="Database file for the local collection", required=False, is_flag=False)
-def subsonic(db_file):
+@click.option("-j", "--concurrency", default=SubsonicDatabase.DEFAULT_CONCURRENCY, help="Number of albums to fetch at the same time")
+@click.option("-i", "--incremental", required=False, is_flag=True, default=False,
+              help="Only fetch the albums that changed since the last sync")
+def subsonic(db_file, concurrency, incremental):
     """Scan a remote subsonic music collection"""
     db_file = db_file_check(db_file)
     db = SubsonicDatabase(db_file, config)
     db.open()
-    db.sync()
+    db.sync(concurrency=concurrency, incremental=incremental)
 
 
 @click.command()
@@ -275,6 +313,29 @@ def unresolved(db_file):
     urt.print_releases(releases)
 
 
+@click.command()
+@click.option("-d", "--db_file", help="Database file for the local collection", required=False, is_flag=False)
+@click.option("-h", "--host", help="Host to listen on", default=server.DEFAULT_HOST)
+@click.option("-p", "--port", help="Port to listen on", default=server.DEFAULT_PORT)
+@click.option("-s", "--socket", "socket_path", help="Listen on this unix socket instead of a TCP port", required=False)
+@click.option("-w", "--workers", help="Number of requests handled at the same time", default=server.DEFAULT_WORKERS)
+@click.option("-t", "--threads", help="Number of threads used to search the fuzzy index (default: one per CPU)", type=int, required=False)
+@click.option("-k", "--candidates", help="Number of fuzzy index candidates to rerank per recording", default=ContentResolver.DEFAULT_CANDIDATES)
+@click.option("-a", "--artist-blocking", help="Match the artist first, then search only that artist's recordings", is_flag=True, default=False)
+def serve(db_file, host, port, socket_path, workers, threads, candidates, artist_blocking):
+    "Run a server that keeps the fuzzy index loaded and resolves recordings and playlists over HTTP"
+    db_file = db_file_check(db_file)
+    db = Database(db_file)
+    db.open()
+    server.serve(host=host,
+                 port=port,
+                 socket_path=socket_path,
+                 workers=workers,
+                 num_threads=threads,
+                 k=candidates,
+                 artist_blocking=artist_blocking)
+
+
 cli.add_command(create)
 cli.add_command(scan)
 cli.add_command(playlist)
@@ -286,6 +347,7 @@ cli.add_command(top_tags)
 cli.add_command(duplicates)
 cli.add_command(periodic_jams)
 cli.add_command(unresolved)
+cli.add_command(serve)
 
 
 def usage(command):
@@ -294,5 +356,7 @@ def usage(command):
 
 
 if __name__ == "__main__":
+    # Needed for the scan worker processes in frozen (pyinstaller) builds
+    freeze_support()
     cli()
     sys.exit(0)
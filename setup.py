@@ -22,7 +22,6 @@ setup(
     install_requires=[
         "Click==8.1.3",
         "mutagen==1.46.0",
-        "nmslib==2.1.1",
         "peewee==3.16.2",
         "py-sonic@git+https://github.com/mayhem/py-sonic.git@int-vs-string",
         "requests",
@@ -30,9 +29,14 @@ setup(
         "tqdm",
         "troi@git+https://github.com/metabrainz/troi-recommendation-playground.git@lb-local",
         "scikit-learn==1.2.1",
+        "numpy",
+        "scipy",
         "Unidecode==1.3.6",
         "lb_matching_tools@git+https://github.com/metabrainz/listenbrainz-matching-tools.git@v-2023-07-19.0"
     ],
+    extras_require={
+        "nmslib": ["nmslib==2.1.1"],
+    },
     use_scm_version=True,
     setup_requires=['setuptools_scm'],
 )